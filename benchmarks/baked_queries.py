@@ -0,0 +1,92 @@
+"""Per query overhead of the model_interface hot paths, baked vs not.
+
+'plain' builds and compiles an ORM Query on every call, as the hot paths
+did before, 'baked' runs the model_interface implementation, which reuses
+the compiled SQL.
+
+Usage: python -m benchmarks.baked_queries [--users N] [--queries N]
+"""
+import argparse
+import random
+import time
+
+from src import models
+from src.model_interface import Cache, DbConnection, User
+from src.utils import Rut
+
+
+def _time_per_call(function, args_list):
+    """Microseconds per call of 'function' over 'args_list'."""
+    start = time.perf_counter()
+    for args in args_list:
+        function(*args)
+    return (time.perf_counter() - start) * 1e6 / len(args_list)
+
+
+def _plain_load_identity(session, telegram_id):
+    return session.query(
+            models.User.id, models.User.rut,
+            models.SubscribedUsers.chat_id) \
+        .outerjoin(models.SubscribedUsers,
+                   models.SubscribedUsers.user_id == models.User.id) \
+        .filter(models.User.telegram_id == telegram_id).first()
+
+
+def _plain_cache_load(session, user_id, rut):
+    return session.query(models.CachedResult).filter_by(
+            user_id=user_id, rut=rut.rut_sin_digito).all()
+
+
+def _plain_get_chat_id(session, user_id):
+    return session.query(models.SubscribedUsers). \
+        filter(models.SubscribedUsers.user_id == user_id).first()
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=5000)
+    args = parser.parse_args()
+
+    db_connection = DbConnection(in_memory=True)
+    user = User(db_connection)
+    cache = Cache(db_connection)
+    ruts = {}
+    for telegram_id in range(1, args.users + 1):
+        rut = Rut.build_rut_sin_digito(str(10000000 + telegram_id))
+        ruts[user.get_id(telegram_id)] = rut
+        user.set_rut(telegram_id, rut)
+        user.subscribe(telegram_id, telegram_id)
+        cache.update(user.get_id(telegram_id), rut, 'result')
+    session = db_connection.get_session()
+
+    telegram_ids = [(random.randint(1, args.users),)
+                    for _ in range(args.queries)]
+    user_ids = [(random.choice(list(ruts)),) for _ in range(args.queries)]
+    user_ruts = [(user_id, ruts[user_id]) for (user_id,) in user_ids]
+
+    cases = (
+            ('load identity',
+             lambda telegram_id: _plain_load_identity(session, telegram_id),
+             lambda telegram_id: user._load_identity(telegram_id, False),
+             telegram_ids),
+            ('cache load',
+             lambda user_id, rut: _plain_cache_load(session, user_id, rut),
+             cache._load, user_ruts),
+            ('get chat id',
+             lambda user_id: _plain_get_chat_id(session, user_id),
+             user.get_chat_id, user_ids),
+    )
+    print('%-14s %12s %12s' % ('query', 'plain us', 'baked us'))
+    for name, plain, baked, args_list in cases:
+        # Warm up, the first baked call compiles the query.
+        plain(*args_list[0])
+        baked(*args_list[0])
+        print('%-14s %12.1f %12.1f' % (name,
+                                       _time_per_call(plain, args_list),
+                                       _time_per_call(baked, args_list)))
+
+
+if __name__ == '__main__':
+    main()
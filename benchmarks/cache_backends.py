@@ -0,0 +1,56 @@
+"""Compares the throughput of the cache backends.
+
+Usage: python -m benchmarks.cache_backends [--entries N] [--reads N]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from src import cache_backends
+from src.model_interface import DbConfig, DbConnection, User
+from src.utils import Rut
+
+
+def _bench(cache, ruts, reads):
+    """Returns (updates/s, reads/s) for 'cache'."""
+    start = time.perf_counter()
+    for user_id, rut in enumerate(ruts, 1):
+        cache.update(user_id, rut, 'result %d' % user_id)
+    update_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(reads):
+        user_id = random.randint(1, len(ruts))
+        cache.get(user_id, ruts[user_id - 1])
+    read_time = time.perf_counter() - start
+    return len(ruts) / update_time, reads / read_time
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--reads', type=int, default=5000)
+    args = parser.parse_args()
+
+    ruts = [Rut.build_rut_sin_digito(str(10000000 + i))
+            for i in range(args.entries)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_connection = DbConnection(config=DbConfig(
+                url='sqlite:///%s' % os.path.join(tmp_dir, 'db.sqlite')))
+        user = User(db_connection)
+        for telegram_id in range(1, args.entries + 1):
+            user.get_id(telegram_id)
+
+        print('%-8s %12s %12s' % ('backend', 'updates/s', 'reads/s'))
+        for backend in cache_backends.BACKENDS:
+            cache = cache_backends.build_cache(
+                    backend, db_connection, os.path.join(tmp_dir, 'cache'))
+            updates, reads = _bench(cache, ruts, args.reads)
+            print('%-8s %12.0f %12.0f' % (backend, updates, reads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Refresh pipeline simulation over a notification window, on a virtual
+clock.
+
+Seeds a temporary db with synthetic subscribers and drives the bot through
+window_step, as the loop does, from the opening of the next window until it
+closes. The virtual clock jumps to each wake up instead of sleeping, the
+bank is a fake answering after a fixed latency, in real time, so the
+workers, the job queue and the outbox run as they do in production.
+
+Reports, for each virtual hour, the bank queries made and the staleness of
+the subscribers' results, ie the time since they were retrieved. Then the
+achieved refresh rate and the notifications sent.
+
+Usage: python -m benchmarks.simulation [--subscribers N] [--ruts N]
+           [--rate N] [--latency S] [--change-probability P] [--hours N]
+"""
+import argparse
+import datetime
+import logging
+import os
+import pathlib
+import random
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from src import bot, models, utils, web
+from src.bot import ValeVistaBot
+from src.model_interface import DbConfig, DbConnection, User
+from src.web import Parser, WebRetriever
+
+_PAGES = pathlib.Path(web.__file__).parent.joinpath('test', 'test_pages')
+# Rendered payments, not worth a notification, and payments to be cashed,
+# notified when they show up.
+_RENDIDO = _PAGES.joinpath('pagado_rendido.html').read_text(
+        encoding='utf-8', errors='ignore')
+_RENDICION = _PAGES.joinpath('pagado_rendicion.html').read_text(
+        encoding='utf-8', errors='ignore')
+
+_PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class VirtualClock():
+    """Naive utc time which only moves when set. Thread safe."""
+
+    def __init__(self, start: datetime.datetime) -> None:
+        self._now = start
+        self._lock = threading.Lock()
+
+    def __call__(self) -> datetime.datetime:
+        with self._lock:
+            return self._now
+
+    def set(self, now: datetime.datetime) -> None:
+        """Moves the clock to 'now', never backwards."""
+        with self._lock:
+            self._now = max(self._now, now)
+
+
+class FakeBank(WebRetriever):
+    """Answers after 'latency' seconds, real time.
+
+    Each query flips the result of the rut, with 'change_probability',
+    between rendered payments and payments to be cashed.
+    """
+
+    def __init__(self, latency: float, change_probability: float) -> None:
+        self._latency = latency
+        self._change_probability = change_probability
+        self._lock = threading.Lock()
+        self._to_cash: Dict[int, bool] = {}
+        self.queries = 0
+
+    def retrieve(self, rut):
+        time.sleep(self._latency)
+        with self._lock:
+            self.queries += 1
+            to_cash = self._to_cash.get(rut.rut_sin_digito, False)
+            if random.random() < self._change_probability:
+                to_cash = not to_cash
+                self._to_cash[rut.rut_sin_digito] = to_cash
+        return _RENDICION if to_cash else _RENDIDO
+
+
+class _Updater():
+    """Stands for the telegram Updater, counts the messages sent."""
+
+    def __init__(self) -> None:
+        self.bot = self
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def sendMessage(self, unused_chat_id, unused_text):
+        # pylint: disable=invalid-name
+        with self._lock:
+            self.sent += 1
+
+    def stop(self):
+        """Nothing to stop."""
+
+
+def seed(db_connection: DbConnection, subscribers: int, ruts: int,
+         now: datetime.datetime, max_age: datetime.timedelta) -> None:
+    """Adds 'subscribers' users subscribed to one of 'ruts' ruts, with
+    results retrieved up to 'max_age' before 'now'."""
+    result = Parser.events_to_cache_string(
+            Parser.parse(_RENDIDO).get_events())
+    users, subscriptions, cached = [], [], []
+    for user_id in range(1, subscribers + 1):
+        rut = str(10000000 + user_id % ruts)
+        users.append({'id': user_id, 'telegram_id': user_id, 'rut': rut})
+        subscriptions.append({'user_id': user_id, 'chat_id': str(user_id)})
+        cached.append({'user_id': user_id, 'rut': rut, 'result': result,
+                       'retrieved': now - random.random() * max_age})
+    with db_connection.engine.connect() as connection:
+        with connection.begin():
+            connection.execute(models.User.__table__.insert(), users)
+            connection.execute(models.SubscribedUsers.__table__.insert(),
+                               subscriptions)
+            connection.execute(models.CachedResult.__table__.insert(),
+                               cached)
+
+
+def staleness(db_connection: DbConnection,
+              now: datetime.datetime) -> List[float]:
+    """Hours since the results of each subscriber were retrieved, sorted.
+    """
+    return sorted((now - subscriber.retrieved).total_seconds() / 3600
+                  for subscriber in User(db_connection).get_subscribers())
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    return values[int(fraction * (len(values) - 1))]
+
+
+def _format_staleness(ages: List[float]) -> str:
+    overdue = sum(1 for age in ages if age > bot.HOURS_TO_UPDATE)
+    return '%s %6.1f %8.1f%%' % (
+            ' '.join('%6.1f' % _percentile(ages, fraction)
+                     for fraction in _PERCENTILES),
+            ages[-1], 100.0 * overdue / len(ages))
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--ruts', type=int, default=None,
+                        help='distinct ruts, by default one per subscriber')
+    parser.add_argument('--rate', type=float, default=bot.REFRESH_RATE,
+                        help='maximum refreshes per hour')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds each bank query takes')
+    parser.add_argument('--change-probability', type=float, default=0.1)
+    parser.add_argument('--max-age', type=float,
+                        default=bot.HOURS_TO_UPDATE,
+                        help='hours, the seeded results are retrieved '
+                        'uniformly up to this long before the opening')
+    parser.add_argument('--hours', type=float, default=None,
+                        help='virtual hours, until the window closes by '
+                        'default')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    # The page of payments to be cashed logs a parse error on every query.
+    logging.getLogger('bot_main_logger').setLevel(logging.CRITICAL)
+
+    opening, closing = utils.next_window(datetime.datetime.utcnow())
+    if args.hours is not None:
+        closing = opening + datetime.timedelta(hours=args.hours)
+    clock = VirtualClock(opening)
+    tmp_dir = tempfile.TemporaryDirectory()
+    # Not in memory, its single connection can't be shared by the workers.
+    db_connection = DbConnection(config=DbConfig(url='sqlite:///%s' % (
+            os.path.join(tmp_dir.name, 'db.sqlite'))))
+    seed(db_connection, args.subscribers, args.ruts or args.subscribers,
+         opening, datetime.timedelta(hours=args.max_age))
+    bank = FakeBank(args.latency, args.change_probability)
+    updater = _Updater()
+    valevista = ValeVistaBot(db_connection, bank, refresh_rate=args.rate,
+                             clock=clock)
+
+    print('%6s %8s %6s %6s %6s %6s %9s' % (
+            'hour', 'queries', 'p50 h', 'p90 h', 'p99 h', 'max h',
+            'overdue'))
+    start = time.perf_counter()
+    next_report = opening
+    queries = 0
+    while True:
+        now = clock()
+        if now >= next_report:
+            valevista.wait_refreshes()
+            print('%6.1f %8d %s' % (
+                    (now - opening).total_seconds() / 3600,
+                    bank.queries - queries,
+                    _format_staleness(staleness(db_connection, now))))
+            queries = bank.queries
+            next_report += datetime.timedelta(hours=1)
+        if now >= closing:
+            break
+        clock.set(min(valevista.window_step(updater, now), next_report,
+                      closing))
+    valevista.wait_refreshes()
+    elapsed = time.perf_counter() - start
+    hours = (clock() - opening).total_seconds() / 3600
+
+    print('%d bank queries in %.1f virtual hours, %.1f/h, for %d '
+          'subscribers' % (bank.queries, hours, bank.queries / hours,
+                           args.subscribers))
+    print('%d notifications sent' % updater.sent)
+    print('%.1f s of real time, %.1f bank queries/s' % (
+            elapsed, bank.queries / elapsed))
+    valevista.shutdown(updater)
+    tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
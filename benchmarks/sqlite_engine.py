@@ -0,0 +1,132 @@
+"""Concurrent handlers plus refresh loop throughput per engine config.
+
+Several threads emulate the telegram handlers (user lookups and cache reads
+and writes) while another one emulates the refresh loop (stale subscribers
+query and cache writes). Reports operations per second and lock errors for
+the sqlite defaults, for the production DbConfig writing from every thread
+and for the production DbConfig with the single writer thread.
+
+Usage: python -m benchmarks.sqlite_engine [--seconds N] [--handlers N]
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from src.model_interface import Cache, DbConfig, DbConnection, User
+from src.utils import Rut
+
+CONFIGS = (
+        ('sqlite defaults', DbConfig(journal_mode='DELETE',
+                                     synchronous='FULL', mmap_size=0,
+                                     cache_size=-2000)),
+        ('inline writes', DbConfig(single_writer=False)),
+        ('production', DbConfig()),
+)
+
+_SUBSCRIBERS = 200
+# Short expiration, so handlers keep a mix of reads and writes.
+_EXP_TIME = datetime.timedelta(seconds=1)
+
+
+class _Counter():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = 0
+        self.errors = 0
+
+    def add(self, ops=0, errors=0):
+        """Adds to the counters."""
+        with self.lock:
+            self.ops += ops
+            self.errors += errors
+
+
+def _populate(db_connection):
+    user = User(db_connection)
+    for telegram_id in range(1, _SUBSCRIBERS + 1):
+        user.set_rut(telegram_id,
+                     Rut.build_rut_sin_digito(str(10000000 + telegram_id)))
+        user.subscribe(telegram_id, telegram_id)
+
+
+def _handler(db_connection, cache, deadline, counter):
+    user = User(db_connection)
+    while time.perf_counter() < deadline:
+        telegram_id = random.randint(1, _SUBSCRIBERS)
+        try:
+            rut = user.get_rut(telegram_id)
+            user_id = user.get_id(telegram_id)
+            if cache.get(user_id, rut) is None:
+                cache.update(user_id, rut, 'result %d' % random.randint(0, 3))
+            counter.add(ops=1)
+        except OperationalError:
+            db_connection.get_session().rollback()
+            counter.add(errors=1)
+    db_connection.get_session().close()
+
+
+def _refresh_loop(db_connection, cache, deadline, counter):
+    user = User(db_connection)
+    while time.perf_counter() < deadline:
+        try:
+            for subscriber in user.get_subscribers_to_update(
+                    0, datetime.datetime.utcnow(), 10):
+                cache.update(subscriber.user_id,
+                             Rut.build_rut_sin_digito(subscriber.rut),
+                             'result %d' % random.randint(0, 3))
+                counter.add(ops=1)
+        except OperationalError:
+            db_connection.get_session().rollback()
+            counter.add(errors=1)
+    db_connection.get_session().close()
+
+
+def _bench(config, seconds, handlers):
+    db_connection = DbConnection(config=config)
+    _populate(db_connection)
+    cache = Cache(db_connection, exp_time=_EXP_TIME)
+    handler_counter = _Counter()
+    refresh_counter = _Counter()
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=_handler,
+                                args=(db_connection, cache, deadline,
+                                      handler_counter))
+               for _ in range(handlers)]
+    threads.append(threading.Thread(
+            target=_refresh_loop,
+            args=(db_connection, cache, deadline, refresh_counter)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db_connection.close()
+    return handler_counter, refresh_counter
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--handlers', type=int, default=4)
+    args = parser.parse_args()
+
+    print('%-16s %14s %14s %8s' % ('config', 'handler ops/s',
+                                   'refresh ops/s', 'errors'))
+    for name, config in CONFIGS:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = config._replace(url='sqlite:///%s' % os.path.join(
+                    tmp_dir, 'db.sqlite'))
+            handler, refresh = _bench(config, args.seconds, args.handlers)
+        print('%-16s %14.0f %14.0f %8d' % (
+                name, handler.ops / args.seconds,
+                refresh.ops / args.seconds, handler.errors + refresh.errors))
+
+
+if __name__ == '__main__':
+    main()
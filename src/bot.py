@@ -3,24 +3,32 @@
 
 """ Module implementing the main loop and the telegram API."""
 
+from concurrent.futures import ThreadPoolExecutor
 import enum
 import datetime
-from functools import partial
+from functools import partial, wraps
 import logging
 import logging.handlers
-from queue import Queue
 import random
 import os
 from signal import signal, SIGINT, SIGTERM, SIGABRT
 import sys
-import time
+import threading
+from typing import Callable, Set, Tuple
 
 from telegram.ext import CommandHandler, Dispatcher, Filters, MessageHandler
 from telegram.ext import Updater
 import telegram
 
 
+from src import cache_backends
+from src.job_queue import Job, JobQueue
 from src.messages import Messages
+from src import outbox
+from src.outbox import Outbox
+from src.pacing import RefreshPacer
+from src.scheduler import RefreshScheduler
+from src.shutdown import ShutdownCoordinator
 from src.model_interface import User, DbConnection
 from src.model_interface import UserBadUseError, UserDoesNotExistError
 from src import model_interface
@@ -28,6 +36,7 @@ from src.utils import Rut
 from src import utils
 from src import web
 from src.web import ParsingException, Web, WebRetriever
+from src.workers import WorkerPool
 
 logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
 logger.setLevel(logging.DEBUG)
@@ -54,10 +63,84 @@ logger.info('Logging started')
 # Gets the bot token from the environment.
 TOKEN = os.getenv("BOT_TOKEN", None)
 
+# Cache backend, one of cache_backends.BACKENDS.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+
+# File used by the dbm cache backend.
+CACHE_DBM_PATH = os.getenv("CACHE_DBM_PATH", "cache.dbm")
+
+# Minutes after expiration during which /get answers with the cached result
+# while the bank is queried in background. 0 disables it.
+STALE_GRACE = datetime.timedelta(
+        minutes=int(os.getenv("STALE_GRACE_MINUTES", "0")))
+
+# Max concurrent background queries to refresh stale results.
+REVALIDATION_WORKERS = 2
+
 # Minimum hours before automatically update a cached result from a user
 HOURS_TO_UPDATE = 33
 
-SUBSCRIBED = Queue()  # type: Queue
+# The subscriber refreshed by each step is chosen among this many of the
+# most stale ones.
+STEP_CANDIDATES = 20
+
+# Max background refreshes per hour. Within it the rate is paced to refresh
+# the due subscribers evenly until the window closes.
+REFRESH_RATE = float(os.getenv("REFRESH_RATE_PER_HOUR", "360"))
+
+# Min background refreshes per hour, even if no subscriber is due.
+REFRESH_MIN_RATE = 6
+
+# A failed background refresh is tried again after this long, doubled after
+# each failure.
+REFRESH_RETRY_DELAY = datetime.timedelta(minutes=30)
+
+# Kinds of the jobs in the job queue, their payloads are:
+# refresh: the 'rut' (without digito verificador) whose subscribers are
+# refreshed.
+REFRESH_JOB = 'refresh'
+# notify: 'telegram_id', 'chat_id' and 'message' to send.
+NOTIFY_JOB = 'notify'
+
+# Dead jobs are deleted after this long, if a refresh job was dead its
+# subscriber is tried again afterwards.
+DEAD_JOB_RETENTION = datetime.timedelta(days=1)
+
+# Threads running the background refreshes.
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "4"))
+
+# Max background refreshes querying the bank at once.
+REFRESH_FETCH_CONCURRENCY = int(os.getenv("REFRESH_FETCH_CONCURRENCY", "2"))
+
+# Max messages per second sent by the bot, Telegram allows about 30.
+TELEGRAM_GLOBAL_RATE = 25
+
+# Max messages per second sent to each chat.
+TELEGRAM_CHAT_RATE = 1
+
+# Max background refreshes queued or running, the loop waits for a free
+# slot before taking another subscriber from the scheduler.
+REFRESH_MAX_PENDING = 2 * REFRESH_WORKERS
+
+# Max time the loop sleeps within the window, before checking it again.
+MAX_LOOP_SLEEP = datetime.timedelta(minutes=5)
+
+# How long before the window opens subscribers start to be pre-fetched.
+WARMUP_LEAD = datetime.timedelta(hours=1)
+
+# Seconds the bot has to stop once signaled, in flight work not done by then
+# is lost. Keep it under the grace period of the process manager.
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE_SECONDS", "20"))
+
+# Held notifications leased at once when the window opens.
+FLUSH_BATCH_SIZE = 20
+
+# Minimum time between db maintenance runs, they only run outside the
+# window.
+MAINTENANCE_PERIOD = datetime.timedelta(days=1)
+
+# How often the cache usage stats are written to the log.
+STATS_LOG_PERIOD = datetime.timedelta(hours=6)
 
 
 class ValeVistaBot():
@@ -66,16 +149,49 @@ class ValeVistaBot():
     username = "valevistabot"
 
     # Arguments are dependency injection for test purposes.
+    # pylint: disable=too-many-arguments
     def __init__(self, db_connection: DbConnection,
                  web_retriever: WebRetriever = None,
-                 cache: model_interface.Cache = None) -> None:
+                 cache: model_interface.CacheBackend = None,
+                 stale_grace: datetime.timedelta = STALE_GRACE,
+                 refresh_rate: float = REFRESH_RATE,
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        """
+        :param clock: current naive utc time, replaced by a virtual one to
+                      simulate the refreshes. The loop sleeps in real time.
+        """
         if web_retriever is None:
             self._web_retriever = web.WebPageDownloader()  # type: WebRetriever
         else:
             self._web_retriever = web_retriever
-        self._cache = cache or model_interface.Cache(db_connection)
+        self._clock = clock
+        self._cache = cache or model_interface.Cache(db_connection,
+                                                     clock=clock)
         self._running = True
+        # Set to wake the loop up when stopping.
+        self._stopping = threading.Event()
+        self._window = utils.NotificationWindow()
         self._db_connection = db_connection
+        self._jobs = JobQueue(db_connection,
+                              retry_delay=REFRESH_RETRY_DELAY, clock=clock)
+        self._stale_grace = stale_grace
+        self._revalidator = ThreadPoolExecutor(
+                max_workers=REVALIDATION_WORKERS)
+        # (telegram_id, rut) being revalidated in background.
+        self._revalidating: Set[Tuple[int, int]] = set()
+        self._revalidating_lock = threading.Lock()
+        self._scheduler = RefreshScheduler(db_connection, HOURS_TO_UPDATE,
+                                           refresh_rate, cache=self._cache)
+        self._pacer = RefreshPacer(self._scheduler, REFRESH_MIN_RATE,
+                                   refresh_rate)
+        self._refresh_pool = WorkerPool(
+                REFRESH_WORKERS, REFRESH_MAX_PENDING,
+                {'fetch': REFRESH_FETCH_CONCURRENCY})
+        self._outbox = Outbox(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE,
+                              on_unauthorized=self._chat_unauthorized)
+        self._refresh_retriever = web.LimitedRetriever(
+                self._web_retriever, self._refresh_pool.stage('fetch'))
 
     # Command handlers.
     @staticmethod
@@ -101,31 +217,31 @@ class ValeVistaBot():
         if rut:
             logger.debug('USR[%s]; GET_RUT[%s]', telegram_id, rut)
             self.query_the_bank_and_reply(telegram_id, rut,
-                                          update.message.reply_text,
+                                          self._interactive_reply(update),
                                           self.ReplyWhen.ALWAYS)
             return
         logger.debug('USR[%s]; GET_NO_RUT', telegram_id)
-        update.message.reply_text(Messages.NO_RUT_MSG)
+        self._reply(update, Messages.NO_RUT_MSG)
 
     def set_rut(self, unused_bot, update: telegram.Update):
         """Set a rut to easily query it in the future."""
         spl = update.message.text.split(' ')
         if len(spl) < 2:
             logger.debug('USR[%s]; EMPTY_RUT', update.message.from_user.id)
-            update.message.reply_text(Messages.SET_EMPTY_RUT)
+            self._reply(update, Messages.SET_EMPTY_RUT)
             return
 
         rut = Rut.build_rut(spl[1])
 
         if rut is None:
             logger.debug('USR[%s]; INVALID_RUT', update.message.from_user.id)
-            update.message.reply_text(Messages.SET_INVALID_RUT)
+            self._reply(update, Messages.SET_INVALID_RUT)
             return
 
         User(self._db_connection).set_rut(update.message.from_user.id, rut)
 
         logger.debug("USR[%s]; SET_RUT[%s]", update.message.from_user.id, rut)
-        update.message.reply_text(Messages.SET_RUT % rut)
+        self._reply(update, Messages.SET_RUT % rut)
 
     def subscribe(self, unused_bot, update: telegram.Update):
         """Subscribe and get updates on valevista changes for your rut."""
@@ -134,16 +250,16 @@ class ValeVistaBot():
         if chat_type != 'private':
             logger.debug('USR[%s]; FROM NON PRIVATE CHAT[%s]',
                          update.message.from_user.id, chat_type)
-            update.message.reply_text(Messages.FROM_NON_PRIVATE_CHAT)
+            self._reply(update, Messages.FROM_NON_PRIVATE_CHAT)
             return
         try:
             User(self._db_connection).subscribe(
                     update.message.from_user.id, update.message.chat.id)
         except UserBadUseError as bad_user_exep:
             logger.warning(bad_user_exep.public_message)
-            update.message.reply_text(bad_user_exep.public_message)
+            self._reply(update, bad_user_exep.public_message)
         else:
-            update.message.reply_text(Messages.SUBSCRIBED)
+            self._reply(update, Messages.SUBSCRIBED)
 
     def unsubscribe(self, unused_bot, update: telegram.Update):
         """Stop getting updates."""
@@ -153,13 +269,13 @@ class ValeVistaBot():
                                                   update.message.chat.id)
         except UserBadUseError as bad_user_exep:
             logger.warning(bad_user_exep.public_message)
-            update.message.reply_text(bad_user_exep.public_message)
+            self._reply(update, bad_user_exep.public_message)
         except UserDoesNotExistError as user_exep:
             logger.warning(user_exep.public_message)
-            update.message.reply_text(Messages.UNSUBSCRIBE_NON_SUBSCRIBED)
+            self._reply(update, Messages.UNSUBSCRIBE_NON_SUBSCRIBED)
         else:
             logger.info("User %s unsubscribed", update.message.from_user.id)
-            update.message.reply_text(Messages.UNSUBSCRIBED)
+            self._reply(update, Messages.UNSUBSCRIBED)
 
     @staticmethod
     def debug(bot, update: telegram.Update):
@@ -180,10 +296,10 @@ class ValeVistaBot():
         rut = Rut.build_rut(update.message.text)
         if rut:
             self.query_the_bank_and_reply(update.message.from_user.id, rut,
-                                          update.message.reply_text,
+                                          self._interactive_reply(update),
                                           self.ReplyWhen.ALWAYS)
         elif Rut.looks_like_rut(update.message.text):
-            update.message.reply_text(Messages.LOOKS_LIKE_RUT)
+            self._reply(update, Messages.LOOKS_LIKE_RUT)
         else:
             self.echo(bot, update)
 
@@ -193,21 +309,59 @@ class ValeVistaBot():
         """Replies with the message received."""
         update.message.reply_text(update.message.text)
 
-    @staticmethod
-    def send_message_retry(send_fx, retries):
-        """Calls send_fx and it retries if it fails due network issues. """
+    def _reply(self, update: telegram.Update, msg: str):
+        """Replies 'msg' to 'update' once the unit of work commits, the
+        transaction is not held open while talking to telegram."""
+        self._db_connection.after_commit(
+                lambda: update.message.reply_text(msg))
+
+    def _interactive_reply(self, update: telegram.Update):
+        """Function replying to 'update' through the outbox, ahead of the
+        background notifications, once the unit of work commits. It waits
+        until the reply is sent.
 
-        while True:
+        Network errors are retried by the outbox, if it gives up the reply
+        is dropped.
+        """
+        def send(msg):
             try:
-                send_fx()
+                self._outbox.send(
+                        update.message.chat_id,
+                        partial(update.message.reply_text, msg),
+                        outbox.INTERACTIVE).result()
             except telegram.error.NetworkError:
-                if retries == 0:
-                    logger.exception("Network error, retrying...")
-                    break
-                else:
-                    retries = retries - 1
-                    logger.warning("Network error, retrying.")
-            break
+                logger.exception('USR[%s]; Reply not sent',
+                                 update.message.from_user.id)
+
+        def reply(msg):
+            self._db_connection.after_commit(partial(send, msg))
+        return reply
+
+    def _notification(self, updater, chat_id, msg):
+        """Queues a background notification, returns its future."""
+        return self._outbox.send(
+                chat_id, partial(updater.bot.sendMessage, chat_id, msg))
+
+    def _queue_notification(self, updater, telegram_id, chat_id, msg,
+                            hold=False):
+        """Queues a notification job in the unit of work of the cache write,
+        so it is not lost if the bot stops before sending it. It is sent
+        once the unit of work commits.
+
+        :param hold: leaves it for flush_held_notifications instead, eg on
+                     warmups.
+        """
+        self._hold_notification(telegram_id, chat_id, msg)
+        if not hold:
+            self._db_connection.after_commit(
+                    partial(self.flush_held_notifications, updater))
+
+    def _chat_unauthorized(self, chat_id: str):
+        """Unsubscribes the chat of a message rejected as unauthorized."""
+        logger.debug('CHAT_ID[%s] Unauthorized us, unsubscribing...',
+                     chat_id)
+        with self._db_connection.unit_of_work('unsubscribe'):
+            User(self._db_connection).unsubscribe_chat(chat_id)
 
     class ReplyWhen(enum.Enum):
         """When to send a message to the user."""
@@ -215,58 +369,124 @@ class ValeVistaBot():
         IS_USEFUL_FOR_USER = 2  # Only send a message if there is useful data.
 
     def query_the_bank_and_reply(self, telegram_id: int, rut: Rut, reply_fn,
-                                 reply_when: ReplyWhen):
+                                 reply_when: ReplyWhen,
+                                 web_retriever: WebRetriever = None):
         """Query the bank for updates, and send a message to the user.
 
         If reply_when is set to always, send a message to the user even if
         there are no changes from the last time we queried. Otherwise will
         send a message to the user only if new and useful information was
         retrieved.
+
+        :param web_retriever: overrides the bot's retriever.
+
+        Returns:
+            bool: Whether the results could be retrieved.
         """
-        def reply(msg):
-            """Wrapper for retrying on network error."""
-            return self.send_message_retry(lambda: reply_fn(msg), 3)
+        if (reply_when == self.ReplyWhen.ALWAYS and self._stale_grace and
+                self._reply_stale(telegram_id, rut, reply_fn)):
+            return True
         try:
             web_result = Web(self._db_connection, rut, telegram_id,
-                             self._cache, self._web_retriever)
+                             self._cache,
+                             web_retriever or self._web_retriever)
             response = web_result.get_results()
         # Expected exception.
         except ParsingException as parsing_exep:
             if reply_when == self.ReplyWhen.ALWAYS:
-                reply(parsing_exep.public_message)
-            return
+                reply_fn(parsing_exep.public_message)
+            return False
         except Exception:  # pylint: disable=broad-except
             logger.exception("Error:")
             if reply_when == self.ReplyWhen.ALWAYS:
-                reply(Messages.INTERNAL_ERROR)
-            return
+                reply_fn(Messages.INTERNAL_ERROR)
+            return False
 
         if reply_when == self.ReplyWhen.ALWAYS:
-            reply(response)
+            reply_fn(response)
         elif reply_when == self.ReplyWhen.IS_USEFUL_FOR_USER:
             if web_result.is_useful_info_for_user():
                 logger.debug('USR[%s]; Useful[%s]', telegram_id, response)
-                reply(response)
+                reply_fn(response)
         else:
             logger.error('Not handled enum: %s', reply_when)
+        return True
+
+    def _reply_stale(self, telegram_id: int, rut: Rut, reply) -> bool:
+        """Replies with a stale cached result and revalidates it.
+
+        Returns whether a stale result was found and sent, if so the bank is
+        queried in background and the user only gets a second message if
+        the result changed.
+        """
+        user_id = User(self._db_connection).get_id(telegram_id)
+        stale_result, age = self._cache.get_allow_stale(user_id, rut,
+                                                        self._stale_grace)
+        if age is None:
+            return False
+        reply(stale_result + Messages.STALE_RESULT % (
+                age.total_seconds() // 60))
+        key = (telegram_id, rut.rut_sin_digito)
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return True
+            self._revalidating.add(key)
+        self._revalidator.submit(self._revalidate, telegram_id, rut, reply,
+                                 stale_result)
+        return True
+
+    def _revalidate(self, telegram_id: int, rut: Rut, reply,
+                    stale_result: str):
+        try:
+            with self._db_connection.unit_of_work('revalidate'):
+                web_result = Web(self._db_connection, rut, telegram_id,
+                                 self._cache, self._web_retriever)
+            response = web_result.get_results()
+            # Errors from the bank are not worth a second message.
+            result_type = web_result.web_result.get_type()
+            if (result_type == web.TypeOfWebResult.NO_ERROR and
+                    response != stale_result):
+                logger.debug('USR[%s]; Stale result changed', telegram_id)
+                reply(Messages.STALE_RESULT_UPDATED + response)
+        except ParsingException as parsing_exep:
+            logger.warning('USR[%s]; Revalidation failed: %s', telegram_id,
+                           parsing_exep.public_message)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Revalidation error:")
+        finally:
+            with self._revalidating_lock:
+                self._revalidating.discard((telegram_id, rut.rut_sin_digito))
 
     # Bot helping functions.
+    def _unit_of_work(self, handler):
+        """Wraps 'handler' to run it in a single db unit of work."""
+        @wraps(handler)
+        def wrapped(bot, update):
+            with self._db_connection.unit_of_work(
+                    'update:%s' % handler.__name__):
+                return handler(bot, update)
+        return wrapped
+
     def add_handlers(self, dispatcher: Dispatcher) -> None:
         """Adds all ValeVistaBot handlers to 'dispatcher'."""
-        dispatcher.add_handler(CommandHandler("start", self.start))
-        dispatcher.add_handler(CommandHandler("set", self.set_rut))
-        dispatcher.add_handler(CommandHandler("get", self.get_rut))
-        dispatcher.add_handler(CommandHandler("debug", self.debug))
-        dispatcher.add_handler(CommandHandler("help", self.help))
-        dispatcher.add_handler(CommandHandler("subscribe", self.subscribe))
-        dispatcher.add_handler(CommandHandler("unsubscribe", self.unsubscribe))
-        dispatcher.add_handler(MessageHandler(Filters.text, self.msg))
+        uow = self._unit_of_work
+        dispatcher.add_handler(CommandHandler("start", uow(self.start)))
+        dispatcher.add_handler(CommandHandler("set", uow(self.set_rut)))
+        dispatcher.add_handler(CommandHandler("get", uow(self.get_rut)))
+        dispatcher.add_handler(CommandHandler("debug", uow(self.debug)))
+        dispatcher.add_handler(CommandHandler("help", uow(self.help)))
+        dispatcher.add_handler(
+                CommandHandler("subscribe", uow(self.subscribe)))
+        dispatcher.add_handler(
+                CommandHandler("unsubscribe", uow(self.unsubscribe)))
+        dispatcher.add_handler(MessageHandler(Filters.text, uow(self.msg)))
         dispatcher.add_error_handler(self.error)
 
     def signal_handler(self, unused_signum, unused_frame):
         """Gracefully stops the bot on a received signal."""
         if self._running:
             self._running = False
+            self._stopping.set()
         else:
             logger.error("Exiting now!")
             sys.exit(1)
@@ -276,46 +496,286 @@ class ValeVistaBot():
 
         If useful new data is available, send a message to the user.
         """
-        user_conn = User(self._db_connection)
-        users_to_update = user_conn.get_subscribers_to_update(hours)
-        if not users_to_update:
+        with self._db_connection.unit_of_work('step'):
+            users_to_update = self._cache.subscribers_to_update(
+                    User(self._db_connection), hours, STEP_CANDIDATES)
+            if not users_to_update:
+                return
+
+            # Random among the most stale ones, so a subscriber whose query
+            # keeps failing does not block the others.
+            self._refresh(updater, random.choice(users_to_update))
+
+    def _refresh(self, updater, subscriber: model_interface.Subscriber,
+                 web_retriever: WebRetriever = None, hold=False):
+        """Queries the bank for 'subscriber', notifies if useful.
+
+        :param web_retriever: overrides the retriever for the refreshes.
+        :param hold: holds the notification, see _queue_notification.
+
+        Returns:
+            bool: Whether the results could be retrieved.
+        """
+        logger.debug("Updating: user_id=%s", subscriber.user_id)
+        rut = Rut.build_rut_sin_digito(subscriber.rut)
+        # The notifications are sent by the outbox, a chat rejecting them as
+        # unauthorized is unsubscribed by _chat_unauthorized.
+        return self.query_the_bank_and_reply(
+                subscriber.telegram_id, rut,
+                partial(self._queue_notification, updater,
+                        subscriber.telegram_id, subscriber.chat_id,
+                        hold=hold),
+                ValeVistaBot.ReplyWhen.IS_USEFUL_FOR_USER,
+                web_retriever or self._refresh_retriever)
+
+    def _refresh_task(self, updater, job: Job):
+        """Runs a refresh job, the bank is queried once for all the
+        subscribers of the rut."""
+        if self._stopping.is_set():
+            # Queued when the bot started stopping, left for the next start.
+            self._jobs.release(job, self._clock())
             return
+        retriever = web.SharedRetriever(self._refresh_retriever)
+        error = None
+        for subscriber in User(self._db_connection).get_subscribers(
+                job.payload['rut']):
+            try:
+                with self._db_connection.unit_of_work('refresh'):
+                    if not self._refresh(updater, subscriber, retriever,
+                                         job.payload.get('hold', False)):
+                        error = 'results not retrieved'
+            except Exception as exception:  # pylint: disable=broad-except
+                logger.exception("Refresh failed")
+                error = repr(exception)
+        if error is None:
+            self._jobs.complete(job)
+        else:
+            # The subscribers refreshed are not queried again on retries,
+            # their cached results are fresh.
+            self._jobs.fail(job, self._clock(), error)
 
-        user_to_update = users_to_update[random.randint(
-                0, len(users_to_update) - 1)]
-        logger.debug("To update queue length: %s. Updating: user_id=%s",
-                     len(users_to_update), user_to_update.id)
-        rut = Rut.build_rut_sin_digito(user_to_update.rut)
-        user_chat_id = user_conn.get_chat_id(user_to_update.id)
-        try:
-            self.query_the_bank_and_reply(
-                    user_to_update.telegram_id, rut,
-                    partial(updater.bot.sendMessage, user_chat_id),
-                    ValeVistaBot.ReplyWhen.IS_USEFUL_FOR_USER)
-        except telegram.error.Unauthorized:
-            logger.debug(
-                    'USR[%s]; CHAT_ID[%s] Unauthorized us, unsubscribing...',
-                    user_to_update.telegram_id, user_chat_id)
-            user_conn.unsubscribe(user_to_update.telegram_id, user_chat_id)
+    def refresh_due(self, updater, now: datetime.datetime,
+                    due_by: datetime.datetime = None) -> int:
+        """Starts refreshing the subscribers the scheduler finds due at 'now'.
+
+        The subscribers are refreshed in groups sharing a rut, queued as
+        jobs, so they are retried if they fail and not lost on restarts.
+        Blocks while the workers are busy, see wait_refreshes to wait for
+        the refreshes to finish.
+
+        :param due_by: refreshes the subscribers due by then instead, ahead
+                       of time, holding their notifications.
+
+        Returns:
+            int: Number of refreshes, ie ruts, started.
+        """
+        group = self._scheduler.next_due_group(now, due_by)
+        while group and self._running:
+            # Already queued if a previous refresh failed or the bot
+            # restarted while running it.
+            self._jobs.put(REFRESH_JOB, {'rut': group[0].rut,
+                                         'hold': due_by is not None},
+                           key='refresh:%s' % group[0].rut,
+                           available_at=now)
+            for subscriber in group:
+                self._scheduler.done(subscriber, now)
+            group = self._scheduler.next_due_group(self._clock(), due_by)
+        started = 0
+        while self._running:
+            jobs = self._jobs.lease(REFRESH_JOB, self._clock())
+            if not jobs:
+                break
+            self._refresh_pool.submit(self._refresh_task, updater, jobs[0])
+            started += 1
+        return started
+
+    def wait_refreshes(self, timeout: float = None) -> bool:
+        """Waits for the started refreshes to finish, and their
+        notifications to be sent.
+
+        Returns:
+            bool: False if it timed out.
+        """
+        return (self._refresh_pool.join(timeout) and
+                self.wait_notifications(timeout))
+
+    def wait_notifications(self, timeout: float = None) -> bool:
+        """Waits for the queued messages to be sent.
+
+        Returns:
+            bool: False if it timed out.
+        """
+        return self._outbox.join(timeout)
+
+    def log_stats(self):
+        """Writes the cache and db query stats to the log."""
+        logger.info('Cache stats: %s',
+                    model_interface.CacheStats.format(self._cache.stats()))
+        logger.info('Query stats:\n%s', self._db_connection.profiler.format(
+                self._db_connection.profiler.snapshot()))
+        logger.info('Refresh scheduler: %s', RefreshScheduler.format(
+                self._scheduler.report(self._clock())))
+        logger.info('Refresh pacing: %s', RefreshPacer.format(
+                self._pacer.report(self._clock())))
+        logger.info('Refresh workers: %(pending)d pending, %(completed)d '
+                    'completed', self._refresh_pool.stats())
+        logger.info('Outbox: %(pending)d pending', self._outbox.stats())
+        logger.info('Jobs: %(pending)d pending, %(leased)d leased, %(dead)d '
+                    'dead', self._jobs.stats())
+
+    def _hold_notification(self, telegram_id, chat_id, msg):
+        self._jobs.put(NOTIFY_JOB, {'telegram_id': telegram_id,
+                                    'chat_id': chat_id, 'message': msg},
+                       available_at=self._clock())
+
+    def warmup_step(self, updater,
+                    now: datetime.datetime) -> datetime.datetime:
+        """Starts refreshing the subscribers due by the opening, paced to
+        finish them before it.
+
+        Runs before the window opens, so the window is spent sending rather
+        than querying the bank. Useful results are held until
+        flush_held_notifications is called.
+
+        Returns:
+            datetime: when more refreshes may be due, or the window opens.
+        """
+        opening = self._window.next_window(now)[0]
+        self._pacer.update(now, opening)
+        self.refresh_due(updater, now, due_by=opening)
+        done = self._clock()
+        return min(done + min(datetime.timedelta(
+                seconds=self._scheduler.seconds_until_next(done, opening)),
+                              MAX_LOOP_SLEEP), opening)
+
+    def window_step(self, updater,
+                    now: datetime.datetime) -> datetime.datetime:
+        """Sends the held notifications and starts the refreshes due at
+        'now', paced to finish them before the window closes.
+
+        Outside of the window nothing is sent nor refreshed.
+
+        Returns:
+            datetime: when more refreshes may be due, or the window opens.
+        """
+        if not self._window.is_open(now):
+            return self._window.next_window(now)[0]
+        self.flush_held_notifications(updater)
+        self._pacer.update(now)
+        self.refresh_due(updater, now)
+        done = self._clock()
+        return done + min(datetime.timedelta(
+                seconds=self._scheduler.seconds_until_next(done)),
+                          MAX_LOOP_SLEEP)
+
+    def flush_held_notifications(self, updater):
+        """Sends the queued notifications, the ones held during the warmup
+        and the ones of refreshes which didn't send them before stopping.
+        """
+        jobs = self._jobs.lease(NOTIFY_JOB, self._clock(),
+                                FLUSH_BATCH_SIZE)
+        while jobs:
+            logger.info("Sending %d held notifications", len(jobs))
+            for job in jobs:
+                self._notify(updater, job)
+            jobs = self._jobs.lease(NOTIFY_JOB, self._clock(),
+                                    FLUSH_BATCH_SIZE)
+
+    def _notify(self, updater, job: Job):
+        """Runs a notify job, it is done once the message is sent."""
+        future = self._notification(updater, job.payload['chat_id'],
+                                    job.payload['message'])
+        future.add_done_callback(partial(self._notified, job))
+
+    def _notified(self, job: Job, future):
+        error = future.exception()
+        # Unauthorized ones were unsubscribed.
+        if error is None or isinstance(error, telegram.error.Unauthorized):
+            self._jobs.complete(job)
+            return
+        logger.warning('USR[%s]; Notification failed: %s',
+                       job.payload['telegram_id'], error)
+        self._jobs.fail(job, self._clock(), repr(error))
 
     def loop(self, updater):
-        """Background loop to check for updates."""
+        """Background loop to check for updates.
+
+        Sleeps until there is something to do: refreshes within the window,
+        warmups before it opens and maintenance in between.
+        """
+        last_stats_log = self._clock()
+        last_maintenance = None
 
         while self._running:
+            now = self._clock()
+            opening, _ = self._window.next_window(now)
+            wake_up = opening - WARMUP_LEAD
             try:
-                if utils.is_a_proper_time(datetime.datetime.utcnow()):
-                    self.step(updater)
+                if opening <= now:
+                    wake_up = self.window_step(updater, now)
+                elif wake_up <= now:
+                    wake_up = self.warmup_step(updater, now)
+                elif (last_maintenance is None or
+                      now - last_maintenance >= MAINTENANCE_PERIOD):
+                    last_maintenance = now
+                    model_interface.DbMaintenance(self._db_connection,
+                                                  clock=self._clock).run()
+                    self._jobs.prune_dead(now - DEAD_JOB_RETENTION)
             except Exception:  # pylint: disable=broad-except
                 logger.exception("step failed")
-            # Between 5 and 25 minutes
-            time.sleep(random.randint(5 * 60, 25 * 60))
-        updater.stop()
+            if now - last_stats_log >= STATS_LOG_PERIOD:
+                self.log_stats()
+                last_stats_log = now
+            wake_up = min(wake_up, last_stats_log + STATS_LOG_PERIOD)
+            self._stopping.wait(max(
+                    (wake_up - self._clock()).total_seconds(),
+                    0))
+        self.shutdown(updater)
+
+    def shutdown(self, updater, deadline: float = SHUTDOWN_DEADLINE):
+        """Stops taking updates and drains the in flight work.
+
+        Refreshes queued but not started are given back to the job queue,
+        the running ones and the queued messages get until the deadline.
+        The db writes are flushed last, the refreshes still queued then are
+        cancelled and the running ones abandoned, their jobs are leased
+        again once their lease expires.
+        """
+        self._running = False
+        self._stopping.set()
+        coordinator = ShutdownCoordinator(deadline)
+        coordinator.add('updates', updater.stop)
+        coordinator.add('refreshes',
+                        partial(self._refresh_pool.shutdown, wait=True))
+        coordinator.add('revalidations',
+                        partial(self._revalidator.shutdown, wait=True))
+        coordinator.add('outbox', self._outbox.stop)
+        coordinator.add('db', self._close_db)
+        unfinished = coordinator.run()
+        if unfinished:
+            logger.error('Stopped without draining: %s',
+                         ', '.join(unfinished))
+        else:
+            logger.info('Stopped')
+
+    def _close_db(self):
+        """Flushes the db writes, abandoning the refreshes not drained."""
+        cancelled = self._refresh_pool.cancel_pending()
+        running = self._refresh_pool.stats()['pending']
+        if cancelled or running:
+            logger.warning('Abandoning %d queued and %d running refreshes',
+                           cancelled, running)
+        self._db_connection.close()
 
 
 def main():
     """Entry point."""
 
-    bot = ValeVistaBot(DbConnection())
+    db_connection = DbConnection(config=model_interface.DbConfig.from_env())
+    cache = cache_backends.build_cache(
+            CACHE_BACKEND, db_connection, CACHE_DBM_PATH,
+            history=model_interface.ResultHistory(db_connection))
+    bot = ValeVistaBot(db_connection, cache=cache)
 
     stop_signals = (SIGINT, SIGTERM, SIGABRT)
     for sig in stop_signals:
@@ -0,0 +1,247 @@
+"""Streaming bulk export and import of the bot tables.
+
+Moves users, subscriptions and cached results between databases through
+JSONL or CSV files, in constant memory and with batched inserts.
+
+Usage:
+    python -m src.bulk export users users.jsonl
+    python -m src.bulk import users users.jsonl [--batch-size 5000]
+
+The database is taken from the DB_URL environment variable (see
+model_interface.DbConfig) or --db-url.
+
+Imports write straight to the database, a running bot doesn't see them in
+its caches: restart it after importing.
+"""
+import argparse
+import csv
+import datetime
+import json
+import logging
+import sys
+from typing import Dict, Iterator, Optional, TextIO, Tuple
+
+from sqlalchemy import select
+
+from src import models
+from src.model_interface import DbConfig, DbConnection
+from src.utils import Rut
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+TABLES = {
+        'users': models.User.__table__,
+        'subscribed_users': models.SubscribedUsers.__table__,
+        'cached_results': models.CachedResult.__table__,
+}
+
+FORMATS = ('jsonl', 'csv')
+
+ON_CONFLICT = ('abort', 'ignore', 'replace')
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Rows read from the db per fetch while exporting.
+_EXPORT_FETCH_SIZE = 1000
+
+
+class InvalidRowError(Exception):
+    """A row to import is not valid."""
+
+
+def _format_from_path(path: str) -> str:
+    for fmt in FORMATS:
+        if path.endswith('.' + fmt):
+            return fmt
+    raise ValueError('Unable to infer the format of %s' % path)
+
+
+def _export_value(column: str, value):
+    if value is None:
+        return None
+    if column == 'rut':
+        return str(Rut.build_rut_sin_digito(str(value)))
+    if isinstance(value, datetime.datetime):
+        return value.strftime(_TIME_FORMAT)
+    return value
+
+
+def _import_rut(value: str) -> str:
+    """Validates a rut, returns it without digito verificador.
+
+    It must be accepted by Rut.build_rut, with the right digito verificador
+    if it has one.
+    """
+    full_rut = value
+    if '-' not in value:
+        try:
+            full_rut = str(Rut.build_rut_sin_digito(value))
+        except ValueError:
+            raise InvalidRowError('Invalid rut: %s' % value)
+    rut = Rut.build_rut(full_rut)
+    if rut is None:
+        raise InvalidRowError('Invalid rut: %s' % value)
+    return str(rut.rut_sin_digito)
+
+
+def _import_row(table, row: Dict) -> Dict:
+    """Converts a row read from a file to column values."""
+    values = {}
+    for column in table.columns:
+        value = row.get(column.name)
+        if value is None or value == '':
+            values[column.name] = None
+        elif column.name == 'rut':
+            values[column.name] = _import_rut(str(value))
+        elif isinstance(column.type, models.DateTime):
+            try:
+                values[column.name] = datetime.datetime.strptime(
+                        value, _TIME_FORMAT)
+            except ValueError:
+                raise InvalidRowError('Invalid %s: %s' % (column.name, value))
+        elif isinstance(column.type, models.Integer):
+            try:
+                values[column.name] = int(value)
+            except ValueError:
+                raise InvalidRowError('Invalid %s: %s' % (column.name, value))
+        else:
+            values[column.name] = str(value)
+    return values
+
+
+def _read_records(in_file: TextIO, fmt: str) -> Iterator:
+    """Records of 'in_file', one per row, to be parsed by _parse_record."""
+    if fmt == 'csv':
+        return iter(csv.DictReader(in_file))
+    return (line for line in in_file if line.strip())
+
+
+def _parse_record(record, fmt: str) -> Dict:
+    """Row read from a file, before converting it to column values."""
+    if fmt == 'csv':
+        return record
+    try:
+        row = json.loads(record)
+    except json.JSONDecodeError as error:
+        raise InvalidRowError('Invalid JSON: %s' % error)
+    if not isinstance(row, dict):
+        raise InvalidRowError('Not a JSON object: %s' % record.strip())
+    return row
+
+
+def export_table(db_connection: DbConnection, table_name: str,
+                 out_file: TextIO, fmt: str) -> int:
+    """Writes every row of 'table_name' to 'out_file'.
+
+    Returns:
+        int: Number of exported rows.
+    """
+    table = TABLES[table_name]
+    columns = [column.name for column in table.columns]
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(out_file, fieldnames=columns)
+        writer.writeheader()
+    exported = 0
+    with db_connection.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+                select([table]).order_by(table.c.id))
+        while True:
+            rows = result.fetchmany(_EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                values = {column: _export_value(column, row[column])
+                          for column in columns}
+                if writer is not None:
+                    writer.writerow(values)
+                else:
+                    out_file.write(json.dumps(values) + '\n')
+            exported += len(rows)
+    return exported
+
+
+def import_table(db_connection: DbConnection, table_name: str,
+                 in_file: TextIO, fmt: str, batch_size: int = 5000,
+                 on_conflict: str = 'abort') -> Tuple[int, int]:
+    """Inserts the rows of 'in_file' into 'table_name'.
+
+    Each batch of 'batch_size' rows is inserted in a single transaction,
+    invalid rows are logged and skipped. The caches of 'db_connection' are
+    not updated, nor the ones of a running bot.
+
+    Returns:
+        (imported, rejected): number of inserted and skipped rows.
+    """
+    table = TABLES[table_name]
+    insert = table.insert()
+    if on_conflict != 'abort':
+        insert = insert.prefix_with('OR %s' % on_conflict.upper())
+    imported = 0
+    rejected = 0
+    batch = []
+
+    def flush(connection):
+        with connection.begin():
+            connection.execute(insert, batch)
+        batch.clear()
+
+    with db_connection.engine.connect() as connection:
+        for line_number, record in enumerate(_read_records(in_file, fmt),
+                                             1):
+            try:
+                batch.append(_import_row(table, _parse_record(record, fmt)))
+            except InvalidRowError as error:
+                logger.warning('Row %d rejected: %s', line_number, error)
+                rejected += 1
+                continue
+            if len(batch) >= batch_size:
+                imported += len(batch)
+                flush(connection)
+        if batch:
+            imported += len(batch)
+            flush(connection)
+    return imported, rejected
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+            description='Bulk export/import of the bot tables.')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('file', help='Path to the JSONL or CSV file.')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='Defaults to the file extension.')
+    parser.add_argument('--db-url', help='Defaults to DB_URL.')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Rows inserted per transaction.')
+    parser.add_argument('--on-conflict', choices=ON_CONFLICT,
+                        default='abort')
+    args = parser.parse_args(argv)
+
+    config = DbConfig.from_env()
+    if args.db_url:
+        config = config._replace(url=args.db_url)
+    fmt = args.format or _format_from_path(args.file)
+    db_connection = DbConnection(config=config)
+    try:
+        if args.command == 'export':
+            with open(args.file, 'w', newline='') as out_file:
+                exported = export_table(db_connection, args.table, out_file,
+                                        fmt)
+            print('Exported %d rows' % exported)
+            return 0
+        with open(args.file, newline='') as in_file:
+            imported, rejected = import_table(
+                    db_connection, args.table, in_file, fmt,
+                    args.batch_size, args.on_conflict)
+        print('Imported %d rows, rejected %d' % (imported, rejected))
+        return 1 if rejected else 0
+    finally:
+        db_connection.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
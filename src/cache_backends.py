@@ -0,0 +1,158 @@
+"""Cache backends not backed by the main database.
+
+model_interface.Cache stores the results in the sqlite database, this module
+adds an in-memory backend and a dbm file backend which can be shared between
+processes. They are meant for deployments where the interactive cache should
+not touch the main database.
+
+The refreshes are scheduled by the time the results were stored in the
+cache in use, see CacheBackend.with_retrieved, so they work the same with
+any backend.
+"""
+import datetime
+import dbm
+import fcntl
+import json
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from src.model_interface import (CacheBackend, DbConnection,
+                                 DEFAULT_EXP_TIME, ResultHistory)
+from src import model_interface
+from src.utils import Rut
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+class MemoryCache(CacheBackend):
+    """Keeps the results in a dict, lost when the process exits."""
+
+    def __init__(self, exp_time: datetime.timedelta = DEFAULT_EXP_TIME,
+                 history: Optional[ResultHistory] = None,
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        super(MemoryCache, self).__init__(exp_time, history, clock)
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[int, int],
+                            Tuple[str, datetime.datetime]] = {}
+
+    def _load(self, user_id, rut):
+        with self._lock:
+            return self._entries.get((user_id, rut.rut_sin_digito))
+
+    def _store(self, user_id, rut, result):
+        key = (user_id, rut.rut_sin_digito)
+        with self._lock:
+            previous = self._entries.get(key)
+            self._entries[key] = (result, self._clock())
+        return previous is None or previous[0] != result
+
+    def invalidate(self, user_id, rut):
+        with self._lock:
+            self._entries.pop((user_id, rut.rut_sin_digito), None)
+
+
+class DbmCache(CacheBackend):
+    """Keeps the results in a dbm file.
+
+    The file is opened on every operation while holding a lock on a
+    sibling '.lock' file, so several processes can share it.
+    """
+    _TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, path: str,
+                 exp_time: datetime.timedelta = DEFAULT_EXP_TIME,
+                 history: Optional[ResultHistory] = None,
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        super(DbmCache, self).__init__(exp_time, history, clock)
+        self._path = path
+        self._lock_path = path + '.lock'
+        # Creates the file if it does not exist.
+        with self._locked(), dbm.open(self._path, 'c'):
+            pass
+
+    def _locked(self):
+        return _FileLock(self._lock_path)
+
+    @staticmethod
+    def _key(user_id: int, rut: Rut) -> str:
+        return '%d:%d' % (user_id, rut.rut_sin_digito)
+
+    @classmethod
+    def _decode(cls, value: bytes) -> Tuple[str, datetime.datetime]:
+        entry = json.loads(value.decode('utf-8'))
+        return entry['result'], datetime.datetime.strptime(
+                entry['retrieved'], cls._TIME_FORMAT)
+
+    @classmethod
+    def _encode(cls, result: str, retrieved: datetime.datetime) -> bytes:
+        return json.dumps({
+                'result': result,
+                'retrieved': retrieved.strftime(cls._TIME_FORMAT),
+        }).encode('utf-8')
+
+    def _load(self, user_id, rut):
+        with self._locked(), dbm.open(self._path, 'r') as db:
+            value = db.get(self._key(user_id, rut))
+        if value is None:
+            return None
+        return self._decode(value)
+
+    def _store(self, user_id, rut, result):
+        key = self._key(user_id, rut)
+        with self._locked(), dbm.open(self._path, 'w') as db:
+            previous = db.get(key)
+            db[key] = self._encode(result, self._clock())
+        return previous is None or self._decode(previous)[0] != result
+
+    def invalidate(self, user_id, rut):
+        with self._locked(), dbm.open(self._path, 'w') as db:
+            key = self._key(user_id, rut)
+            if key in db:
+                del db[key]
+
+
+class _FileLock():
+    """Exclusive flock on 'path' while in the context."""
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *unused_exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()  # type: ignore
+        self._file = None
+
+
+BACKENDS = ('sqlite', 'memory', 'dbm')
+
+
+# pylint: disable=too-many-arguments
+def build_cache(backend: str, db_connection: DbConnection,
+                dbm_path: Optional[str] = None,
+                exp_time: datetime.timedelta = DEFAULT_EXP_TIME,
+                history: Optional[ResultHistory] = None,
+                clock: Callable[[], datetime.datetime] = (
+                        datetime.datetime.utcnow)) -> CacheBackend:
+    """Builds the cache backend named 'backend', one of BACKENDS.
+
+    The changes of the results are recorded in 'history', if set, whatever
+    the backend.
+    """
+    if backend == 'sqlite':
+        return model_interface.Cache(db_connection, exp_time, history, clock)
+    if backend == 'memory':
+        return MemoryCache(exp_time, history, clock)
+    if backend == 'dbm':
+        if not dbm_path:
+            raise ValueError('dbm cache backend requires a path')
+        return DbmCache(dbm_path, exp_time, history, clock)
+    raise ValueError('Unknown cache backend: %s' % backend)
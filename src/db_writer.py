@@ -0,0 +1,117 @@
+"""Single writer thread for the database.
+
+SQLite allows a single writer at a time, writes coming from several threads
+wait on each other's locks and eventually fail with 'database is locked'.
+DbWriter runs every write in one thread instead: jobs are queued, and the
+ones queued while a transaction runs are committed together in the next one.
+"""
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+from typing import Any, Callable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+# A write: receives the writer's session, its return value is the result of
+# the future. It must not commit.
+WriteJob = Callable[[Session], Any]
+
+
+class DbWriter():
+    """Runs write jobs in a dedicated thread, batching them in transactions.
+
+    A job failing doesn't fail the other jobs of its batch: the batch is
+    rolled back and its jobs run again, each in its own transaction.
+    """
+    _STOP = None
+
+    def __init__(self, engine, max_batch: int = 100) -> None:
+        """
+        :param engine: engine to write to, the writer keeps a connection.
+        :param max_batch: maximum number of jobs per transaction.
+        """
+        self._engine = engine
+        self._max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._stopped = False
+        self._stop_lock = threading.Lock()
+        # Set once the thread has its connection, so its files exist when
+        # the constructor returns.
+        self._connected = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='db-writer',
+                                        daemon=True)
+        self._thread.start()
+        self._connected.wait()
+
+    def submit(self, job: WriteJob) -> Future:
+        """Queues 'job', returns a future with its result."""
+        future: Future = Future()
+        with self._stop_lock:
+            if self._stopped:
+                raise RuntimeError('DbWriter stopped')
+            self._queue.put((job, future))
+        return future
+
+    def stop(self, timeout: float = None) -> None:
+        """Runs the queued jobs and stops the thread."""
+        with self._stop_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _next_batch(self) -> Tuple[List[Tuple[WriteJob, Future]], bool]:
+        """Blocks for the next jobs, returns them and whether to stop."""
+        item = self._queue.get()
+        batch = []
+        while item is not self._STOP:
+            batch.append(item)
+            if len(batch) >= self._max_batch:
+                return batch, False
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _run(self) -> None:
+        try:
+            connection = self._engine.connect()
+        finally:
+            self._connected.set()
+        session = Session(bind=connection)
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                if batch:
+                    self._run_batch(session, batch)
+                    session.expunge_all()
+        finally:
+            session.close()
+            connection.close()
+
+    def _run_batch(self, session: Session,
+                   batch: List[Tuple[WriteJob, Future]]) -> None:
+        results = []
+        try:
+            for job, _ in batch:
+                results.append(job(session))
+                # Constraint errors surface here, for the job causing them.
+                session.flush()
+            session.commit()
+        except Exception as exception:  # pylint: disable=broad-except
+            session.rollback()
+            if len(batch) > 1:
+                for item in batch:
+                    self._run_batch(session, [item])
+            else:
+                batch[0][1].set_exception(exception)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,183 @@
+"""Persistent queue of the background jobs, stored in the jobs table.
+
+Jobs survive restarts: a job is leased while it runs and only deleted once
+completed, if the bot dies meanwhile the lease expires and the job is
+leased again. A failed job is retried with exponential backoff, after
+'max_attempts' it is kept as a dead letter instead.
+"""
+import datetime
+import json
+import logging
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import func
+
+from src import models
+from src.model_interface import DbConnection
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+PENDING = 'pending'
+LEASED = 'leased'
+DEAD = 'dead'
+
+
+class Job(NamedTuple):
+    """A leased job."""
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    # Including the current one.
+    attempts: int
+
+
+class JobQueue():
+    """Durable queue of jobs, leased by kind in order of availability."""
+
+    def __init__(self, db_connection: DbConnection,
+                 lease: datetime.timedelta = datetime.timedelta(minutes=10),
+                 max_attempts: int = 5,
+                 retry_delay: datetime.timedelta = (
+                         datetime.timedelta(minutes=5)),
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        """
+        :param lease: how long a job may run before it is leased again.
+        :param max_attempts: a job failing this many times is dead.
+        :param retry_delay: delay after the first failure, doubled after
+                            each one.
+        :param clock: current naive utc time, new jobs are available from.
+        """
+        self._db_connection = db_connection
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._clock = clock
+
+    def put(self, kind: str, payload: Dict[str, Any],
+            key: Optional[str] = None,
+            available_at: Optional[datetime.datetime] = None) -> bool:
+        """Adds a job, available from 'available_at' (now by default).
+
+        :param key: if a job with this key exists, even a dead one, the new
+                    one is not added.
+
+        Returns:
+            bool: Whether the job was added.
+        """
+        available_at = available_at or self._clock()
+
+        def add(session):
+            if key is not None and session.query(models.Job.id).filter(
+                    models.Job.key == key).first() is not None:
+                return False
+            session.add(models.Job(
+                    kind=kind, key=key, payload=json.dumps(payload),
+                    state=PENDING, attempts=0, available_at=available_at))
+            return True
+        return self._db_connection.write(add)
+
+    def lease(self, kind: str, now: datetime.datetime,
+              limit: int = 1) -> List[Job]:
+        """Leases up to 'limit' available jobs of 'kind'.
+
+        Jobs whose lease expired are leased again, each lease counts as an
+        attempt. Every leased job must be completed or failed.
+        """
+        def lease(session):
+            rows = session.query(models.Job).filter(
+                    models.Job.kind == kind,
+                    models.Job.state.in_((PENDING, LEASED)),
+                    models.Job.available_at <= now).order_by(
+                            models.Job.available_at, models.Job.id).limit(
+                                    limit).all()
+            jobs = []
+            for row in rows:
+                if row.attempts >= self._max_attempts:
+                    # The process died running it, again.
+                    logger.warning('Job %s lease expired, dead', row.id)
+                    row.state = DEAD
+                    row.available_at = now
+                    row.last_error = 'lease expired'
+                    continue
+                row.state = LEASED
+                row.attempts += 1
+                row.available_at = now + self._lease
+                jobs.append(Job(row.id, row.kind, json.loads(row.payload),
+                                row.attempts))
+            return jobs
+        return self._db_connection.write(lease)
+
+    def complete(self, job: Job) -> None:
+        """Deletes a finished job."""
+        self._db_connection.write(
+                lambda session: session.query(models.Job).filter(
+                        models.Job.id == job.id).delete(
+                                synchronize_session=False))
+
+    def release(self, job: Job, now: datetime.datetime) -> None:
+        """Gives back a leased job which didn't run, without an attempt."""
+        self._db_connection.write(
+                lambda session: session.query(models.Job).filter(
+                        models.Job.id == job.id,
+                        models.Job.state == LEASED).update(
+                                {'state': PENDING,
+                                 'attempts': models.Job.attempts - 1,
+                                 'available_at': now},
+                                synchronize_session=False))
+
+    def fail(self, job: Job, now: datetime.datetime, error: str) -> None:
+        """Schedules a retry of a failed job, or makes it dead."""
+        def fail(session):
+            row = session.query(models.Job).get(job.id)
+            if row is None:
+                return
+            row.last_error = error
+            if row.attempts >= self._max_attempts:
+                logger.warning('Job %s failed %d times, dead: %s', row.id,
+                               row.attempts, error)
+                row.state = DEAD
+                row.available_at = now
+                return
+            row.state = PENDING
+            row.available_at = now + self._retry_delay * (
+                    2 ** (row.attempts - 1))
+        self._db_connection.write(fail)
+
+    def dead(self, kind: str) -> List[models.Job]:
+        """Dead letters of 'kind'."""
+        return self._db_connection.get_session().query(models.Job).filter(
+                models.Job.kind == kind, models.Job.state == DEAD).order_by(
+                        models.Job.id).all()
+
+    def retry_dead(self, job_id: int, now: datetime.datetime) -> None:
+        """Makes a dead job pending again, with its attempts reset."""
+        self._db_connection.write(
+                lambda session: session.query(models.Job).filter(
+                        models.Job.id == job_id,
+                        models.Job.state == DEAD).update(
+                                {'state': PENDING, 'attempts': 0,
+                                 'available_at': now},
+                                synchronize_session=False))
+
+    def prune_dead(self, before: datetime.datetime) -> int:
+        """Deletes the jobs dead since before 'before', so their keys can be
+        used again.
+
+        Returns:
+            int: Number of deleted jobs.
+        """
+        return self._db_connection.write(
+                lambda session: session.query(models.Job).filter(
+                        models.Job.state == DEAD,
+                        models.Job.available_at < before).delete(
+                                synchronize_session=False))
+
+    def stats(self) -> Dict[str, int]:
+        """Number of jobs by state."""
+        counts = {PENDING: 0, LEASED: 0, DEAD: 0}
+        counts.update(self._db_connection.get_session().query(
+                models.Job.state, func.count(models.Job.id)).group_by(
+                        models.Job.state).all())
+        return counts
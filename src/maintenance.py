@@ -0,0 +1,39 @@
+"""Offline maintenance of the bot database, run with the bot stopped.
+
+Usage:
+    python -m src.maintenance vacuum [--db-url URL]
+
+'vacuum' rebuilds the db file, enabling incremental vacuum on databases
+created before it was the default, so the periodic maintenance can give
+space back. It locks the db until done.
+
+The database is taken from the DB_URL environment variable (see
+model_interface.DbConfig) or --db-url.
+"""
+import argparse
+import sys
+from typing import Optional
+
+from src.model_interface import DbConfig, DbConnection, DbMaintenance
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+            description='Offline maintenance of the bot database.')
+    parser.add_argument('command', choices=('vacuum',))
+    parser.add_argument('--db-url', help='Defaults to DB_URL.')
+    args = parser.parse_args(argv)
+
+    config = DbConfig.from_env()
+    if args.db_url:
+        config = config._replace(url=args.db_url)
+    db_connection = DbConnection(config=config)
+    DbMaintenance(db_connection).vacuum()
+    print('Vacuumed, auto_vacuum=%s' % db_connection.pragma('auto_vacuum'))
+    db_connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
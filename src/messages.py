@@ -48,6 +48,14 @@ class Messages():
                "periodicaménte la página del banco para avisarte tan pronto "
                "detecte cambios.")
 
+    # Appended to a stale result while the bank is queried in background.
+    STALE_RESULT = (
+            "\n\n(Resultado consultado hace %d minutos, estoy revisando la "
+            "página del banco y te aviso si hay cambios)")
+
+    # Prepended to the fresh result when it differs from the stale one.
+    STALE_RESULT_UPDATED = "Hubo cambios, el resultado actualizado es:\n\n"
+
     # ####################################### #
     # ######## User errors messages. ######## #
     # ####################################### #
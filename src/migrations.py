@@ -0,0 +1,98 @@
+"""Versioned schema migrations, applied when connecting to the database.
+
+The version of the schema is stored in sqlite's PRAGMA user_version, on
+startup every migration newer than it is applied in order. Migrations must
+be idempotent: the version is bumped after each one runs, if the process
+dies in between the migration runs again on the next start.
+"""
+import logging
+from typing import Callable, List, Tuple
+
+from sqlalchemy.engine import Connection, Engine
+
+from . import models
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+def _baseline(connection: Connection) -> None:
+    """Tables of the original schema, existing databases already have them.
+    """
+    models.Base.metadata.create_all(
+            connection, tables=[models.User.__table__,
+                                models.CachedResult.__table__,
+                                models.SubscribedUsers.__table__])
+
+
+def _cached_results_indexes(connection: Connection) -> None:
+    """Indexes for the cache lookups and the stale subscribers query."""
+    connection.execute(
+            'CREATE INDEX IF NOT EXISTS ix_cached_results_user_id_rut '
+            'ON cached_results (user_id, rut)')
+    connection.execute(
+            'CREATE INDEX IF NOT EXISTS ix_cached_results_retrieved '
+            'ON cached_results (retrieved)')
+
+
+def _incremental_auto_vacuum(connection: Connection) -> None:
+    """Checks for incremental vacuum on databases created without it.
+
+    New databases get it from DbConfig.pragmas. Changing it on an existing
+    one requires a full VACUUM, which rewrites the whole file while locking
+    it, so it is not run here but offline, see src.maintenance.
+    """
+    if connection.execute('PRAGMA auto_vacuum').scalar() == 2:
+        return
+    logger.warning('Incremental auto_vacuum not enabled, space is not '
+                   'reclaimed until "python -m src.maintenance vacuum" is '
+                   'run with the bot stopped')
+
+
+def _result_history(connection: Connection) -> None:
+    """Table (and its index) with the history of the results."""
+    models.Base.metadata.create_all(
+            connection, tables=[models.ResultHistory.__table__])
+
+
+def _jobs(connection: Connection) -> None:
+    """Table (and its indexes) of the persistent job queue."""
+    models.Base.metadata.create_all(
+            connection, tables=[models.Job.__table__])
+
+
+# (version, description, migration), in order.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+        (1, 'baseline schema', _baseline),
+        (2, 'cached_results indexes', _cached_results_indexes),
+        (3, 'incremental auto_vacuum', _incremental_auto_vacuum),
+        (4, 'result_history table', _result_history),
+        (5, 'jobs table', _jobs),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(connection: Connection) -> int:
+    """Version of the schema of the database."""
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def migrate(engine: Engine) -> int:
+    """Applies the pending migrations.
+
+    Returns:
+        int: The number of applied migrations.
+    """
+    applied = 0
+    with engine.connect() as connection:
+        version = schema_version(connection)
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info('Applying migration %d: %s', migration_version,
+                        description)
+            migration(connection)
+            connection.execute('PRAGMA user_version = %d' % migration_version)
+            applied += 1
+    return applied
@@ -1,17 +1,35 @@
 """Interface to talk with the db models."""
+from collections import OrderedDict
+from concurrent.futures import Future
+import contextlib
 import datetime
+import json
 import logging
+import os
+import threading
+import time
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional,
+                    Tuple)
 
-from sqlalchemy import create_engine
+from sqlalchemy import and_, bindparam, create_engine, event, func, or_
+from sqlalchemy.ext import baked
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
 
+from src.db_writer import DbWriter, WriteJob
 from src.messages import Messages
+from src.profiling import QueryProfiler
 from src.utils import Rut
+from . import migrations
 from . import models
 
 
 logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
 
+# Caches the compiled SQL of the queries in the hot paths, built with
+# _BAKERY(lambda session: ...) and bound parameters.
+_BAKERY = baked.bakery()
+
 
 class ValeVistaBotException(Exception):
     """Base exception, carries a public message for the user."""
@@ -28,16 +46,121 @@ class UserDoesNotExistError(ValeVistaBotException):
     """User not found in the DB."""
 
 
+class DbConfig(NamedTuple):
+    """Settings of the sqlite engine, applied to every new connection.
+
+    The defaults are meant for production: in WAL mode readers are not
+    blocked by the writer, and with synchronous=NORMAL commits don't fsync
+    (a power loss may lose the last commits, but never corrupts the db).
+    """
+    url: str = 'sqlite:///db.sqlite'
+    # One of DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF.
+    journal_mode: str = 'WAL'
+    # One of OFF, NORMAL, FULL or EXTRA.
+    synchronous: str = 'NORMAL'
+    # Bytes of the db file accessed through mmap, 0 disables it.
+    mmap_size: int = 64 * 1024 * 1024
+    # Page cache size, in KiB if negative, in pages otherwise.
+    cache_size: int = -16 * 1024
+    # Milliseconds to wait for a lock before failing with 'database is
+    # locked'.
+    busy_timeout: int = 5000
+    # Queries taking longer than this are logged.
+    slow_query_ms: int = 200
+    # Run the writes in a dedicated thread, see db_writer. The in-memory db
+    # always writes in the caller's thread.
+    single_writer: bool = True
+
+    _JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL',
+                      'OFF')
+    _SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    @classmethod
+    def from_env(cls) -> 'DbConfig':
+        """Builds a config, overriding the defaults with DB_* env vars."""
+        defaults = cls()
+        return cls(
+                url=os.getenv('DB_URL', defaults.url),
+                journal_mode=os.getenv('DB_JOURNAL_MODE',
+                                       defaults.journal_mode),
+                synchronous=os.getenv('DB_SYNCHRONOUS', defaults.synchronous),
+                mmap_size=int(os.getenv('DB_MMAP_SIZE', defaults.mmap_size)),
+                cache_size=int(os.getenv('DB_CACHE_SIZE',
+                                         defaults.cache_size)),
+                busy_timeout=int(os.getenv('DB_BUSY_TIMEOUT_MS',
+                                           defaults.busy_timeout)),
+                slow_query_ms=int(os.getenv('DB_SLOW_QUERY_MS',
+                                            defaults.slow_query_ms)),
+                single_writer=os.getenv('DB_SINGLE_WRITER', '1') != '0')
+
+    def pragmas(self) -> List[str]:
+        """PRAGMA statements to run on each new connection."""
+        journal_mode = self.journal_mode.upper()
+        synchronous = self.synchronous.upper()
+        if journal_mode not in self._JOURNAL_MODES:
+            raise ValueError('Invalid journal_mode: %s' % self.journal_mode)
+        if synchronous not in self._SYNCHRONOUS:
+            raise ValueError('Invalid synchronous: %s' % self.synchronous)
+        return [
+                # Only effective on a new database, before any table is
+                # created. Allows DbMaintenance to give space back in small
+                # steps.
+                'PRAGMA auto_vacuum = INCREMENTAL',
+                'PRAGMA journal_mode = %s' % journal_mode,
+                'PRAGMA synchronous = %s' % synchronous,
+                'PRAGMA mmap_size = %d' % int(self.mmap_size),
+                'PRAGMA cache_size = %d' % int(self.cache_size),
+                'PRAGMA busy_timeout = %d' % int(self.busy_timeout),
+        ]
+
+
 class DbConnection():
-    """Connection to the database."""
-    def __init__(self, in_memory: bool = False) -> None:
+    """Connection to the database.
+
+    Reads go through the session of each thread, writes are jobs submitted
+    to submit_write or write, run by a DbWriter thread.
+    """
+    def __init__(self, in_memory: bool = False,
+                 config: Optional[DbConfig] = None) -> None:
+        if config is None:
+            config = DbConfig()
         if in_memory:
-            engine = create_engine('sqlite:///:memory:')
+            # A single connection shared by all the threads, otherwise each
+            # thread would see its own empty database.
+            engine = create_engine(
+                    'sqlite:///:memory:', poolclass=StaticPool,
+                    connect_args={'check_same_thread': False})
         else:
-            engine = create_engine('sqlite:///db.sqlite')
+            engine = create_engine(config.url)
+        self._pragmas = config.pragmas()
+        event.listen(engine, 'connect', self._on_connect)
 
-        models.Base.metadata.create_all(engine)
+        migrations.migrate(engine)
+        self.profiler = QueryProfiler(config.slow_query_ms / 1000)
+        self.profiler.attach(engine)
+        self._engine = engine
         self._session = scoped_session(sessionmaker(bind=engine))
+        self.identity_cache = IdentityCache()
+        # Unit of work state of each thread.
+        self._local = threading.local()
+        # A single connection is shared with the in-memory db, a writer
+        # would be just another user of it.
+        self._writer: Optional[DbWriter] = None
+        if config.single_writer and not in_memory:
+            self._writer = DbWriter(engine)
+
+    def close(self) -> None:
+        """Waits for the pending writes and stops the writer thread."""
+        if self._writer is not None:
+            self._writer.stop()
+
+    def _on_connect(self, dbapi_connection, unused_connection_record):
+        for pragma in self._pragmas:
+            dbapi_connection.execute(pragma)
+
+    def pragma(self, name: str):
+        """Current value of the PRAGMA 'name' for this connection."""
+        return self.get_session().execute('PRAGMA %s' % name).scalar()
 
     @staticmethod
     def commit_rollback(session):
@@ -53,23 +176,286 @@ class DbConnection():
         """Returns a new SQLAlchemy session."""
         return self._session()
 
+    @property
+    def engine(self):
+        """The SQLAlchemy engine, for Core level bulk operations."""
+        return self._engine
+
+    def _in_unit_of_work(self) -> bool:
+        return getattr(self._local, 'depth', 0) > 0
+
+    def commit(self, session) -> None:
+        """Commits 'session', or only flushes it inside a unit_of_work.
+
+        Flushing still surfaces constraint errors where they happen, the
+        unit of work commits everything once at its end.
+        """
+        if self._in_unit_of_work():
+            session.flush()
+        else:
+            self.commit_rollback(session)
+
+    def submit_write(self, job: WriteJob) -> Future:
+        """Runs the write 'job', which receives the session to write with.
+
+        With the writer thread, 'job' is queued and committed along with the
+        jobs queued meanwhile. Otherwise it runs now with the caller's
+        session and is committed as in commit().
+
+        Returns:
+            Future: With the value returned by 'job'.
+        """
+        if self._writer is not None:
+            def flushed_job(session):
+                result = job(session)
+                session.flush()
+                return result
+            # The writer thread records the queries, flush included, in the
+            # profiler scope of the caller.
+            return self._writer.submit(
+                    self.profiler.in_current_scope(flushed_job))
+        future: Future = Future()
+        session = self.get_session()
+        try:
+            result = job(session)
+            self.commit(session)
+        except Exception as exception:  # pylint: disable=broad-except
+            if not self._in_unit_of_work():
+                session.rollback()
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+        return future
+
+    def write(self, job: WriteJob):
+        """Like submit_write, but waits for 'job' and returns its result."""
+        try:
+            return self.submit_write(job).result()
+        finally:
+            if self._writer is not None:
+                # Objects read before the write may have changed.
+                self.get_session().expire_all()
+
+    def invalidate_identity(self, telegram_id: int) -> None:
+        """Drops 'telegram_id' from the identity cache.
+
+        Inside a unit of work it is dropped again after the commit, another
+        thread may have cached the old committed values in between.
+        """
+        self.identity_cache.invalidate(telegram_id)
+        if self._in_unit_of_work():
+            self._local.invalidated.add(telegram_id)
+
+    def cache_identity(self, telegram_id: int, identity: 'UserIdentity',
+                       generation: Tuple[int, int]) -> None:
+        """Puts 'identity' in the identity cache, see IdentityCache.put.
+
+        Inside a unit of work it is dropped if the unit rolls back, it may
+        have been read from uncommitted rows.
+        """
+        self.identity_cache.put(telegram_id, identity, generation)
+        if self._in_unit_of_work():
+            self._local.cached.add(telegram_id)
+
+    def after_commit(self, callback: Callable[[], Any]) -> None:
+        """Calls 'callback' once the current unit of work commits, or now
+        outside of one.
+
+        For the network I/O of the unit of work (eg replies), so it doesn't
+        run with the transaction open. Dropped if the unit rolls back.
+        """
+        if self._in_unit_of_work():
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+
+    @contextlib.contextmanager
+    def unit_of_work(self, scope: str = 'update'):
+        """Scopes the db work of a whole update.
+
+        Removes the thread's session at the end, so its identity map doesn't
+        grow across updates. Without the writer thread the writes also run
+        in a single transaction, committed at the end or rolled back on
+        exception. With it each write is committed by the writer, a unit
+        failing after a write doesn't roll it back. Nested units of work
+        join the outermost one. The
+        callbacks registered with after_commit run after the outermost one
+        commits, out of the unit of work.
+
+        :param scope: name the queries are aggregated under by the profiler.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._local.invalidated = set()
+            self._local.cached = set()
+            self._local.after_commit = []
+        self._local.depth = depth + 1
+        callbacks = []
+        with self.profiler.scope(scope):
+            try:
+                yield self.get_session()
+                if depth == 0:
+                    self.commit_rollback(self.get_session())
+                    callbacks = self._local.after_commit
+            except Exception:
+                if depth == 0:
+                    self.get_session().rollback()
+                    # The identities cached during the unit of work may not
+                    # exist anymore.
+                    self._local.invalidated.update(self._local.cached)
+                raise
+            finally:
+                self._local.depth = depth
+                if depth == 0:
+                    for telegram_id in self._local.invalidated:
+                        self.identity_cache.invalidate(telegram_id)
+                    self._session.remove()
+        for callback in callbacks:
+            callback()
+
+
+class Subscriber(NamedTuple):
+    """A subscribed user, as needed to refresh its results."""
+    user_id: int
+    telegram_id: int
+    # Without digito verificador.
+    rut: str
+    chat_id: str
+    # Last time its results were retrieved (utc), None if never.
+    retrieved: Optional[datetime.datetime] = None
+
+
+class UserIdentity(NamedTuple):
+    """What most updates need to know about the user sending them."""
+    id: int
+    # Without digito verificador, None if not set.
+    rut: Optional[str]
+    # Chat of the subscription, None if not subscribed.
+    chat_id: Optional[str]
+
+
+class IdentityCache():
+    """Bounded, thread safe, LRU map of telegram_id -> UserIdentity.
+
+    Shared by all the User instances of a DbConnection. User invalidates the
+    entries when it modifies the user. Each invalidation bumps the
+    generation of the telegram id, an identity loaded before it is not
+    cached, see put.
+    """
+    def __init__(self, max_size: int = 10000) -> None:
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: Dict[int, UserIdentity] = OrderedDict()
+        # Of the recently invalidated telegram ids.
+        self._generations: Dict[int, int] = OrderedDict()
+        # Bumped when the generations are forgotten.
+        self._epoch = 0
+
+    def get(self, telegram_id: int) -> Optional[UserIdentity]:
+        """The cached identity of 'telegram_id', if any."""
+        with self._lock:
+            identity = self._entries.get(telegram_id)
+            if identity is not None:
+                self._entries.move_to_end(telegram_id)  # type: ignore
+            return identity
+
+    def generation(self, telegram_id: int) -> Tuple[int, int]:
+        """To be taken before loading the identity, and given to put."""
+        with self._lock:
+            return self._epoch, self._generations.get(telegram_id, 0)
+
+    def put(self, telegram_id: int, identity: UserIdentity,
+            generation: Tuple[int, int]) -> None:
+        """Caches 'identity', evicting the least recently used if full.
+
+        Nothing is cached if 'telegram_id' was invalidated since
+        'generation' was taken, 'identity' could predate the change.
+        """
+        with self._lock:
+            if generation != (self._epoch,
+                              self._generations.get(telegram_id, 0)):
+                return
+            self._entries[telegram_id] = identity
+            self._entries.move_to_end(telegram_id)  # type: ignore
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)  # type: ignore
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Forgets 'telegram_id'."""
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+            self._generations[telegram_id] = self._generations.get(
+                    telegram_id, 0) + 1
+            self._generations.move_to_end(telegram_id)  # type: ignore
+            if len(self._generations) > self._max_size:
+                # Forgetting any generation would let a stale identity in.
+                self._forget_generations()
+
+    def _forget_generations(self) -> None:
+        self._generations.clear()
+        self._epoch += 1
+
+    def clear(self) -> None:
+        """Forgets everything."""
+        with self._lock:
+            self._entries.clear()
+            self._forget_generations()
+
 
 class User():
-    """Interface to the User table in the database."""
+    """Interface to the User table in the database.
+
+    Lookups by telegram id are cached in the instance, usually living for a
+    single update, and in the DbConnection's IdentityCache.
+    """
     def __init__(self, db_connection: DbConnection) -> None:
         self._db_connection = db_connection
+        self._identities: Dict[int, UserIdentity] = {}
+
+    def _get_identity(self, telegram_id: int,
+                      create: bool = True) -> UserIdentity:
+        identity = self._identities.get(telegram_id)
+        if identity is not None:
+            return identity
+        identity_cache = self._db_connection.identity_cache
+        identity = identity_cache.get(telegram_id)
+        if identity is None:
+            generation = identity_cache.generation(telegram_id)
+            identity = self._load_identity(telegram_id, create)
+            self._db_connection.cache_identity(telegram_id, identity,
+                                               generation)
+        self._identities[telegram_id] = identity
+        return identity
 
-    def _get_user(self, telegram_id: int, create: bool = True):
+    def _load_identity(self, telegram_id: int, create: bool) -> UserIdentity:
         session = self._db_connection.get_session()
-        user = session.query(
-                models.User).filter_by(telegram_id=telegram_id).first()
-        if not user:
-            if not create:
-                raise UserDoesNotExistError('User not found.')
+        query = _BAKERY(lambda session: session.query(
+                models.User.id, models.User.rut,
+                models.SubscribedUsers.chat_id))
+        query += lambda query: query.outerjoin(
+                models.SubscribedUsers,
+                models.SubscribedUsers.user_id == models.User.id)
+        query += lambda query: query.filter(
+                models.User.telegram_id == bindparam('telegram_id'))
+        row = query(session).params(telegram_id=telegram_id).first()
+        if row:
+            return UserIdentity(*row)
+        if not create:
+            raise UserDoesNotExistError('User not found.')
+
+        def create_user(session):
             user = models.User(telegram_id=telegram_id)
             session.add(user)
-            session.commit()
-        return user
+            session.flush()
+            # Read before committing, the commit expires 'user' and reading
+            # it afterwards would query it again.
+            return user.id
+        return UserIdentity(self._db_connection.write(create_user), None,
+                            None)
+
+    def _invalidate(self, telegram_id: int) -> None:
+        self._identities.pop(telegram_id, None)
+        self._db_connection.invalidate_identity(telegram_id)
 
     def get_id(self, telegram_id: int, create: bool = True):
         """
@@ -78,39 +464,45 @@ class User():
                        creates a new user
         :return: the id of the user.
         """
-        return self._get_user(telegram_id, create).id
+        return self._get_identity(telegram_id, create).id
 
     def get_telegram_id(self, user_id):
         """Gets the telegram id for the given user."""
         session = self._db_connection.get_session()
-        user = session.query(models.User).filter_by(id=user_id).first()
+        query = _BAKERY(lambda session: session.query(models.User))
+        query += lambda query: query.filter(
+                models.User.id == bindparam('user_id'))
+        user = query(session).params(user_id=user_id).first()
         if not user:
             raise UserDoesNotExistError('User not found.')
         return user.telegram_id
 
     def set_rut(self, telegram_id, rut):
         """Sets a rut for the user."""
-        session = self._db_connection.get_session()
-        user = self._get_user(telegram_id, True)
-        if user.rut == rut.rut_sin_digito:
+        identity = self._get_identity(telegram_id, True)
+        if identity.rut == str(rut.rut_sin_digito):
             return
-        user.rut = rut.rut_sin_digito
-        session.commit()
+        try:
+            self._db_connection.write(
+                    lambda session: session.query(models.User).filter_by(
+                            id=identity.id).update(
+                                    {'rut': rut.rut_sin_digito},
+                                    synchronize_session=False))
+        finally:
+            self._invalidate(telegram_id)
 
     def get_rut(self, telegram_id):
         """Gets the user rut."""
-        user = self._get_user(telegram_id, True)
-        if user.rut:
-            return Rut.build_rut_sin_digito(user.rut)
+        identity = self._get_identity(telegram_id, True)
+        if identity.rut:
+            return Rut.build_rut_sin_digito(identity.rut)
         return None
 
     def is_subscribed(self, telegram_id, chat_id):
         """Whether the user with the given chat is subscribed or not."""
-        session = self._db_connection.get_session()
-        user_id = self.get_id(telegram_id)
-        result = session.query(models.SubscribedUsers).filter_by(
-                user_id=user_id, chat_id=chat_id).all()
-        return len(result) > 0
+        subscribed_chat_id = self._get_identity(telegram_id).chat_id
+        return (subscribed_chat_id is not None and
+                subscribed_chat_id == str(chat_id))
 
     def subscribe(self, telegram_id, chat_id):
         """Subscribes the given user with the given chat."""
@@ -120,97 +512,675 @@ class User():
             raise UserBadUseError(Messages.ALREADY_SUBSCRIBED)
 
         user_id = self.get_id(telegram_id, False)
-        subscription = models.SubscribedUsers(user_id=user_id, chat_id=chat_id)
-        session = self._db_connection.get_session()
-        session.add(subscription)
-        DbConnection.commit_rollback(session)
+        try:
+            self._db_connection.write(
+                    lambda session: session.add(models.SubscribedUsers(
+                            user_id=user_id, chat_id=chat_id)))
+        finally:
+            self._invalidate(telegram_id)
 
     def unsubscribe(self, telegram_id, chat_id):
         """Unsubscribes the user with the given id and chat."""
         user_id = self.get_id(telegram_id, False)
-        session = self._db_connection.get_session()
-        result = session.query(models.SubscribedUsers). \
-            filter_by(user_id=user_id, chat_id=chat_id).all()
-        if not result:
+        try:
+            deleted = self._db_connection.write(
+                    lambda session: session.query(models.SubscribedUsers).
+                    filter_by(user_id=user_id, chat_id=chat_id).
+                    delete(synchronize_session=False))
+        finally:
+            self._invalidate(telegram_id)
+        if not deleted:
             raise UserBadUseError(Messages.UNSUBSCRIBE_NON_SUBSCRIBED)
 
-        session.delete(result[0])
-        session.commit()
+    def unsubscribe_chat(self, chat_id) -> bool:
+        """Unsubscribes the user subscribed in 'chat_id', if any.
 
-    def get_subscribers_to_update(self, hours):
+        Returns:
+            bool: Whether there was one.
+        """
+        session = self._db_connection.get_session()
+        row = session.query(models.User.telegram_id).join(
+                models.SubscribedUsers,
+                models.SubscribedUsers.user_id == models.User.id).filter(
+                        models.SubscribedUsers.chat_id == str(chat_id)).first()
+        if row is None:
+            return False
+        self.unsubscribe(row.telegram_id, str(chat_id))
+        return True
+
+    def get_subscribers_to_update(
+            self, hours, now: datetime.datetime,
+            limit: Optional[int] = None) -> List['Subscriber']:
         """Subscribed users which results have not been retrieved in 'hours'.
 
-        Returns  a list of all the subscribed users which cache has not been
-        updated in the last 'hours' hours.
+        Returns the subscribers whose cached result for their rut has not been
+        updated in the last 'hours' hours before 'now' (utc), the ones never
+        retrieved first and then the least recently retrieved. At most
+        'limit' if set.
+        """
+        t_limit = now - datetime.timedelta(hours=hours)
+        query = self._subscribers_query() \
+            .filter(or_(models.CachedResult.retrieved.is_(None),
+                        models.CachedResult.retrieved <= t_limit)) \
+            .order_by(models.CachedResult.retrieved.asc())
+        if limit is not None:
+            query = query.limit(limit)
+        return [Subscriber(*row) for row in query]
+
+    def get_subscribers(self, rut: Optional[str] = None
+                        ) -> List['Subscriber']:
+        """Every subscribed user, with the time its results were retrieved.
+
+        :param rut: if set, only the subscribers with this rut (without
+                    digito verificador).
         """
+        query = self._subscribers_query()
+        if rut is not None:
+            query = query.filter(models.User.rut == rut)
+        return [Subscriber(*row) for row in query]
+
+    def _subscribers_query(self):
+        """Subscribers joined with the cached result for their rut."""
         session = self._db_connection.get_session()
-        t_limit = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
-        already_updated_users = session.query(models.User) \
-            .filter(models.SubscribedUsers.user_id == models.User.id) \
-            .filter(models.CachedResult.user_id == models.User.id) \
-            .filter(models.CachedResult.retrieved > t_limit)
-        # All subscribed users minus the already updated
-        to_update_users = session.query(models.User) \
-            .filter(models.SubscribedUsers.user_id == models.User.id) \
-            .filter(models.User.id.notin_(
-                    already_updated_users.with_entities(models.User.id)))
-        return to_update_users.all()
+        return session.query(
+                models.User.id, models.User.telegram_id, models.User.rut,
+                models.SubscribedUsers.chat_id,
+                models.CachedResult.retrieved) \
+            .join(models.SubscribedUsers,
+                  models.SubscribedUsers.user_id == models.User.id) \
+            .outerjoin(models.CachedResult, and_(
+                    models.CachedResult.user_id == models.User.id,
+                    models.CachedResult.rut == models.User.rut))
 
     def get_chat_id(self, user_id):
         """Gets the chat id for the user with 'user_id'."""
         session = self._db_connection.get_session()
-        subscribed_user = session.query(models.SubscribedUsers). \
-            filter(models.SubscribedUsers.user_id == user_id).first()
-        if subscribed_user is None:
+        query = _BAKERY(lambda session: session.query(
+                models.SubscribedUsers.chat_id))
+        query += lambda query: query.filter(
+                models.SubscribedUsers.user_id == bindparam('user_id'))
+        row = query(session).params(user_id=user_id).first()
+        if row is None:
             raise ValueError("User isn't subscribed")
-        return subscribed_user.chat_id
+        return row.chat_id
 
 
-class Cache():
-    """Access to the cache db table."""
-    _DEFAULT_EXP_TIME = datetime.timedelta(hours=2)
+# How long a cached result is served before querying the bank again.
+DEFAULT_EXP_TIME = datetime.timedelta(hours=2)
+
+
+class CacheStats():
+    """Thread safe counters describing how effective the cache is.
+
+    Besides hits and misses, keeps a histogram of the age of the entries
+    served from the cache, which is what TTLs should be tuned against.
+    """
+    # Upper bound (in minutes) of each bucket of the age histogram, entries
+    # older than the last bound fall into an extra overflow bucket.
+    AGE_BUCKETS = (5, 15, 30, 60, 120, 12 * 60, 24 * 60)
+
+    def __init__(self, clock: Callable[[], datetime.datetime] = (
+            datetime.datetime.utcnow)) -> None:
+        """
+        :param clock: current naive utc time, the counters start from it.
+        """
+        self._lock = threading.Lock()
+        self._since = clock()
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._stale = 0
+        self._changed = 0
+        self._unchanged = 0
+        self._age_histogram = [0] * (len(self.AGE_BUCKETS) + 1)
+
+    @classmethod
+    def _bucket_labels(cls):
+        labels = ['<=%dm' % bound for bound in cls.AGE_BUCKETS]
+        labels.append('>%dm' % cls.AGE_BUCKETS[-1])
+        return labels
+
+    def record_hit(self, age: datetime.timedelta) -> None:
+        """A non expired entry of age 'age' was served."""
+        minutes = age.total_seconds() / 60
+        bucket = len(self.AGE_BUCKETS)
+        for i, bound in enumerate(self.AGE_BUCKETS):
+            if minutes <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self._hits += 1
+            self._age_histogram[bucket] += 1
+
+    def record_miss(self) -> None:
+        """There was no entry for the requested key."""
+        with self._lock:
+            self._misses += 1
+
+    def record_expired(self) -> None:
+        """There was an entry, but it was too old to be served."""
+        with self._lock:
+            self._expired += 1
+
+    def record_stale(self) -> None:
+        """An expired entry was served within its grace period."""
+        with self._lock:
+            self._stale += 1
+
+    def record_update(self, changed: bool) -> None:
+        """An entry was written, 'changed' if its result was different."""
+        with self._lock:
+            if changed:
+                self._changed += 1
+            else:
+                self._unchanged += 1
+
+    def snapshot(self) -> Dict:
+        """Returns a copy of the current counters."""
+        with self._lock:
+            lookups = (self._hits + self._misses + self._expired +
+                       self._stale)
+            return {
+                    'since': self._since,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'expired': self._expired,
+                    'stale': self._stale,
+                    'hit_ratio': self._hits / lookups if lookups else 0.0,
+                    'changed': self._changed,
+                    'unchanged': self._unchanged,
+                    'age_histogram': OrderedDict(zip(
+                            self._bucket_labels(), self._age_histogram)),
+            }
+
+    @staticmethod
+    def format(stats: Dict) -> str:
+        """One line representation of a snapshot, meant for the logs."""
+        histogram = ' '.join(
+                '%s:%d' % (label, count)
+                for label, count in stats['age_histogram'].items())
+        return ('hits=%d misses=%d expired=%d stale=%d hit_ratio=%.2f '
+                'changed=%d unchanged=%d ages=[%s]') % (
+                        stats['hits'], stats['misses'], stats['expired'],
+                        stats['stale'], stats['hit_ratio'], stats['changed'],
+                        stats['unchanged'], histogram)
+
+
+class ResultChange(NamedTuple):
+    """A change of the results of a rut, see ResultHistory."""
+    observed_at: datetime.datetime
+    added: List[str]
+    removed: List[str]
+
+
+class ResultHistory():
+    """Append-only history of the results of each rut.
+
+    A row is only written when the events of a rut change, it holds the
+    events added and removed since the previous state. The state of a rut is
+    rebuilt by replaying its rows, which are few: events change a handful of
+    times in their life. Error results are not recorded.
+    """
+    _ENTRIES_SEPARATOR = '\n\n'
 
     def __init__(self, db_connection: DbConnection,
-                 exp_time: datetime.timedelta = _DEFAULT_EXP_TIME) -> None:
-        self._exp_time = exp_time
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        """
+        :param clock: current naive utc time, the changes are observed at.
+        """
         self._db_connection = db_connection
+        self._clock = clock
 
-    def get(self, user_id, rut):
-        """If there are non expired results, return them."""
-        session = self._db_connection.get_session()
-        result = session.query(models.CachedResult).filter_by(
-                user_id=user_id, rut=rut.rut_sin_digito).all()
-        if not result or result[0].retrieved < (
-                datetime.datetime.utcnow() - self._exp_time):
+    @classmethod
+    def _entries(cls, result: str) -> Optional[List[str]]:
+        """Events in a cached result string, None for errors."""
+        if (Messages.CLIENTE_ERROR in result or
+                Messages.INTENTE_NUEVAMENTE_ERROR in result):
             return None
-        return result[0].result
+        if not result or Messages.NO_PAGOS in result:
+            return []
+        return result.split(cls._ENTRIES_SEPARATOR)
+
+    @staticmethod
+    def _encode(added, removed) -> str:
+        delta = {}
+        if added:
+            delta['a'] = sorted(added)
+        if removed:
+            delta['r'] = sorted(removed)
+        return json.dumps(delta, ensure_ascii=False, separators=(',', ':'))
+
+    def _rows(self, rut_sin_digito: str,
+              since: Optional[datetime.datetime] = None,
+              until: Optional[datetime.datetime] = None, session=None):
+        if session is None:
+            session = self._db_connection.get_session()
+        query = session.query(models.ResultHistory).filter(
+                        models.ResultHistory.rut == rut_sin_digito)
+        if since is not None:
+            query = query.filter(models.ResultHistory.observed_at >= since)
+        if until is not None:
+            query = query.filter(models.ResultHistory.observed_at <= until)
+        return query.order_by(models.ResultHistory.observed_at,
+                              models.ResultHistory.id)
+
+    @staticmethod
+    def _replay(rows) -> set:
+        state: set = set()
+        for row in rows:
+            delta = json.loads(row.delta)
+            state.difference_update(delta.get('r', ()))
+            state.update(delta.get('a', ()))
+        return state
+
+    def record(self, rut: Rut, result: str) -> bool:
+        """Records 'result' as the current result of 'rut'.
+
+        Returns:
+            bool: Whether a row was written, ie the events changed.
+        """
+        entries = self._entries(result)
+        if entries is None:
+            return False
+        rut_sin_digito = str(rut.rut_sin_digito)
+
+        # Reads the state in the write, so concurrent records of the same
+        # change are not written twice.
+        def record(session):
+            state = self._replay(self._rows(rut_sin_digito, session=session))
+            added = set(entries) - state
+            removed = state - set(entries)
+            if not added and not removed:
+                return False
+            session.add(models.ResultHistory(
+                    rut=rut_sin_digito,
+                    observed_at=self._clock(),
+                    delta=self._encode(added, removed)))
+            return True
+        return self._db_connection.write(record)
+
+    def changes(self, rut: Rut, since: Optional[datetime.datetime] = None,
+                until: Optional[datetime.datetime] = None
+                ) -> List[ResultChange]:
+        """Changes of the results of 'rut', oldest first."""
+        changes = []
+        for row in self._rows(str(rut.rut_sin_digito), since, until):
+            delta = json.loads(row.delta)
+            changes.append(ResultChange(
+                    row.observed_at, delta.get('a', []), delta.get('r', [])))
+        return changes
+
+    def events_at(self, rut: Rut,
+                  when: Optional[datetime.datetime] = None) -> List[str]:
+        """Events of 'rut' at 'when' (utc), defaults to now."""
+        return sorted(self._replay(
+                self._rows(str(rut.rut_sin_digito), until=when)))
+
+    def first_seen(self, rut: Rut,
+                   text: str) -> Optional[datetime.datetime]:
+        """When an event containing 'text' first showed up for 'rut'.
+
+        For example first_seen(rut, 'Vigente') tells when a vale vista
+        became available.
+        """
+        text = text.lower()
+        for change in self.changes(rut):
+            if any(text in event.lower() for event in change.added):
+                return change.observed_at
+        return None
+
+    def compact(self, session, rut_sin_digito: str,
+                before: datetime.datetime) -> int:
+        """Folds the rows of a rut older than 'before' into a single one.
+
+        A write job, runs with the 'session' of the write.
+
+        Returns:
+            int: Number of deleted rows.
+        """
+        rows = self._rows(rut_sin_digito, session=session).filter(
+                models.ResultHistory.observed_at < before).all()
+        if not rows:
+            return 0
+        state = self._replay(rows)
+        for row in rows:
+            session.delete(row)
+        if not state:
+            return len(rows)
+        session.add(models.ResultHistory(
+                rut=rut_sin_digito, observed_at=rows[-1].observed_at,
+                delta=self._encode(state, ())))
+        return len(rows) - 1
+
+
+class CacheBackend():
+    """Base class for the cache backends.
+
+    Keeps the last result retrieved for each (user, rut) pair. Subclasses
+    implement the storage (_load, _store and invalidate), expiration and
+    usage stats are handled here, as well as recording the changes in the
+    results history, if any.
+    """
+    def __init__(self, exp_time: datetime.timedelta = DEFAULT_EXP_TIME,
+                 history: Optional[ResultHistory] = None,
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        """
+        :param clock: current naive utc time, the results age by it.
+        """
+        self._exp_time = exp_time
+        self._stats = CacheStats(clock)
+        self._history = history
+        self._clock = clock
+
+    def _load(self, user_id: int,
+              rut: Rut) -> Optional[Tuple[str, datetime.datetime]]:
+        """Returns the stored (result, utc retrieved time), if any."""
+        raise NotImplementedError()
+
+    def _store(self, user_id: int, rut: Rut, result: str) -> bool:
+        """Stores 'result' retrieved now, returns whether it changed."""
+        raise NotImplementedError()
+
+    def invalidate(self, user_id: int, rut: Rut) -> None:
+        """Forgets the result stored for 'user_id' and 'rut'."""
+        raise NotImplementedError()
+
+    def with_retrieved(self, subscribers: List[Subscriber]
+                       ) -> List[Subscriber]:
+        """'subscribers' with 'retrieved' set to when their results were
+        stored in this cache, the refreshes are scheduled by it."""
+        updated = []
+        for subscriber in subscribers:
+            entry = self._load(subscriber.user_id,
+                               Rut.build_rut_sin_digito(subscriber.rut))
+            updated.append(subscriber._replace(
+                    retrieved=entry[1] if entry is not None else None))
+        return updated
+
+    def subscribers_to_update(self, user: User, hours: float,
+                              limit: Optional[int] = None
+                              ) -> List[Subscriber]:
+        """Same as User.get_subscribers_to_update, by the results stored in
+        this cache."""
+        t_limit = self._clock() - datetime.timedelta(hours=hours)
+        stale = [subscriber for subscriber in self.with_retrieved(
+                        user.get_subscribers())
+                 if subscriber.retrieved is None or
+                 subscriber.retrieved <= t_limit]
+        stale.sort(key=lambda subscriber: (
+                subscriber.retrieved or datetime.datetime.min))
+        return stale[:limit]
+
+    def stats(self) -> Dict:
+        """Usage counters of this cache since it was created."""
+        return self._stats.snapshot()
 
-    def update(self, user_id, rut: Rut, result):
+    def get(self, user_id: int, rut: Rut) -> Optional[str]:
+        """If there are non expired results, return them."""
+        return self.get_allow_stale(user_id, rut, datetime.timedelta(0))[0]
+
+    def get_allow_stale(
+            self, user_id: int, rut: Rut, grace: datetime.timedelta
+            ) -> Tuple[Optional[str], Optional[datetime.timedelta]]:
+        """Like get, but also returns results expired less than 'grace' ago.
+
+        Returns:
+            (result, age): age is only set if the result is stale, ie it is
+                expired but within the grace period.
+        """
+        entry = self._load(user_id, rut)
+        if entry is None:
+            self._stats.record_miss()
+            return None, None
+        result, retrieved = entry
+        age = self._clock() - retrieved
+        if age > self._exp_time + grace:
+            self._stats.record_expired()
+            return None, None
+        if age > self._exp_time:
+            self._stats.record_stale()
+            return result, age
+        self._stats.record_hit(age)
+        return result, None
+
+    def update(self, user_id: int, rut: Rut, result: str) -> bool:
         """Updates the cache with 'result'.
 
         Returns:
             bool: Whether the cache changed or not (ie result was already
                 stored).
         """
-        session = self._db_connection.get_session()
-        c_result = session.query(models.CachedResult).filter_by(
-                user_id=user_id, rut=rut.rut_sin_digito).all()
-        if not c_result:
-            c_result = models.CachedResult(
-                    rut=rut.rut_sin_digito, user_id=user_id, result=result)
-            session.add(c_result)
-            session.commit()
-            return True
-        if len(c_result) > 1:
-            logger.warning("Unexpected len of results in the db:%d",
-                           len(c_result))
-        # If the new result is the same than the previous one onupdate is not
-        # triggered and the timestamp of the cached result is not updated.
-        if c_result[0].result == result:
-            changed = False
-        else:
-            c_result[0].result = result
-            changed = True
-        c_result[0].retrieved = datetime.datetime.utcnow()
-        session.commit()
+        changed = self._store(user_id, rut, result)
+        self._stats.record_update(changed)
+        if changed and self._history is not None:
+            self._history.record(rut, result)
         return changed
+
+
+class Cache(CacheBackend):
+    """Access to the cache db table."""
+
+    def __init__(self, db_connection: DbConnection,
+                 exp_time: datetime.timedelta = DEFAULT_EXP_TIME,
+                 history: Optional[ResultHistory] = None,
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        super(Cache, self).__init__(exp_time, history, clock)
+        self._db_connection = db_connection
+
+    @staticmethod
+    def _baked_query(session, query, user_id, rut: Rut):
+        """Runs the baked 'query' filtered by 'user_id' and 'rut'."""
+        query += lambda query: query.filter(
+                models.CachedResult.user_id == bindparam('user_id'),
+                models.CachedResult.rut == bindparam('rut'))
+        return query(session).params(
+                user_id=user_id, rut=rut.rut_sin_digito).all()
+
+    def _load(self, user_id, rut):
+        query = _BAKERY(lambda session: session.query(
+                models.CachedResult.result, models.CachedResult.retrieved))
+        result = self._baked_query(self._db_connection.get_session(), query,
+                                   user_id, rut)
+        if not result:
+            return None
+        return result[0].result, result[0].retrieved
+
+    def _store(self, user_id, rut, result):
+        def store(session):
+            query = _BAKERY(
+                    lambda session: session.query(models.CachedResult))
+            c_result = self._baked_query(session, query, user_id, rut)
+            if not c_result:
+                session.add(models.CachedResult(
+                        rut=rut.rut_sin_digito, user_id=user_id,
+                        result=result, retrieved=self._clock()))
+                return True
+            if len(c_result) > 1:
+                logger.warning("Unexpected len of results in the db:%d",
+                               len(c_result))
+            # If the new result is the same than the previous one onupdate is
+            # not triggered and the timestamp of the cached result is not
+            # updated.
+            if c_result[0].result == result:
+                changed = False
+            else:
+                c_result[0].result = result
+                changed = True
+            c_result[0].retrieved = self._clock()
+            return changed
+        return self._db_connection.write(store)
+
+    def invalidate(self, user_id, rut):
+        self._db_connection.write(
+                lambda session: session.query(models.CachedResult).filter_by(
+                        user_id=user_id, rut=rut.rut_sin_digito).delete(
+                                synchronize_session=False))
+
+    def with_retrieved(self, subscribers):
+        # Read along with the subscribers, from the same table.
+        return subscribers
+
+    def subscribers_to_update(self, user, hours, limit=None):
+        return user.get_subscribers_to_update(hours, self._clock(), limit)
+
+
+class DbMaintenance():
+    """Housekeeping tasks to keep the database small.
+
+    Every step works in small batches, committing and pausing in between,
+    so the handlers are never blocked for long.
+    """
+    _DEFAULT_RETENTION = datetime.timedelta(days=7)
+    _DEFAULT_HISTORY_RETENTION = datetime.timedelta(days=365)
+    # sqlite's PRAGMA auto_vacuum value for incremental vacuum.
+    _AUTO_VACUUM_INCREMENTAL = 2
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, db_connection: DbConnection,
+                 retention: datetime.timedelta = _DEFAULT_RETENTION,
+                 batch_size: int = 500, pause: float = 0.1,
+                 history_retention: datetime.timedelta = (
+                         _DEFAULT_HISTORY_RETENTION),
+                 clock: Callable[[], datetime.datetime] = (
+                         datetime.datetime.utcnow)) -> None:
+        """
+        :param retention: cached results not tied to a subscription older
+                          than this are deleted.
+        :param history_retention: result history older than this is folded
+                                  into a single row per rut.
+        :param batch_size: rows deleted or pages vacuumed per transaction.
+        :param pause: seconds to sleep between batches.
+        :param clock: current naive utc time, the retentions count from it.
+        """
+        self._db_connection = db_connection
+        self._retention = retention
+        self._batch_size = batch_size
+        self._pause = pause
+        self._history_retention = history_retention
+        self._clock = clock
+
+    def prune_cache(self) -> int:
+        """Deletes expired cached results not tied to a subscription.
+
+        A result is tied to a subscription if its user is subscribed and
+        it is for the rut the user has set, results for any other rut come
+        from one-off queries.
+
+        Returns:
+            int: Number of deleted rows.
+        """
+        session = self._db_connection.get_session()
+        t_limit = self._clock() - self._retention
+        subscribed = session.query(models.SubscribedUsers.id) \
+            .join(models.User,
+                  models.User.id == models.SubscribedUsers.user_id) \
+            .filter(models.SubscribedUsers.user_id ==
+                    models.CachedResult.user_id) \
+            .filter(models.User.rut == models.CachedResult.rut)
+        to_delete = session.query(models.CachedResult.id) \
+            .filter(models.CachedResult.retrieved < t_limit) \
+            .filter(~subscribed.exists()) \
+            .limit(self._batch_size)
+
+        deleted = 0
+        while True:
+            ids = [row.id for row in to_delete.all()]
+            if not ids:
+                return deleted
+            self._db_connection.write(
+                    lambda session, ids=ids: session.query(
+                            models.CachedResult)
+                    .filter(models.CachedResult.id.in_(ids))
+                    .delete(synchronize_session=False))
+            deleted += len(ids)
+            time.sleep(self._pause)
+
+    def prune_history(self) -> int:
+        """Folds the result history older than the retention.
+
+        The old rows of each rut are replaced by a single one with the events
+        they add up to, so the current state can still be rebuilt.
+
+        Returns:
+            int: Number of deleted rows.
+        """
+        session = self._db_connection.get_session()
+        history = ResultHistory(self._db_connection, self._clock)
+        t_limit = self._clock() - self._history_retention
+        to_fold = session.query(models.ResultHistory.rut) \
+            .filter(models.ResultHistory.observed_at < t_limit) \
+            .group_by(models.ResultHistory.rut) \
+            .having(func.count(models.ResultHistory.id) > 1) \
+            .limit(self._batch_size)
+
+        deleted = 0
+        while True:
+            ruts = [row.rut for row in to_fold.all()]
+            if not ruts:
+                return deleted
+            deleted += self._db_connection.write(
+                    lambda session, ruts=ruts: sum(
+                            history.compact(session, rut, t_limit)
+                            for rut in ruts))
+            time.sleep(self._pause)
+
+    def incremental_vacuum(self) -> int:
+        """Gives the free pages of the db file back to the file system.
+
+        Returns:
+            int: Number of reclaimed bytes.
+        """
+        db_connection = self._db_connection
+        if db_connection.pragma('auto_vacuum') != (
+                self._AUTO_VACUUM_INCREMENTAL):
+            logger.warning('Incremental vacuum not enabled in the db, '
+                           'unable to reclaim space. See src.maintenance.')
+            return 0
+        page_size = db_connection.pragma('page_size')
+        initial_pages = db_connection.pragma('page_count')
+        while db_connection.pragma('freelist_count') > 0:
+            db_connection.write(self._incremental_vacuum_batch)
+            time.sleep(self._pause)
+        return (initial_pages - db_connection.pragma('page_count')) * page_size
+
+    def _incremental_vacuum_batch(self, session) -> None:
+        # sqlite frees a page per row stepped through. The rows have no
+        # columns, SQLAlchemy closes such results without fetching them, so
+        # they are fetched from the DBAPI cursor.
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute('PRAGMA incremental_vacuum(%d)' % self._batch_size)
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def vacuum(self) -> None:
+        """Rebuilds the db file with a full VACUUM, enabling incremental
+        vacuum if it was not.
+
+        Locks the db until done, which takes long on a large one: only to be
+        run with the bot stopped, see src.maintenance.
+        """
+        # Nothing else may be using the db.
+        self._db_connection.get_session().close()
+        with self._db_connection.engine.connect() as connection:
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('VACUUM')
+
+    def run(self) -> Dict:
+        """Prunes the cache and the history and compacts the db.
+
+        Returns:
+            dict: The number of cache 'rows' and 'history_rows' deleted and
+                'bytes' reclaimed.
+        """
+        rows = self.prune_cache()
+        history_rows = self.prune_history()
+        reclaimed_bytes = self.incremental_vacuum()
+        logger.info('Db maintenance: %d rows and %d history rows deleted, '
+                    '%d bytes reclaimed', rows, history_rows, reclaimed_bytes)
+        return {'rows': rows, 'history_rows': history_rows,
+                'bytes': reclaimed_bytes}
@@ -1,6 +1,7 @@
 """DB models used by the bot."""
 from sqlalchemy.sql import func
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, DateTime
+from sqlalchemy import Text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()  # pylint: disable=invalid-name
@@ -29,6 +30,11 @@ class CachedResult(Base):  # type: ignore
     checking if there are changes since the last time we queried the service.
     """
     __tablename__ = 'cached_results'
+    # Also created by migrations on existing databases.
+    __table_args__ = (
+            Index('ix_cached_results_user_id_rut', 'user_id', 'rut'),
+            Index('ix_cached_results_retrieved', 'retrieved'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
@@ -52,3 +58,56 @@ class SubscribedUsers(Base):  # type: ignore
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), unique=True)
     chat_id = Column(String(length=20), unique=True)
+
+
+# pylint: disable=too-few-public-methods
+class ResultHistory(Base):  # type: ignore
+    """Append-only log of the changes of the results of each rut.
+
+    Only written when a result changes, each row holds the events added and
+    removed since the previous row of the same rut as compact JSON.
+    """
+    __tablename__ = 'result_history'
+    __table_args__ = (
+            Index('ix_result_history_rut_observed_at', 'rut', 'observed_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # Rut without digito verificador.
+    rut = Column(String(length=9), nullable=False)
+    observed_at = Column(DateTime(timezone=True), nullable=False)
+    # {"a": [added events], "r": [removed events]}, empty lists omitted.
+    delta = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<ResultHistory(rut='%s', observed_at='%s', delta='%s')>" % (
+                self.rut, self.observed_at, self.delta)
+
+
+# pylint: disable=too-few-public-methods
+class Job(Base):  # type: ignore
+    """Background job, see job_queue.JobQueue."""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+            Index('ix_jobs_kind_state_available_at', 'kind', 'state',
+                  'available_at'),
+            Index('ix_jobs_key', 'key'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(length=20), nullable=False)
+    # At most one job with each key is kept, if set.
+    key = Column(String(length=50))
+    # JSON.
+    payload = Column(Text, nullable=False)
+    # pending, leased or dead.
+    state = Column(String(length=10), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # When pending it can be leased from then on, when leased the lease
+    # expires then and when dead it died then.
+    available_at = Column(DateTime(timezone=True), nullable=False)
+    last_error = Column(Text)
+
+    def __repr__(self):
+        return "<Job(id='%s', kind='%s', key='%s', state='%s')>" % (
+                self.id, self.kind, self.key, self.state)
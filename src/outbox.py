@@ -0,0 +1,251 @@
+"""Rate limited queue of the messages sent to Telegram.
+
+Telegram rejects bots sending more than about 30 messages per second overall
+or more than one per second to the same chat, answering RetryAfter. Outbox
+sends the queued messages from its own thread, paced by a global token
+bucket and one per chat, interactive replies first. On RetryAfter every
+send is paused for as long as Telegram asks.
+"""
+from concurrent.futures import Future
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import telegram
+
+from src.retry import RetryBudget, RetryPolicy
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+# Priorities, lower first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Retries of the messages failing with network errors, the budget is shared
+# by every message. Bad requests are network errors too, but not retried.
+TELEGRAM_RETRY_POLICY = RetryPolicy((telegram.error.NetworkError,),
+                                    base_delay=1, max_delay=16,
+                                    max_elapsed=60, budget=RetryBudget())
+
+
+class TokenBucket():
+    """'rate' tokens per second, holding up to 'capacity' of them."""
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = now
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (
+                now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until a token is available, 0 if it is now."""
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def take(self, now: float) -> None:
+        """Takes a token, it must be available."""
+        self._refill(now)
+        self._tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """Whether the bucket holds all its tokens, ie it is idle."""
+        self._refill(now)
+        return self._tokens >= self._capacity
+
+
+class _Message():  # pylint: disable=too-few-public-methods
+    """A queued message."""
+
+    def __init__(self, priority: int, sequence: int, chat_id,
+                 send: Callable[[], Any]) -> None:
+        self.key = (priority, sequence)
+        self.chat_id = str(chat_id)
+        self.send = send
+        self.future: Future = Future()
+        self.attempts = 0
+        self.first_attempt: Optional[float] = None
+        self.not_before = 0.0
+
+
+class Outbox():
+    """Sends messages to Telegram from a dedicated thread, rate limited."""
+
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1,
+                 on_unauthorized: Optional[Callable[[str], None]] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 retry_policy: RetryPolicy = TELEGRAM_RETRY_POLICY) -> None:
+        """
+        :param global_rate: messages per second, to every chat.
+        :param chat_rate: messages per second to each chat.
+        :param on_unauthorized: called with the chat id of the messages
+                                failing because the user blocked the bot.
+        :param clock: seconds, monotonic.
+        :param retry_policy: for the messages failing with network errors,
+                             they are queued again after its delay.
+        """
+        self._chat_rate = chat_rate
+        self._on_unauthorized = on_unauthorized
+        self._clock = clock
+        self._retry_policy = retry_policy
+        self._global = TokenBucket(global_rate, global_rate, clock())
+        self._chats: Dict[str, TokenBucket] = {}
+        self._paused_until = 0.0
+        # Sorted by priority and then by arrival.
+        self._pending: List[_Message] = []
+        self._sequence = itertools.count()
+        self._sending = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='outbox',
+                                        daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id, send: Callable[[], Any],
+             priority: int = BACKGROUND) -> Future:
+        """Queues a message to 'chat_id'.
+
+        :param send: sends the message, eg a partial of bot.sendMessage.
+
+        Returns:
+            Future: with the result of 'send', or its exception.
+        """
+        message = _Message(priority, next(self._sequence), chat_id, send)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('Outbox stopped')
+            self._insert(message)
+        return message.future
+
+    def _insert(self, message: _Message) -> None:
+        index = len(self._pending)
+        while index > 0 and self._pending[index - 1].key > message.key:
+            index -= 1
+        self._pending.insert(index, message)
+        self._condition.notify_all()
+
+    def _bucket(self, chat_id: str, now: float) -> TokenBucket:
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket(self._chat_rate, 1, now)
+        return self._chats[chat_id]
+
+    def _next(self, now: float
+              ) -> Tuple[Optional[_Message], Optional[float]]:
+        """The first message which can be sent now, or else how long to wait
+        for one (None if there are none)."""
+        if not self._pending:
+            return None, None
+        wait = max(self._global.wait(now), self._paused_until - now)
+        if wait > 0:
+            return None, wait
+        for message in self._pending:
+            message_wait = max(message.not_before - now,
+                               self._bucket(message.chat_id, now).wait(now))
+            if message_wait <= 0:
+                return message, None
+            wait = message_wait if wait <= 0 else min(wait, message_wait)
+        return None, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                message, wait = self._next(self._clock())
+                while message is None:
+                    if self._stopped and not self._pending:
+                        return
+                    self._condition.wait(wait)
+                    message, wait = self._next(self._clock())
+                now = self._clock()
+                self._pending.remove(message)
+                self._global.take(now)
+                self._bucket(message.chat_id, now).take(now)
+                self._sending += 1
+            try:
+                self._deliver(message)
+            finally:
+                with self._condition:
+                    self._sending -= 1
+                    if not self._pending:
+                        self._prune(self._clock())
+                    self._condition.notify_all()
+
+    def _deliver(self, message: _Message) -> None:
+        message.attempts += 1
+        if message.first_attempt is None:
+            message.first_attempt = self._clock()
+            self._retry_policy.record_call()
+        try:
+            result = message.send()
+        except telegram.error.RetryAfter as retry_after:
+            logger.warning('Flood control, sending again in %s s',
+                           retry_after.retry_after)
+            with self._condition:
+                self._paused_until = max(
+                        self._paused_until,
+                        self._clock() + retry_after.retry_after)
+                self._insert(message)
+        except telegram.error.Unauthorized as unauthorized:
+            # Before failing the future, so whoever waits for it sees the
+            # callback done.
+            if self._on_unauthorized is not None:
+                try:
+                    self._on_unauthorized(message.chat_id)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('on_unauthorized failed')
+            message.future.set_exception(unauthorized)
+        except telegram.error.BadRequest as bad_request:
+            message.future.set_exception(bad_request)
+        except self._retry_policy.retry_on as error:
+            now = self._clock()
+            delay = self._retry_policy.next_delay(
+                    message.attempts, now - message.first_attempt)
+            if delay is None:
+                logger.error('CHAT_ID[%s] Message not sent: %r',
+                             message.chat_id, error)
+                message.future.set_exception(error)
+                return
+            logger.warning('%r, sending again in %.1f s', error, delay)
+            with self._condition:
+                message.not_before = now + delay
+                self._insert(message)
+        except Exception as exception:  # pylint: disable=broad-except
+            message.future.set_exception(exception)
+        else:
+            message.future.set_result(result)
+
+    def _prune(self, now: float) -> None:
+        """Forgets the buckets of the chats not sent to lately."""
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                        if bucket.full(now)]:
+            del self._chats[chat_id]
+
+    def join(self, timeout: float = None) -> bool:
+        """Waits until every queued message is sent.
+
+        Returns:
+            bool: False if it timed out.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                    lambda: not self._pending and not self._sending,
+                    timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """Number of 'pending' messages."""
+        with self._condition:
+            return {'pending': len(self._pending) + self._sending}
+
+    def stop(self, timeout: float = None) -> None:
+        """Sends the queued messages and stops the thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
@@ -0,0 +1,93 @@
+"""Pacing of the background refreshes against the refresh SLA.
+
+Notifications are only sent within the window, see utils.is_a_proper_time.
+RefreshPacer sets the scheduler rate so the subscribers due before the
+window closes are spread evenly over what is left of it, instead of
+refreshing them in a burst at the opening and idling afterwards.
+"""
+import datetime
+import logging
+from typing import Dict, Optional
+
+from src.scheduler import RefreshScheduler
+from src import utils
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+class RefreshPacer():
+    """Recalculates the RefreshScheduler rate from the pending work."""
+
+    def __init__(self, scheduler: RefreshScheduler, min_rate: float,
+                 max_rate: float) -> None:
+        """
+        :param min_rate: refreshes per hour even if nothing is due, so the
+                         subscribers found due later aren't held back.
+        :param max_rate: refreshes per hour never exceeded, whatever the
+                         SLA requires.
+        """
+        self._scheduler = scheduler
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+
+    def required_rate(self, now: datetime.datetime,
+                      deadline: Optional[datetime.datetime] = None
+                      ) -> float:
+        """Refreshes per hour needed to refresh, before 'deadline', every
+        subscriber due by then.
+
+        Subscribers sharing a rut are refreshed together, so ruts are
+        counted.
+
+        :param deadline: the window closing by default.
+        """
+        deadline = deadline or utils.window_closing(now)
+        due = self._scheduler.ruts_due_before(deadline)
+        hours_left = (deadline - now).total_seconds() / 3600
+        if hours_left <= 0:
+            return float('inf') if due else 0.0
+        return due / hours_left
+
+    def update(self, now: datetime.datetime,
+               deadline: Optional[datetime.datetime] = None) -> float:
+        """Sets the scheduler rate for 'now', within the window or, with
+        'deadline', ahead of it (eg to warm up until the opening).
+
+        Returns:
+            float: the new rate, refreshes per hour.
+        """
+        rate = min(max(self.required_rate(now, deadline), self._min_rate),
+                   self._max_rate)
+        if abs(rate - self._scheduler.rate) >= 0.1:
+            logger.debug('Refresh rate %.1f/h -> %.1f/h',
+                         self._scheduler.rate, rate)
+            self._scheduler.set_rate(rate)
+        return rate
+
+    def report(self, now: datetime.datetime) -> Dict:
+        """Projected completion of the refreshes due by the window closing.
+
+        Returns:
+            dict: 'due' ruts by the 'closing', 'rate' per hour,
+                'completion' time at this rate and whether that is
+                'on_time'.
+        """
+        closing = utils.window_closing(now)
+        due = self._scheduler.ruts_due_before(closing)
+        rate = self._scheduler.rate
+        completion = now + datetime.timedelta(hours=due / rate)
+        return {
+                'due': due,
+                'closing': closing,
+                'rate': rate,
+                'completion': completion,
+                'on_time': completion <= closing,
+        }
+
+    @staticmethod
+    def format(report: Dict) -> str:
+        """One line summary of a report, for the logs."""
+        return ('%(due)d due by %(closing)s, done at %(completion)s at '
+                '%(rate).1f/h' % report +
+                ('' if report['on_time'] else ', behind the SLA'))
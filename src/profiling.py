@@ -0,0 +1,207 @@
+"""Profiling of the queries run through a SQLAlchemy engine.
+
+QueryProfiler hooks the engine's cursor execute events and records the count
+and time of the queries per statement template, ie the SQL with its bound
+parameters as placeholders. Queries run inside a scope (a Telegram update or
+a refresh step, see DbConnection.unit_of_work) are also aggregated per scope
+name, the writes run for it by the db writer thread included, and a
+template repeated many times in a single scope is logged, as it usually is
+a query in a loop that could be a single one.
+"""
+import collections
+import contextlib
+import functools
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+# 'IN (?, ?, ?)' lists would make a template per list length.
+_PLACEHOLDER_LIST = re.compile(r'\bIN \(\?(\s*,\s*\?)*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_template(statement: str) -> str:
+    """Normalizes 'statement' so the queries built alike share a template."""
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    return _PLACEHOLDER_LIST.sub('IN (?, ...)', statement)
+
+
+class _TemplateStats():  # pylint: disable=too-few-public-methods
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed: float) -> None:
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+class _ScopeStats():  # pylint: disable=too-few-public-methods
+    def __init__(self) -> None:
+        self.count = 0
+        self.queries = 0
+        self.total_time = 0.0
+        self.max_queries = 0
+
+
+class _Scope():  # pylint: disable=too-few-public-methods
+    """Queries of a scope being run."""
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.queries = 0
+        self.total_time = 0.0
+        self.templates: Dict[str, int] = collections.Counter()
+
+
+class QueryProfiler():
+    """Records count and time of the queries run through an engine."""
+
+    def __init__(self, slow_query_threshold: float = 0.2,
+                 repeated_query_threshold: int = 10) -> None:
+        """
+        :param slow_query_threshold: queries taking more seconds than this
+                                     are logged.
+        :param repeated_query_threshold: templates run more times than this
+                                         in a single scope are logged.
+        """
+        self._slow_query_threshold = slow_query_threshold
+        self._repeated_query_threshold = repeated_query_threshold
+        self._lock = threading.Lock()
+        self._templates: Dict[str, _TemplateStats] = collections.defaultdict(
+                _TemplateStats)
+        self._scopes: Dict[str, _ScopeStats] = collections.defaultdict(
+                _ScopeStats)
+        self._local = threading.local()
+
+    def attach(self, engine) -> None:
+        """Starts profiling the queries run through 'engine'."""
+        # pylint: disable=unused-argument,too-many-arguments
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            conn.info.setdefault('query_start_time', []).append(
+                    time.perf_counter())
+
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            start = conn.info['query_start_time'].pop()
+            self.record(statement, time.perf_counter() - start)
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    def record(self, statement: str, elapsed: float) -> None:
+        """Records a query of 'statement' which took 'elapsed' seconds."""
+        template = statement_template(statement)
+        with self._lock:
+            self._templates[template].record(elapsed)
+        scope = self._current_scope()
+        if scope is not None:
+            scope.queries += 1
+            scope.total_time += elapsed
+            scope.templates[template] += 1
+        if elapsed > self._slow_query_threshold:
+            logger.warning('Slow query (%.0f ms) in %s: %s', elapsed * 1000,
+                           scope.name if scope is not None else '-',
+                           template)
+
+    def _current_scope(self) -> Optional[_Scope]:
+        return getattr(self._local, 'scope', None)
+
+    def in_current_scope(self, function: Callable) -> Callable:
+        """Wraps 'function' so its queries are recorded in the scope of the
+        calling thread, when it is called from another thread (eg the db
+        writer's).
+
+        The scope must still be open when 'function' runs, ie the caller
+        waits for it. Otherwise its queries are not aggregated.
+        """
+        scope = self._current_scope()
+        if scope is None:
+            return function
+
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            previous = self._current_scope()
+            self._local.scope = scope
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._local.scope = previous
+        return wrapped
+
+    @contextlib.contextmanager
+    def scope(self, name: str):
+        """Aggregates the queries run in the context under 'name'.
+
+        Nested scopes are part of the outermost one.
+        """
+        if self._current_scope() is not None:
+            yield
+            return
+        scope = _Scope(name)
+        self._local.scope = scope
+        try:
+            yield
+        finally:
+            self._local.scope = None
+            self._close_scope(scope)
+
+    def _close_scope(self, scope: _Scope) -> None:
+        with self._lock:
+            stats = self._scopes[scope.name]
+            stats.count += 1
+            stats.queries += scope.queries
+            stats.total_time += scope.total_time
+            stats.max_queries = max(stats.max_queries, scope.queries)
+        for template, count in scope.templates.items():
+            if count > self._repeated_query_threshold:
+                logger.warning('Query run %d times in %s: %s', count,
+                               scope.name, template)
+        logger.debug('%s: %d queries in %.1f ms', scope.name, scope.queries,
+                     scope.total_time * 1000)
+
+    def snapshot(self, top: int = 10) -> Dict:
+        """Aggregated stats.
+
+        Returns:
+            dict: 'templates', the 'top' templates by total time, and
+                'scopes', the stats of each scope name.
+        """
+        with self._lock:
+            templates: List[Dict] = [
+                    {'template': template, 'count': stats.count,
+                     'total_ms': stats.total_time * 1000,
+                     'max_ms': stats.max_time * 1000}
+                    for template, stats in self._templates.items()]
+            scopes = {
+                    name: {'count': stats.count, 'queries': stats.queries,
+                           'avg_queries': stats.queries / stats.count,
+                           'max_queries': stats.max_queries,
+                           'avg_ms': stats.total_time * 1000 / stats.count}
+                    for name, stats in self._scopes.items()}
+        templates.sort(key=lambda stats: stats['total_ms'], reverse=True)
+        return {'templates': templates[:top], 'scopes': scopes}
+
+    @staticmethod
+    def format(snapshot: Dict) -> str:
+        """One line per scope and template of a snapshot, for the logs."""
+        lines = []
+        for name, stats in sorted(snapshot['scopes'].items()):
+            lines.append(
+                    '%s: %d runs, %.1f queries (max %d), %.1f ms avg' % (
+                            name, stats['count'], stats['avg_queries'],
+                            stats['max_queries'], stats['avg_ms']))
+        for stats in snapshot['templates']:
+            lines.append('%d x %.1f ms (max %.1f ms): %s' % (
+                    stats['count'], stats['total_ms'] / stats['count'],
+                    stats['max_ms'], stats['template']))
+        return '\n'.join(lines)
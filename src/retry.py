@@ -0,0 +1,118 @@
+"""Retries of calls failing with transient errors.
+
+RetryPolicy waits an exponentially growing, randomized ("full jitter")
+delay between attempts and gives up after 'max_elapsed' seconds. A
+RetryBudget shared by the calls to the same service caps the retries to a
+fraction of the calls, so an outage doesn't multiply the load on the service
+nor keep every caller busy retrying.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+from typing import Callable, Deque, Optional, Tuple, Type
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+class RetryBudget():
+    """Allows, within any 'window' seconds, 'minimum' retries plus 'ratio'
+    retries per call made. Thread safe."""
+
+    def __init__(self, ratio: float = 0.2, minimum: int = 10,
+                 window: float = 60,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._ratio = ratio
+        self._minimum = minimum
+        self._window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._calls: Deque[float] = collections.deque()
+        self._retries: Deque[float] = collections.deque()
+
+    def _expire(self, now: float) -> None:
+        for times in (self._calls, self._retries):
+            while times and times[0] <= now - self._window:
+                times.popleft()
+
+    def record_call(self) -> None:
+        """Records a call, first attempts only."""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._calls.append(now)
+
+    def try_retry(self) -> bool:
+        """Takes a retry from the budget, if there is one left."""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if len(self._retries) >= (
+                    self._minimum + self._ratio * len(self._calls)):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class RetryPolicy():
+    """Exponential backoff with jitter, bounded by time and by a budget."""
+
+    def __init__(self, retry_on: Tuple[Type[Exception], ...],
+                 base_delay: float = 0.5, max_delay: float = 8,
+                 max_elapsed: float = 30,
+                 budget: Optional[RetryBudget] = None) -> None:
+        """
+        :param retry_on: exceptions worth another attempt.
+        :param base_delay: max seconds before the first retry, doubled for
+                           each following one up to 'max_delay'.
+        :param max_elapsed: no retry is started after this many seconds
+                            since the first attempt.
+        :param budget: shared by the calls to the same service, if set.
+        """
+        self.retry_on = retry_on
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_elapsed = max_elapsed
+        self._budget = budget
+        # Replaceable for tests.
+        self.sleep = time.sleep
+        self.clock = time.monotonic
+
+    def record_call(self) -> None:
+        """Records the first attempt of a call against the budget."""
+        if self._budget is not None:
+            self._budget.record_call()
+
+    def next_delay(self, attempts: int, elapsed: float) -> Optional[float]:
+        """Seconds to wait before retrying, None to give up.
+
+        :param attempts: failed attempts so far.
+        :param elapsed: seconds since the first attempt.
+        """
+        delay = random.uniform(0, min(
+                self._max_delay, self._base_delay * 2 ** (attempts - 1)))
+        if elapsed + delay > self._max_elapsed:
+            logger.warning('Giving up after %d attempts', attempts)
+            return None
+        if self._budget is not None and not self._budget.try_retry():
+            logger.warning('Retry budget exhausted, giving up')
+            return None
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        """Calls 'function', retrying it while it fails with 'retry_on'."""
+        self.record_call()
+        start = self.clock()
+        attempts = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except self.retry_on as error:
+                attempts += 1
+                delay = self.next_delay(attempts, self.clock() - start)
+                if delay is None:
+                    raise
+                logger.warning('%r, retrying in %.1f s', error, delay)
+                self.sleep(delay)
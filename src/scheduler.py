@@ -0,0 +1,190 @@
+"""Scheduling of the background refreshes of the subscribers' results.
+
+RefreshScheduler keeps the subscribers in a min-heap by the time their
+results are due, ie retrieved HOURS_TO_UPDATE hours ago, and hands the
+overdue ones out no faster than the configured rate.
+"""
+import datetime
+import heapq
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from src.model_interface import CacheBackend, DbConnection, Subscriber, User
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+class RefreshScheduler():
+    """Min-heap of the subscribers by the time their refresh is due.
+
+    The heap is rebuilt from the db every 'reload_period', picking up new
+    subscribers and dropping the ones who left. Thread safe.
+    """
+    def __init__(self, db_connection: DbConnection, hours: float,
+                 rate: float, reload_period: datetime.timedelta = (
+                         datetime.timedelta(minutes=10)),
+                 cache: Optional[CacheBackend] = None) -> None:
+        """
+        :param hours: results are due this many hours after retrieved.
+        :param rate: maximum refreshes per hour.
+        :param reload_period: how often the subscribers are read again.
+        :param cache: the results are taken as retrieved when they were
+                      stored in it, if set, instead of in the db.
+        """
+        self._db_connection = db_connection
+        self._cache = cache
+        self._due_after = datetime.timedelta(hours=hours)
+        self._reload_period = reload_period
+        self._lock = threading.Lock()
+        # (due time, user id, subscriber), the user id breaks ties.
+        self._heap: List[Tuple[datetime.datetime, int, Subscriber]] = []
+        # User ids handed out and not done yet.
+        self._in_flight: Set[int] = set()
+        self._last_reload: Optional[datetime.datetime] = None
+        self._next_slot: Optional[datetime.datetime] = None
+        self._interval = datetime.timedelta(0)
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        """Changes the maximum refreshes per hour."""
+        if rate <= 0:
+            raise ValueError('rate must be positive: %s' % rate)
+        with self._lock:
+            self.rate = rate
+            self._interval = datetime.timedelta(hours=1) / rate
+
+    def _due(self, subscriber: Subscriber) -> datetime.datetime:
+        if subscriber.retrieved is None:
+            return datetime.datetime.min
+        return subscriber.retrieved + self._due_after
+
+    def reload(self, now: datetime.datetime) -> None:
+        """Rebuilds the heap with the subscribers in the db."""
+        subscribers = User(self._db_connection).get_subscribers()
+        if self._cache is not None:
+            subscribers = self._cache.with_retrieved(subscribers)
+        with self._lock:
+            self._heap = [(self._due(subscriber), subscriber.user_id,
+                           subscriber)
+                          for subscriber in subscribers
+                          if subscriber.user_id not in self._in_flight]
+            heapq.heapify(self._heap)
+            self._last_reload = now
+        logger.debug('Scheduler reloaded, %d subscribers', len(subscribers))
+
+    def _maybe_reload(self, now: datetime.datetime) -> None:
+        if (self._last_reload is None or
+                now - self._last_reload >= self._reload_period):
+            self.reload(now)
+
+    def next_due(self, now: datetime.datetime,
+                 due_by: Optional[datetime.datetime] = None
+                 ) -> Optional[Subscriber]:
+        """Hands out the most overdue subscriber, if the rate allows it.
+
+        The subscriber must be given back with done() once refreshed.
+
+        :param due_by: hands out the subscribers due by then, 'now' by
+                       default. Later to refresh them ahead of time.
+        """
+        self._maybe_reload(now)
+        with self._lock:
+            if not self._heap or self._heap[0][0] > (due_by or now):
+                return None
+            if self._next_slot is not None and self._next_slot > now:
+                return None
+            # A slot missed long ago doesn't allow a burst now.
+            self._next_slot = max(self._next_slot or now, now) + (
+                    self._interval)
+            _, user_id, subscriber = heapq.heappop(self._heap)
+            self._in_flight.add(user_id)
+            return subscriber
+
+    def next_due_group(self, now: datetime.datetime,
+                       due_by: Optional[datetime.datetime] = None
+                       ) -> List[Subscriber]:
+        """Like next_due, but along with the subscriber hands out every
+        other with the same rut, due or not, as they share the bank query.
+
+        Each of them must be given back with done().
+        """
+        subscriber = self.next_due(now, due_by)
+        if subscriber is None:
+            return []
+        with self._lock:
+            group = [entry[2] for entry in self._heap
+                     if entry[2].rut == subscriber.rut]
+            if group:
+                self._heap = [entry for entry in self._heap
+                              if entry[2].rut != subscriber.rut]
+                heapq.heapify(self._heap)
+                self._in_flight.update(sibling.user_id for sibling in group)
+        return [subscriber] + group
+
+    def done(self, subscriber: Subscriber, now: datetime.datetime) -> None:
+        """Schedules 'subscriber' again, after a refresh at 'now'.
+
+        Failed refreshes are retried by their jobs, not rescheduled here.
+        """
+        due = now + self._due_after
+        subscriber = subscriber._replace(retrieved=now)
+        with self._lock:
+            self._in_flight.discard(subscriber.user_id)
+            heapq.heappush(self._heap, (due, subscriber.user_id, subscriber))
+
+    def ruts_due_before(self, when: datetime.datetime) -> int:
+        """Number of ruts of the subscribers, not being refreshed, due at
+        'when'."""
+        with self._lock:
+            return len({subscriber.rut for due, _, subscriber in self._heap
+                        if due <= when})
+
+    def seconds_until_next(self, now: datetime.datetime,
+                           due_by: Optional[datetime.datetime] = None
+                           ) -> float:
+        """Seconds until next_due, with the same 'due_by', may hand out a
+        subscriber.
+
+        Only accounts for the subscribers known now, a reload may bring
+        some due earlier.
+        """
+        with self._lock:
+            if not self._heap:
+                wait = self._reload_period
+            else:
+                wait = max(self._heap[0][0] - (due_by or now),
+                           datetime.timedelta(0))
+                if self._next_slot is not None:
+                    wait = max(wait, self._next_slot - now)
+        return wait.total_seconds()
+
+    def report(self, now: datetime.datetime) -> Dict:
+        """Backlog and lag against the refresh SLA.
+
+        Returns:
+            dict: 'subscribers' scheduled, 'backlog' of overdue ones,
+                'max_lag' seconds the most overdue is late, 'rate' per hour
+                and 'backlog_hours' to clear the backlog at this rate.
+        """
+        with self._lock:
+            # The never retrieved ones are counted late since the reload
+            # which found them.
+            lags = [now - (self._last_reload if due == datetime.datetime.min
+                           else due)
+                    for due, _, _ in self._heap if due <= now]
+            return {
+                    'subscribers': len(self._heap) + len(self._in_flight),
+                    'backlog': len(lags),
+                    'max_lag': max(lags).total_seconds() if lags else 0.0,
+                    'rate': self.rate,
+                    'backlog_hours': len(lags) / self.rate,
+            }
+
+    @staticmethod
+    def format(report: Dict) -> str:
+        """One line summary of a report, for the logs."""
+        return ('%(subscribers)d subscribers, backlog %(backlog)d '
+                '(%(backlog_hours).1f h at %(rate).0f/h), max lag '
+                '%(max_lag).0f s') % report
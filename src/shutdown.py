@@ -0,0 +1,70 @@
+"""Graceful shutdown within a deadline.
+
+Stopping the bot means stopping and draining several components in order:
+the updates from Telegram, the background refreshes, the outgoing messages
+and the database writes. ShutdownCoordinator runs those steps one after the
+other, each given what is left of a shared deadline, so a step that can't
+drain in time doesn't keep the process from exiting.
+"""
+import logging
+import threading
+import time
+from typing import Callable, List, Tuple
+
+
+logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
+
+
+class ShutdownCoordinator():
+    """Ordered shutdown steps sharing a deadline."""
+
+    def __init__(self, deadline: float,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param deadline: seconds for all the steps.
+        """
+        self._deadline = deadline
+        self._clock = clock
+        self._steps: List[Tuple[str, Callable[[], None]]] = []
+
+    def add(self, name: str, step: Callable[[], None]) -> None:
+        """Adds a step, run after the ones already added."""
+        self._steps.append((name, step))
+
+    def run(self) -> List[str]:
+        """Runs the steps in order.
+
+        Each step runs in its own thread, if it doesn't finish before the
+        deadline it is left running and the next one starts. A failing step
+        doesn't stop the others.
+
+        Returns:
+            list: names of the steps which failed or didn't finish.
+        """
+        end = self._clock() + self._deadline
+        unfinished = []
+        for name, step in self._steps:
+            errors: List[Exception] = []
+            thread = threading.Thread(
+                    target=self._run_step, args=(step, errors),
+                    name='shutdown-%s' % name, daemon=True)
+            start = self._clock()
+            thread.start()
+            thread.join(max(end - self._clock(), 0))
+            if thread.is_alive():
+                logger.error('Shutdown: %s not done by the deadline', name)
+                unfinished.append(name)
+            elif errors:
+                unfinished.append(name)
+            else:
+                logger.info('Shutdown: %s done in %.1f s', name,
+                            self._clock() - start)
+        return unfinished
+
+    @staticmethod
+    def _run_step(step: Callable[[], None], errors: List[Exception]) -> None:
+        try:
+            step()
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.exception('Shutdown step failed')
+            errors.append(exception)
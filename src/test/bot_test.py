@@ -5,12 +5,15 @@ from unittest import TestCase
 from unittest.mock import MagicMock
 import telegram
 import queue
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 from src.test.model_interface_test import User
+from src.job_queue import JobQueue
 from src.model_interface import DbConnection
 from src.bot import ValeVistaBot
 from src import bot
+from src import utils
 from src.utils import is_a_proper_time, Rut
 from src import model_interface
 from src.messages import Messages
@@ -197,6 +200,18 @@ class TestFunctionalBot(TestCase):
         self.dispatcher.process_update(update)
         self.assertEqual(expected, self.stored)
 
+    def testReplyAfterCommit(self):
+        def reply(unused_msg):
+            self.stored = User(self._db_connection).get_rut(
+                    self.user1_telegram_id)
+            raise telegram.error.NetworkError('Reply failed')
+        update = self.simpleCommand('set %s' % self.rut, cb_reply=reply)
+        self.dispatcher.process_update(update)
+        # The rut was committed before replying, the failure keeps it.
+        self.assertEqual(self.rut, self.stored)
+        self.assertEqual(self.rut, User(self._db_connection).get_rut(
+                self.user1_telegram_id))
+
     def testSubscribeNoRut(self):
         expected = Messages.SUBSCRIBE_NO_RUT
         update = self.simpleCommand('subscribe',
@@ -395,6 +410,77 @@ class TestFunctionalBot(TestCase):
                 ValeVistaBot.ReplyWhen.IS_USEFUL_FOR_USER)
         self.assertEqual(None, self.stored)
 
+    def staleBot(self):
+        # Every result is stale right after being stored.
+        cache = model_interface.Cache(
+                self._db_connection, datetime.timedelta(0))
+        return ValeVistaBot(self._db_connection, self.retriever, cache,
+                            stale_grace=datetime.timedelta(hours=1))
+
+    def storeAll(self, recv_str: str):
+        self.all_stored.append(recv_str)
+
+    def testStaleWhileRevalidateUnchanged(self):
+        bot = self.staleBot()
+        self.all_stored = []
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendido.html'))
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        self.assertEqual([self._EXPECTED_PAGADO_RENDIDO], self.all_stored)
+        self.all_stored = []
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        bot._revalidator.shutdown(wait=True)
+        # Only the stale result, the bank had nothing new.
+        self.assertEqual(1, len(self.all_stored))
+        self.assertTrue(self.all_stored[0].startswith(
+                self._EXPECTED_PAGADO_RENDIDO))
+        self.assertIn(Messages.STALE_RESULT % 0, self.all_stored[0])
+
+    def testStaleWhileRevalidateChanged(self):
+        bot = self.staleBot()
+        self.all_stored = []
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendido.html'))
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        self.all_stored = []
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        bot._revalidator.shutdown(wait=True)
+        self.assertEqual(2, len(self.all_stored))
+        self.assertTrue(self.all_stored[0].startswith(
+                self._EXPECTED_PAGADO_RENDIDO))
+        self.assertEqual(Messages.STALE_RESULT_UPDATED +
+                         self._EXPECTED_PAGADO_RENDICION, self.all_stored[1])
+
+    def testStaleWhileRevalidateError(self):
+        bot = self.staleBot()
+        self.all_stored = []
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendido.html'))
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        self.all_stored = []
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('Error.htm'))
+        bot.query_the_bank_and_reply(self.user1_telegram_id, self.rut,
+                                     self.storeAll,
+                                     ValeVistaBot.ReplyWhen.ALWAYS)
+        bot._revalidator.shutdown(wait=True)
+        self.assertEqual(1, len(self.all_stored))
+
     def testMessage(self):
         expected = 'sample_msg'
         update = self.simpleMessage(expected,
@@ -458,8 +544,10 @@ class TestFunctionalBot(TestCase):
         self.stored = None
 
         self.assertFalse(
-                User(self._db_connection).get_subscribers_to_update(1))
-        subscribers = User(self._db_connection).get_subscribers_to_update(0)
+                User(self._db_connection).get_subscribers_to_update(
+                        1, datetime.datetime.utcnow()))
+        subscribers = User(self._db_connection).get_subscribers_to_update(
+                0, datetime.datetime.utcnow())
         self.assertEqual(1, len(subscribers))
 
     def sendMessageMock(self, chat_id, msg):
@@ -478,11 +566,41 @@ class TestFunctionalBot(TestCase):
         mocked_updater.bot.sendMessage = self.sendMessageMock
         self.stored = None
         self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
         self.assertEqual(self._EXPECTED_PAGADO_RENDICION, self.stored)
         self.stored = None
         self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
         self.assertEqual(None, self.stored)
 
+    def testStepNotificationDurable(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        mocked_updater.bot.sendMessage = self.sendMessageMock
+        self.stored = None
+        # The bot stops right after committing the refresh.
+        flush = self.bot.flush_held_notifications
+        self.bot.flush_held_notifications = MagicMock()
+        self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
+        self.assertIsNone(self.stored)
+        jobs = JobQueue(self._db_connection)
+        self.assertEqual(1, jobs.stats()['pending'])
+
+        # Sent on the next flush, and done once sent.
+        flush(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
+        self.assertEqual(self._EXPECTED_PAGADO_RENDICION, self.stored)
+        self.assertEqual(0, jobs.stats()['pending'])
+        self.assertEqual(0, jobs.stats()['leased'])
+
     def testStepNoUpdate(self):
         self.setRut()
         self.retriever.setPath(
@@ -496,15 +614,17 @@ class TestFunctionalBot(TestCase):
         mocked_updater.bot.sendMessage = self.sendMessageMock
         self.stored = None
         self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
         self.assertIsNone(self.stored)
         self.stored = None
         self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
         self.assertEqual(None, self.stored)
 
     def testStepUnauthorized(self):
         self.setRut()
         self.retriever.setPath(
-                web_test.TestFilesBasePath().joinpath('pagado_rendido.html'))
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
         update = self.simpleCommand('subscribe',
                                     cb_reply=self.store_received_string)
         self.dispatcher.process_update(update)  # Process the subscription.
@@ -513,17 +633,209 @@ class TestFunctionalBot(TestCase):
 
         mocked_updater = MagicMock(telegram.ext.Updater)
         mocked_updater.bot = MagicMock(telegram.Bot)
-        mocked_updater.bot.sendMessage = self.sendMessageMock
-
-        mocked_query_the_bank = MagicMock(
+        # The notification is rejected by the outbox.
+        mocked_updater.bot.sendMessage = MagicMock(
             side_effect=telegram.error.Unauthorized('unauthorized'))
-        self.bot.query_the_bank_and_reply = mocked_query_the_bank
 
         self.stored = None
         self.bot.step(mocked_updater)
+        self.assertTrue(self.bot.wait_notifications(5))
+        mocked_updater.bot.sendMessage.assert_called_once()
         self.assertFalse(User(self._db_connection).is_subscribed(
                 self.user1_telegram_id, self.chat_id))
-        self.assertEqual(None, self.stored)
+
+    def testRefreshDue(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        mocked_updater.bot.sendMessage = self.sendMessageMock
+        self.stored = None
+        now = datetime.datetime.utcnow()
+        self.assertEqual(1, self.bot.refresh_due(mocked_updater, now))
+        self.assertTrue(self.bot.wait_refreshes(5))
+        self.assertEqual(self._EXPECTED_PAGADO_RENDICION, self.stored)
+        # Not due again until HOURS_TO_UPDATE later.
+        self.assertEqual(0, self.bot.refresh_due(
+                mocked_updater, now + datetime.timedelta(hours=1)))
+
+    def testVirtualClock(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        mocked_updater.bot.sendMessage = self.sendMessageMock
+        now = datetime.datetime(2030, 1, 1, 15)
+        virtual = ValeVistaBot(self._db_connection, self.retriever,
+                               clock=lambda: now)
+        wake_up = virtual.window_step(mocked_updater, now)
+        self.assertTrue(virtual.wait_refreshes(5))
+        self.assertEqual(self._EXPECTED_PAGADO_RENDICION, self.stored)
+        self.assertLessEqual(wake_up, now + bot.MAX_LOOP_SLEEP)
+        # Retrieved at the virtual time.
+        self.assertEqual([now], [subscriber.retrieved for subscriber in User(
+                self._db_connection).get_subscribers()])
+
+    def testWindowStepClosed(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        mocked_updater.bot.sendMessage = self.sendMessageMock
+        # Saturday.
+        now = datetime.datetime(2016, 12, 3, 15)
+        virtual = ValeVistaBot(self._db_connection, self.retriever,
+                               clock=lambda: now)
+        self.stored = None
+        wake_up = virtual.window_step(mocked_updater, now)
+        self.assertTrue(virtual.wait_refreshes(5))
+        self.assertIsNone(self.stored)
+        self.assertEqual(utils.next_window(now)[0], wake_up)
+        self.assertEqual([None], [subscriber.retrieved for subscriber in User(
+                self._db_connection).get_subscribers()])
+
+    def testShutdownTimedOut(self):
+        self.setRut()
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+        started = threading.Event()
+        release = threading.Event()
+
+        class BlockedRetriever(web_test.WebPageFromFileRetriever):
+            def retrieve(self, rut):
+                started.set()
+                release.wait(5)
+                return super(BlockedRetriever, self).retrieve(rut)
+        retriever = BlockedRetriever(
+                web_test.TestFilesBasePath().joinpath('pagado_rendido.html'))
+        blocked = ValeVistaBot(self._db_connection, retriever)
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        try:
+            self.assertEqual(1, blocked.refresh_due(
+                    mocked_updater, datetime.datetime.utcnow()))
+            self.assertTrue(started.wait(5))
+            with self.assertLogs('bot_main_logger', 'WARNING') as logs:
+                blocked.shutdown(mocked_updater, deadline=0.2)
+        finally:
+            release.set()
+        # The refresh still running is abandoned before stopping the db.
+        self.assertIn('Abandoning 0 queued and 1 running refreshes',
+                      '\n'.join(logs.output))
+        self.assertTrue(blocked.wait_refreshes(5))
+
+    def testRefreshGroupedByRut(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+        other_telegram_id, other_chat_id = get_id(), get_id()
+        with self._db_connection.unit_of_work():
+            user = User(self._db_connection)
+            user.set_rut(other_telegram_id, self.rut)
+            user.subscribe(other_telegram_id, other_chat_id)
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        self.retriever.retrieve = MagicMock(wraps=self.retriever.retrieve)
+        now = datetime.datetime.utcnow()
+        self.assertEqual(1, self.bot.refresh_due(mocked_updater, now))
+        self.assertTrue(self.bot.wait_refreshes(5))
+        self.assertEqual(1, self.retriever.retrieve.call_count)
+        self.assertEqual(
+                {str(self.chat_id), str(other_chat_id)},
+                {call[1][0] for call in
+                 mocked_updater.bot.sendMessage.mock_calls})
+
+    def testRefreshRetried(self):
+        self.setRut()
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        self.bot.query_the_bank_and_reply = MagicMock(return_value=False)
+        now = datetime.datetime.utcnow()
+        self.assertEqual(1, self.bot.refresh_due(mocked_updater, now))
+        self.assertTrue(self.bot.wait_refreshes(5))
+        # Queued to be retried later.
+        self.assertEqual(0, self.bot.refresh_due(mocked_updater, now))
+        self.assertEqual(1, JobQueue(self._db_connection).stats()['pending'])
+
+    def testRefreshReleasedWhenStopping(self):
+        self.setRut()
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        jobs = JobQueue(self._db_connection)
+        jobs.put(bot.REFRESH_JOB, {'rut': 1})
+        job = jobs.lease(bot.REFRESH_JOB, datetime.datetime.utcnow())[0]
+        self.bot.query_the_bank_and_reply = MagicMock(return_value=True)
+        self.bot.signal_handler(None, None)
+        self.bot._refresh_task(  # pylint: disable=protected-access
+                MagicMock(telegram.ext.Updater), job)
+        self.bot.query_the_bank_and_reply.assert_not_called()
+        # Left for the next start.
+        self.assertEqual(1, jobs.stats()['pending'])
+
+    def testLoopStops(self):
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        loop = threading.Thread(target=self.bot.loop, args=(mocked_updater,))
+        loop.start()
+        self.bot.signal_handler(None, None)
+        # Wakes up from its sleep.
+        loop.join(5)
+        self.assertFalse(loop.is_alive())
+        mocked_updater.stop.assert_called_once_with()
+
+    def testWarmupStepHoldsNotifications(self):
+        self.setRut()
+        self.retriever.setPath(
+                web_test.TestFilesBasePath().joinpath('pagado_rendicion.html'))
+        update = self.simpleCommand('subscribe',
+                                    cb_reply=self.store_received_string)
+        self.dispatcher.process_update(update)  # Process the subscription.
+
+        mocked_updater = MagicMock(telegram.ext.Updater)
+        mocked_updater.bot = MagicMock(telegram.Bot)
+        mocked_updater.bot.sendMessage = self.sendMessageMock
+        self.stored = None
+        # Half an hour before the window opens (Friday 10:00 Santiago).
+        now = datetime.datetime(2016, 12, 2, 12, 30)
+        opening = utils.window_opening(now)
+        virtual = ValeVistaBot(self._db_connection, self.retriever,
+                               clock=lambda: now)
+        wake_up = virtual.warmup_step(mocked_updater, now)
+        self.assertTrue(virtual.wait_refreshes(5))
+        self.assertIsNone(self.stored)
+        self.assertLess(now, wake_up)
+        self.assertLessEqual(wake_up, opening)
+        # Already fetched, nothing to do when the window opens.
+        self.assertEqual(0, virtual.refresh_due(mocked_updater, opening))
+        virtual.flush_held_notifications(mocked_updater)
+        self.assertTrue(virtual.wait_notifications(5))
+        self.assertEqual(self._EXPECTED_PAGADO_RENDICION, self.stored)
+        self.stored = None
+        self.bot.flush_held_notifications(mocked_updater)
+        self.assertIsNone(self.stored)
 
 
 class TestStart(TestCase):
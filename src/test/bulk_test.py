@@ -0,0 +1,120 @@
+import io
+import json
+import unittest
+from unittest import TestCase
+
+from src import bulk
+from src.model_interface import Cache, DbConnection, User
+from src.utils import Rut
+
+
+class TestBulk(TestCase):
+
+    def setUp(self):
+        self.source = DbConnection(in_memory=True)
+        self.rut1 = Rut.build_rut('2.343.234-k')
+        self.rut2 = Rut.build_rut('12.444.333-4')
+        user1 = User(self.source)
+        user1.set_rut(1, self.rut1)
+        user1.subscribe(1, 10)
+        User(self.source).set_rut(2, self.rut2)
+        User(self.source).get_id(3)
+        Cache(self.source).update(
+                user1.get_id(1), self.rut1, 'result')
+
+    def roundTrip(self, fmt):
+        destination = DbConnection(in_memory=True)
+        for table in ('users', 'subscribed_users', 'cached_results'):
+            out_file = io.StringIO()
+            exported = bulk.export_table(self.source, table, out_file, fmt)
+            out_file.seek(0)
+            imported, rejected = bulk.import_table(
+                    destination, table, out_file, fmt, batch_size=2)
+            self.assertEqual(exported, imported)
+            self.assertEqual(0, rejected)
+        return destination
+
+    def checkCopy(self, destination):
+        user = User(destination)
+        self.assertEqual(self.rut1.rut_sin_digito,
+                         user.get_rut(1).rut_sin_digito)
+        self.assertEqual(self.rut2.rut_sin_digito,
+                         user.get_rut(2).rut_sin_digito)
+        self.assertIsNone(user.get_rut(3))
+        self.assertTrue(user.is_subscribed(1, 10))
+        self.assertEqual('result',
+                         Cache(destination).get(user.get_id(1), self.rut1))
+
+    def testJsonlRoundTrip(self):
+        self.checkCopy(self.roundTrip('jsonl'))
+
+    def testCsvRoundTrip(self):
+        self.checkCopy(self.roundTrip('csv'))
+
+    def testExportFullRut(self):
+        out_file = io.StringIO()
+        self.assertEqual(3, bulk.export_table(
+                self.source, 'users', out_file, 'jsonl'))
+        rows = [json.loads(line) for line in out_file.getvalue().splitlines()]
+        self.assertEqual(str(self.rut1), rows[0]['rut'])
+        self.assertIsNone(rows[2]['rut'])
+
+    def testInvalidRowsRejected(self):
+        destination = DbConnection(in_memory=True)
+        rows = [
+                {'id': 1, 'telegram_id': 1, 'rut': '2.343.234-1'},
+                {'id': 2, 'telegram_id': 2, 'rut': 'abc'},
+                {'id': 3, 'telegram_id': 'x', 'rut': None},
+                {'id': 4, 'telegram_id': 4, 'rut': '2343234'},
+                {'id': 5, 'telegram_id': 5, 'rut': '12.444.333-4'},
+                # Out of the bounds of Rut.build_rut, with or without dash.
+                {'id': 6, 'telegram_id': 6, 'rut': '1234567890'},
+                {'id': 7, 'telegram_id': 7, 'rut': '123.456.789-2'},
+                {'id': 8, 'telegram_id': 8, 'rut': '123456'},
+        ]
+        in_file = io.StringIO(
+                '\n'.join(json.dumps(row) for row in rows) + '\n')
+        self.assertEqual((2, 6), bulk.import_table(
+                destination, 'users', in_file, 'jsonl'))
+        user = User(destination)
+        self.assertEqual(2343234, user.get_rut(4).rut_sin_digito)
+        self.assertEqual(12444333, user.get_rut(5).rut_sin_digito)
+
+    def testInvalidJsonRejected(self):
+        destination = DbConnection(in_memory=True)
+        in_file = io.StringIO(
+                '{"id": 1, "telegram_id": 1, "rut": null}\n'
+                '{"id": 2, "telegram_id": 2,\n'
+                '[3, 3, null]\n'
+                '\n'
+                '{"id": 4, "telegram_id": 4, "rut": "+2343234"}\n'
+                '{"id": 5, "telegram_id": 5, "rut": "2_343_234"}\n'
+                '{"id": 6, "telegram_id": 6, "rut": "0"}\n'
+                '{"id": 7, "telegram_id": 7, "rut": "2343234"}\n')
+        self.assertEqual((2, 5), bulk.import_table(
+                destination, 'users', in_file, 'jsonl'))
+        user = User(destination)
+        self.assertIsNone(user.get_rut(1))
+        self.assertEqual(2343234, user.get_rut(7).rut_sin_digito)
+
+    def testOnConflict(self):
+        out_file = io.StringIO()
+        bulk.export_table(self.source, 'users', out_file, 'jsonl')
+        for on_conflict in ('ignore', 'replace'):
+            out_file.seek(0)
+            self.assertEqual((3, 0), bulk.import_table(
+                    self.source, 'users', out_file, 'jsonl',
+                    on_conflict=on_conflict))
+        out_file.seek(0)
+        with self.assertRaises(Exception):
+            bulk.import_table(self.source, 'users', out_file, 'jsonl')
+
+    def testFormatFromPath(self):
+        self.assertEqual('csv', bulk._format_from_path('a/users.csv'))
+        self.assertEqual('jsonl', bulk._format_from_path('users.jsonl'))
+        with self.assertRaises(ValueError):
+            bulk._format_from_path('users.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
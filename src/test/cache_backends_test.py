@@ -0,0 +1,145 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+
+from src import cache_backends
+from src.cache_backends import DbmCache, MemoryCache
+from src.model_interface import Cache, DbConnection, User
+from src.utils import Rut
+
+
+class CacheBackendTests():
+    """Tests every backend must pass, mixed into a TestCase."""
+
+    def buildCache(self, exp_time=datetime.timedelta(hours=2),
+                   clock=datetime.datetime.utcnow):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.rut1 = Rut.build_rut('2.343.234-k')
+        self.rut2 = Rut.build_rut('12.444.333-4')
+        self.db_connection = DbConnection(in_memory=True)
+        # Cached results reference existing users.
+        for telegram_id in range(1, 3):
+            User(self.db_connection).get_id(telegram_id)
+        self.cache = self.buildCache()
+
+    def testGetUpdate(self):
+        self.assertIsNone(self.cache.get(1, self.rut1))
+        self.assertTrue(self.cache.update(1, self.rut1, 'result'))
+        self.assertEqual('result', self.cache.get(1, self.rut1))
+        self.assertIsNone(self.cache.get(1, self.rut2))
+        self.assertIsNone(self.cache.get(2, self.rut1))
+        self.assertFalse(self.cache.update(1, self.rut1, 'result'))
+        self.assertTrue(self.cache.update(1, self.rut1, 'result2'))
+        self.assertEqual('result2', self.cache.get(1, self.rut1))
+
+    def testInvalidate(self):
+        self.cache.update(1, self.rut1, 'result')
+        self.cache.update(1, self.rut2, 'result')
+        self.cache.invalidate(1, self.rut1)
+        self.assertIsNone(self.cache.get(1, self.rut1))
+        self.assertEqual('result', self.cache.get(1, self.rut2))
+        # Invalidating a missing entry is a no-op.
+        self.cache.invalidate(1, self.rut1)
+
+    def testExpired(self):
+        cache = self.buildCache(datetime.timedelta(0))
+        cache.update(1, self.rut1, 'result')
+        self.assertIsNone(cache.get(1, self.rut1))
+        self.assertEqual(1, cache.stats()['expired'])
+
+    def testGetAllowStale(self):
+        cache = self.buildCache(datetime.timedelta(0))
+        cache.update(1, self.rut1, 'result')
+        result, age = cache.get_allow_stale(1, self.rut1,
+                                            datetime.timedelta(hours=1))
+        self.assertEqual('result', result)
+        self.assertIsNotNone(age)
+        self.assertEqual((None, None), cache.get_allow_stale(
+                1, self.rut1, datetime.timedelta(0)))
+        self.assertEqual(1, cache.stats()['stale'])
+        # Non expired results are not stale.
+        self.cache.update(1, self.rut1, 'result')
+        self.assertEqual(('result', None), self.cache.get_allow_stale(
+                1, self.rut1, datetime.timedelta(hours=1)))
+
+    def testSubscribersToUpdate(self):
+        now = [datetime.datetime(2018, 10, 1, 15)]
+        cache = self.buildCache(clock=lambda: now[0])
+        user = User(self.db_connection)
+        user.set_rut(1, self.rut1)
+        user.subscribe(1, 100)
+        user_id = user.get_id(1)
+        # Never retrieved.
+        self.assertEqual([None], [subscriber.retrieved for subscriber in
+                                  cache.subscribers_to_update(user, 1)])
+        cache.update(user_id, self.rut1, 'result')
+        self.assertEqual([], cache.subscribers_to_update(user, 1))
+        self.assertEqual([now[0]], [
+                subscriber.retrieved for subscriber in
+                cache.with_retrieved(user.get_subscribers())])
+        now[0] += datetime.timedelta(hours=2)
+        self.assertEqual([user_id], [subscriber.user_id for subscriber in
+                                     cache.subscribers_to_update(user, 1)])
+
+    def testStats(self):
+        self.cache.get(1, self.rut1)
+        self.cache.update(1, self.rut1, 'result')
+        self.cache.get(1, self.rut1)
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['changed'])
+
+
+class TestSqliteCache(CacheBackendTests, TestCase):
+    def buildCache(self, exp_time=datetime.timedelta(hours=2),
+                   clock=datetime.datetime.utcnow):
+        return Cache(self.db_connection, exp_time, clock=clock)
+
+
+class TestMemoryCache(CacheBackendTests, TestCase):
+    def buildCache(self, exp_time=datetime.timedelta(hours=2),
+                   clock=datetime.datetime.utcnow):
+        return MemoryCache(exp_time, clock=clock)
+
+
+class TestDbmCache(CacheBackendTests, TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        super(TestDbmCache, self).setUp()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def buildCache(self, exp_time=datetime.timedelta(hours=2),
+                   clock=datetime.datetime.utcnow):
+        return DbmCache(os.path.join(self.tmp_dir.name, 'cache'), exp_time,
+                        clock=clock)
+
+    def testSharedFile(self):
+        other = self.buildCache()
+        self.cache.update(1, self.rut1, 'result')
+        self.assertEqual('result', other.get(1, self.rut1))
+        self.assertFalse(other.update(1, self.rut1, 'result'))
+
+
+class TestBuildCache(TestCase):
+    def testBuild(self):
+        db_connection = DbConnection(in_memory=True)
+        self.assertIsInstance(
+                cache_backends.build_cache('sqlite', db_connection), Cache)
+        self.assertIsInstance(
+                cache_backends.build_cache('memory', db_connection),
+                MemoryCache)
+        self.assertRaises(ValueError, cache_backends.build_cache, 'dbm',
+                          db_connection)
+        self.assertRaises(ValueError, cache_backends.build_cache, 'redis',
+                          db_connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+
+import sqlalchemy
+
+from src import models
+from src.db_writer import DbWriter
+from src.model_interface import Cache, DbConfig, DbConnection, ResultHistory
+from src.model_interface import User
+from src.utils import Rut
+
+
+class FileDbTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = DbConfig(url='sqlite:///%s' % os.path.join(
+                self.tmp_dir.name, 'db.sqlite'))
+        self.db_connection = DbConnection(config=self.config)
+
+    def tearDown(self):
+        self.db_connection.close()
+        self.db_connection.get_session().close()
+        self.tmp_dir.cleanup()
+
+
+class TestDbWriter(FileDbTestCase):
+
+    def setUp(self):
+        super(TestDbWriter, self).setUp()
+        self.writer = DbWriter(self.db_connection.engine)
+        self.commits = 0
+
+        def count_commit(unused_conn):
+            self.commits += 1
+        sqlalchemy.event.listen(self.db_connection.engine, 'commit',
+                                count_commit)
+
+    def tearDown(self):
+        self.writer.stop()
+        super(TestDbWriter, self).tearDown()
+
+    @staticmethod
+    def addUser(telegram_id):
+        def job(session):
+            user = models.User(telegram_id=telegram_id)
+            session.add(user)
+            session.flush()
+            return user.id
+        return job
+
+    def blockWriter(self):
+        """Blocks the writer until the returned event is set."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(unused_session):
+            started.set()
+            release.wait()
+        self.writer.submit(block)
+        # Otherwise the jobs submitted next could join its batch.
+        started.wait(5)
+        return release
+
+    def testBatches(self):
+        release = self.blockWriter()
+        futures = [self.writer.submit(self.addUser(telegram_id))
+                   for telegram_id in range(10)]
+        commits = self.commits
+        release.set()
+        ids = [future.result(timeout=5) for future in futures]
+        self.assertEqual(10, len(set(ids)))
+        # The queued jobs are committed together.
+        self.assertEqual(1, self.commits - commits)
+        self.assertEqual(10, self.db_connection.get_session().query(
+                models.User).count())
+
+    def testFailingJobIsolated(self):
+        release = self.blockWriter()
+        first = self.writer.submit(self.addUser(1))
+        duplicated = self.writer.submit(self.addUser(1))
+        last = self.writer.submit(self.addUser(2))
+        release.set()
+        self.assertIsNotNone(first.result(timeout=5))
+        self.assertIsNotNone(last.result(timeout=5))
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            duplicated.result(timeout=5)
+        self.assertEqual(2, self.db_connection.get_session().query(
+                models.User).count())
+
+    def testStop(self):
+        release = self.blockWriter()
+        future = self.writer.submit(self.addUser(1))
+        release.set()
+        self.writer.stop()
+        # Queued jobs run before stopping.
+        self.assertTrue(future.done())
+        with self.assertRaises(RuntimeError):
+            self.writer.submit(self.addUser(2))
+
+
+class TestThreadedWrites(FileDbTestCase):
+
+    def setUp(self):
+        super(TestThreadedWrites, self).setUp()
+        self.rut = Rut.build_rut('2.343.234-k')
+
+    def testUser(self):
+        user = User(self.db_connection)
+        user.set_rut(1, self.rut)
+        user.subscribe(1, 10)
+        self.assertTrue(User(self.db_connection).is_subscribed(1, 10))
+        self.assertEqual('10', user.get_chat_id(user.get_id(1)))
+        user.unsubscribe(1, 10)
+        self.assertFalse(User(self.db_connection).is_subscribed(1, 10))
+
+    def testCache(self):
+        history = ResultHistory(self.db_connection)
+        cache = Cache(self.db_connection, history=history)
+        user_id = User(self.db_connection).get_id(1)
+        self.assertTrue(cache.update(user_id, self.rut, 'a'))
+        self.assertFalse(cache.update(user_id, self.rut, 'a'))
+        self.assertTrue(cache.update(user_id, self.rut, 'b'))
+        self.assertEqual('b', cache.get(user_id, self.rut))
+        self.assertEqual(['b'], history.events_at(self.rut))
+        cache.invalidate(user_id, self.rut)
+        self.assertIsNone(cache.get(user_id, self.rut))
+
+    def testProfilerScope(self):
+        with self.db_connection.unit_of_work('update:set'):
+            User(self.db_connection).set_rut(1, self.rut)
+        scopes = self.db_connection.profiler.snapshot()['scopes']
+        # Lookup of the user, then its insert and the rut update, run by
+        # the writer thread.
+        self.assertEqual(3, scopes['update:set']['queries'])
+
+    def testUnitOfWorkWritesCommitted(self):
+        # The writer commits each write, the unit of work can't roll them
+        # back.
+        with self.assertRaises(ValueError):
+            with self.db_connection.unit_of_work():
+                User(self.db_connection).set_rut(1, self.rut)
+                raise ValueError()
+        self.assertEqual(self.rut, User(self.db_connection).get_rut(1))
+
+    def testConcurrentWriters(self):
+        cache = Cache(self.db_connection)
+        errors = []
+
+        def work(first_telegram_id):
+            try:
+                for telegram_id in range(first_telegram_id,
+                                         first_telegram_id + 20):
+                    with self.db_connection.unit_of_work():
+                        user = User(self.db_connection)
+                        user.set_rut(telegram_id, self.rut)
+                        cache.update(user.get_id(telegram_id), self.rut,
+                                     'result')
+            except Exception as exception:  # pylint: disable=broad-except
+                errors.append(exception)
+        threads = [threading.Thread(target=work, args=(i * 100,))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        session = self.db_connection.get_session()
+        self.assertEqual(100, session.query(models.User).filter(
+                models.User.rut == str(self.rut.rut_sin_digito)).count())
+        self.assertEqual(100, session.query(models.CachedResult).count())
+
+
+if __name__ == '__main__':
+    unittest.main()
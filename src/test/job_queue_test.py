@@ -0,0 +1,126 @@
+import datetime
+import unittest
+from unittest import TestCase
+
+from src.job_queue import JobQueue
+from src.model_interface import DbConnection
+from src.test.db_writer_test import FileDbTestCase
+
+
+class TestJobQueue(TestCase):
+
+    def setUp(self):
+        self.db_connection = DbConnection(in_memory=True)
+        self.jobs = JobQueue(self.db_connection,
+                             lease=datetime.timedelta(minutes=10),
+                             max_attempts=3,
+                             retry_delay=datetime.timedelta(minutes=1))
+        self.now = datetime.datetime(2018, 10, 1, 15)
+
+    def testLeaseAndComplete(self):
+        self.assertTrue(self.jobs.put('refresh', {'user_id': 1},
+                                      available_at=self.now))
+        self.assertTrue(self.jobs.put('notify', {'message': 'hi'},
+                                      available_at=self.now))
+        jobs = self.jobs.lease('refresh', self.now, limit=10)
+        self.assertEqual(1, len(jobs))
+        self.assertEqual({'user_id': 1}, jobs[0].payload)
+        self.assertEqual(1, jobs[0].attempts)
+        # Leased.
+        self.assertEqual([], self.jobs.lease('refresh', self.now))
+        self.jobs.complete(jobs[0])
+        self.assertEqual({'pending': 1, 'leased': 0, 'dead': 0},
+                         self.jobs.stats())
+
+    def testNotAvailableYet(self):
+        self.jobs.put('refresh', {}, available_at=self.now)
+        self.assertEqual([], self.jobs.lease(
+                'refresh', self.now - datetime.timedelta(seconds=1)))
+
+    def testClock(self):
+        jobs = JobQueue(self.db_connection, clock=lambda: self.now)
+        # Available from the current time of the clock.
+        jobs.put('refresh', {})
+        self.assertEqual([], jobs.lease(
+                'refresh', self.now - datetime.timedelta(seconds=1)))
+        self.assertEqual(1, len(jobs.lease('refresh', self.now)))
+
+    def testKey(self):
+        self.assertTrue(self.jobs.put('refresh', {'n': 1}, key='a'))
+        self.assertFalse(self.jobs.put('refresh', {'n': 2}, key='a'))
+        self.assertTrue(self.jobs.put('refresh', {'n': 3}, key='b'))
+        self.assertEqual(2, self.jobs.stats()['pending'])
+
+    def testExpiredLease(self):
+        self.jobs.put('refresh', {}, available_at=self.now)
+        self.jobs.lease('refresh', self.now)
+        later = self.now + datetime.timedelta(minutes=10)
+        jobs = self.jobs.lease('refresh', later)
+        self.assertEqual(2, jobs[0].attempts)
+        later += datetime.timedelta(minutes=10)
+        self.jobs.lease('refresh', later)
+        # Out of attempts.
+        later += datetime.timedelta(minutes=10)
+        self.assertEqual([], self.jobs.lease('refresh', later))
+        self.assertEqual('lease expired',
+                         self.jobs.dead('refresh')[0].last_error)
+
+    def testRelease(self):
+        self.jobs.put('refresh', {}, available_at=self.now)
+        job = self.jobs.lease('refresh', self.now)[0]
+        self.jobs.release(job, self.now)
+        # Available again, the attempt not counted.
+        self.assertEqual(1, self.jobs.lease('refresh', self.now)[0].attempts)
+
+    def testRetries(self):
+        self.jobs.put('refresh', {}, available_at=self.now)
+        now = self.now
+        for delay in (1, 2):
+            job = self.jobs.lease('refresh', now)[0]
+            self.jobs.fail(job, now, 'failed')
+            now += datetime.timedelta(minutes=delay)
+            # Backoff.
+            self.assertEqual([], self.jobs.lease(
+                    'refresh', now - datetime.timedelta(seconds=1)))
+        job = self.jobs.lease('refresh', now)[0]
+        self.jobs.fail(job, now, 'failed again')
+        self.assertEqual([], self.jobs.lease(
+                'refresh', now + datetime.timedelta(days=1)))
+        dead = self.jobs.dead('refresh')
+        self.assertEqual(['failed again'], [job.last_error for job in dead])
+
+        self.jobs.retry_dead(dead[0].id, now)
+        self.assertEqual(1, self.jobs.lease('refresh', now)[0].attempts)
+
+    def testPruneDead(self):
+        self.jobs.put('refresh', {}, key='a', available_at=self.now)
+        for _ in range(3):
+            job = self.jobs.lease(
+                    'refresh', self.now + datetime.timedelta(hours=1))[0]
+            self.jobs.fail(job, self.now, 'failed')
+        self.assertEqual(0, self.jobs.prune_dead(self.now))
+        self.assertEqual(1, self.jobs.prune_dead(
+                self.now + datetime.timedelta(seconds=1)))
+        self.assertTrue(self.jobs.put('refresh', {}, key='a'))
+
+
+class TestJobQueueRestart(FileDbTestCase):
+
+    def testLeaseSurvivesRestart(self):
+        now = datetime.datetime(2018, 10, 1, 15)
+        JobQueue(self.db_connection).put('refresh', {'user_id': 1},
+                                         available_at=now)
+        JobQueue(self.db_connection).lease('refresh', now)
+        self.db_connection.close()
+        self.db_connection.get_session().close()
+
+        self.db_connection = DbConnection(config=self.config)
+        jobs = JobQueue(self.db_connection)
+        self.assertEqual([], jobs.lease('refresh', now))
+        # Leased again once the lease of the dead process expires.
+        job = jobs.lease('refresh', now + datetime.timedelta(minutes=10))[0]
+        self.assertEqual(({'user_id': 1}, 2), (job.payload, job.attempts))
+
+
+if __name__ == '__main__':
+    unittest.main()
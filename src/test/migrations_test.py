@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+
+from src import maintenance, migrations
+from src.model_interface import DbConfig, DbConnection, User
+
+# Schema created by the bot before migrations existed.
+_LEGACY_SCHEMA = (
+        'CREATE TABLE users (id INTEGER NOT NULL, telegram_id INTEGER, '
+        'rut VARCHAR(9), PRIMARY KEY (id), UNIQUE (telegram_id))',
+        'CREATE TABLE cached_results (id INTEGER NOT NULL, user_id INTEGER, '
+        'rut VARCHAR(9), retrieved DATETIME DEFAULT (CURRENT_TIMESTAMP), '
+        'result VARCHAR(500), PRIMARY KEY (id), '
+        'FOREIGN KEY(user_id) REFERENCES users (id))',
+        'CREATE TABLE subscribed_users (id INTEGER NOT NULL, user_id INTEGER, '
+        'chat_id VARCHAR(20), PRIMARY KEY (id), UNIQUE (user_id), '
+        'UNIQUE (chat_id), FOREIGN KEY(user_id) REFERENCES users (id))',
+        "INSERT INTO users (telegram_id, rut) VALUES (33, '2343234')",
+)
+
+
+class TestMigrations(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'db.sqlite')
+        self.config = DbConfig(url='sqlite:///%s' % self.path)
+        # Run last, after the connections are closed.
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def connect(self):
+        db_connection = DbConnection(config=self.config)
+        self.addCleanup(db_connection.close)
+        return db_connection
+
+    def indexes(self, db_connection):
+        session = db_connection.get_session()
+        return {row[1] for row in session.execute(
+                'PRAGMA index_list(cached_results)')}
+
+    def testNewDatabase(self):
+        db_connection = self.connect()
+        self.assertEqual(migrations.LATEST_VERSION,
+                         db_connection.pragma('user_version'))
+        self.assertIn('ix_cached_results_user_id_rut',
+                      self.indexes(db_connection))
+        self.assertIn('ix_cached_results_retrieved',
+                      self.indexes(db_connection))
+        db_connection.get_session().close()
+
+    def testLegacyDatabase(self):
+        connection = sqlite3.connect(self.path)
+        for statement in _LEGACY_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+        db_connection = self.connect()
+        self.assertEqual(migrations.LATEST_VERSION,
+                         db_connection.pragma('user_version'))
+        # Left to the offline vacuum, not run on startup.
+        self.assertEqual(0, db_connection.pragma('auto_vacuum'))
+        self.assertIn('ix_cached_results_user_id_rut',
+                      self.indexes(db_connection))
+        self.assertEqual('2343234', str(
+                User(db_connection).get_rut(33).rut_sin_digito))
+        self.assertIn('ix_result_history_rut_observed_at', {
+                row[1] for row in db_connection.get_session().execute(
+                        'PRAGMA index_list(result_history)')})
+        self.assertIn('ix_jobs_key', {
+                row[1] for row in db_connection.get_session().execute(
+                        'PRAGMA index_list(jobs)')})
+        db_connection.get_session().close()
+
+    def testOfflineVacuum(self):
+        connection = sqlite3.connect(self.path)
+        for statement in _LEGACY_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+        self.assertEqual(0, maintenance.main(
+                ['vacuum', '--db-url', self.config.url]))
+        db_connection = self.connect()
+        self.assertEqual(2, db_connection.pragma('auto_vacuum'))
+        self.assertEqual('2343234', str(
+                User(db_connection).get_rut(33).rut_sin_digito))
+        db_connection.get_session().close()
+
+    def testIdempotent(self):
+        self.connect().get_session().close()
+        db_connection = self.connect()
+        self.assertEqual(0, migrations.migrate(db_connection._engine))
+        db_connection.get_session().close()
+
+
+if __name__ == '__main__':
+    unittest.main()
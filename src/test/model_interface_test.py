@@ -1,12 +1,17 @@
 from contextlib import ContextDecorator
+import datetime
+import os
+import tempfile
 import unittest
 from unittest import TestCase
+import unittest.mock
 
 import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from src import models, model_interface
+from src.messages import Messages
 from src.utils import Rut
 from src.model_interface import DbConnection, User, Cache, UserBadUseError
 
@@ -43,6 +48,50 @@ class TestModelInterface(TestCase):
         cache.update(user_id, self.rut1, result2)
         self.assertEqual(result2, cache.get(user_id, self.rut1))
 
+    def testCacheStats(self):
+        user_id = self._user.get_id(9, True)
+        cache = Cache(self._db_connection)
+        self.assertIsNone(cache.get(user_id, self.rut1))
+        self.assertTrue(cache.update(user_id, self.rut1, "result"))
+        self.assertFalse(cache.update(user_id, self.rut1, "result"))
+        self.assertTrue(cache.update(user_id, self.rut1, "result2"))
+        self.assertEqual("result2", cache.get(user_id, self.rut1))
+        self.assertEqual("result2", cache.get(user_id, self.rut1))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0, stats['expired'])
+        self.assertEqual(2, stats['changed'])
+        self.assertEqual(1, stats['unchanged'])
+        self.assertAlmostEqual(2 / 3, stats['hit_ratio'])
+        self.assertEqual(2, stats['age_histogram']['<=5m'])
+        self.assertEqual(2, sum(stats['age_histogram'].values()))
+        self.assertIn('hits=2', model_interface.CacheStats.format(stats))
+
+    def testCacheStatsExpired(self):
+        user_id = self._user.get_id(9, True)
+        cache = Cache(self._db_connection, datetime.timedelta(0))
+        cache.update(user_id, self.rut1, "result")
+        self.assertIsNone(cache.get(user_id, self.rut1))
+        self.assertEqual(1, cache.stats()['expired'])
+        self.assertEqual(0, cache.stats()['hits'])
+
+    def testCacheStatsAgeHistogram(self):
+        stats = model_interface.CacheStats()
+        stats.record_hit(datetime.timedelta(minutes=3))
+        stats.record_hit(datetime.timedelta(minutes=45))
+        stats.record_hit(datetime.timedelta(days=3))
+        histogram = stats.snapshot()['age_histogram']
+        self.assertEqual(1, histogram['<=5m'])
+        self.assertEqual(1, histogram['<=60m'])
+        self.assertEqual(1, histogram['>1440m'])
+
+    def testCacheStatsClock(self):
+        since = datetime.datetime(2018, 10, 1, 15)
+        stats = model_interface.CacheStats(lambda: since)
+        self.assertEqual(since, stats.snapshot()['since'])
+
     def testRutSetAndGet(self):
         self.assertIsNone(self._user.get_rut(32))
         self._user.set_rut(32, self.rut1)
@@ -58,6 +107,154 @@ class TestModelInterface(TestCase):
         self.assertEqual(23, self._user.get_telegram_id(user_id))
 
 
+class TestIdentityCache(TestCase):
+
+    def setUp(self):
+        self._db_connection = DbConnection(in_memory=True)
+        self.rut1 = Rut.build_rut('2.343.234-k')
+        self.rut2 = Rut.build_rut('12.444.333-4')
+        self.queries = 0
+        sqlalchemy.event.listen(self._db_connection._engine,
+                                'before_cursor_execute', self.countQuery)
+
+    def countQuery(self, *unused_args):
+        self.queries += 1
+
+    def testSingleQueryPerUpdate(self):
+        User(self._db_connection).set_rut(1, self.rut1)
+        self.queries = 0
+        user = User(self._db_connection)
+        user.get_rut(1)
+        user.is_subscribed(1, 10)
+        user.get_id(1)
+        self.assertEqual(1, self.queries)
+        # Other update, served by the process wide cache.
+        User(self._db_connection).get_id(1)
+        self.assertEqual(1, self.queries)
+        self._db_connection.identity_cache.clear()
+        User(self._db_connection).get_rut(1)
+        self.assertEqual(2, self.queries)
+
+    def testInvalidation(self):
+        user = User(self._db_connection)
+        other = User(self._db_connection)
+        user.set_rut(1, self.rut1)
+        self.assertEqual(self.rut1, other.get_rut(1))
+        user.set_rut(1, self.rut2)
+        self.assertEqual(self.rut2, User(self._db_connection).get_rut(1))
+        user.subscribe(1, 10)
+        self.assertTrue(User(self._db_connection).is_subscribed(1, 10))
+        self.assertFalse(User(self._db_connection).is_subscribed(1, 11))
+        user.unsubscribe(1, 10)
+        self.assertFalse(User(self._db_connection).is_subscribed(1, 10))
+
+    def testStalePut(self):
+        cache = model_interface.IdentityCache(max_size=2)
+        generation = cache.generation(1)
+        # Modified while the identity was being loaded.
+        cache.invalidate(1)
+        cache.put(1, model_interface.UserIdentity(1, None, None), generation)
+        self.assertIsNone(cache.get(1))
+        cache.put(1, model_interface.UserIdentity(1, None, None),
+                  cache.generation(1))
+        self.assertIsNotNone(cache.get(1))
+        # Not even when its generation is forgotten.
+        generation = cache.generation(2)
+        for telegram_id in (2, 3, 4):
+            cache.invalidate(telegram_id)
+        cache.put(2, model_interface.UserIdentity(2, None, None), generation)
+        self.assertIsNone(cache.get(2))
+
+    def testBounded(self):
+        cache = model_interface.IdentityCache(max_size=2)
+        for telegram_id in range(3):
+            cache.put(telegram_id, model_interface.UserIdentity(
+                    telegram_id, None, None), cache.generation(telegram_id))
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(1))
+        cache.put(3, model_interface.UserIdentity(3, None, None),
+                  cache.generation(3))
+        # 1 was used more recently than 2.
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+
+
+class TestUnitOfWork(TestCase):
+
+    def setUp(self):
+        self._db_connection = DbConnection(in_memory=True)
+        self.rut1 = Rut.build_rut('2.343.234-k')
+        self.commits = 0
+        sqlalchemy.event.listen(self._db_connection._engine, 'commit',
+                                self.countCommit)
+
+    def countCommit(self, *unused_args):
+        self.commits += 1
+
+    def testSingleCommit(self):
+        with self._db_connection.unit_of_work():
+            user = User(self._db_connection)
+            user.set_rut(1, self.rut1)
+            user.subscribe(1, 10)
+            Cache(self._db_connection).update(user.get_id(1), self.rut1, 'r')
+        self.assertEqual(1, self.commits)
+        self._db_connection.identity_cache.clear()
+        self.assertTrue(User(self._db_connection).is_subscribed(1, 10))
+
+    def testRollback(self):
+        with self.assertRaises(ValueError):
+            with self._db_connection.unit_of_work():
+                User(self._db_connection).set_rut(1, self.rut1)
+                raise ValueError()
+        self.assertEqual(0, self.commits)
+        self.assertIsNone(User(self._db_connection).get_rut(1))
+
+    def testNested(self):
+        with self._db_connection.unit_of_work():
+            with self._db_connection.unit_of_work():
+                User(self._db_connection).set_rut(1, self.rut1)
+            self.assertEqual(0, self.commits)
+        self.assertEqual(1, self.commits)
+
+    def testSessionRemoved(self):
+        with self._db_connection.unit_of_work() as session:
+            User(self._db_connection).set_rut(1, self.rut1)
+        self.assertIsNot(session, self._db_connection.get_session())
+
+    def testAfterCommit(self):
+        called = []
+        with self._db_connection.unit_of_work():
+            User(self._db_connection).set_rut(1, self.rut1)
+            self._db_connection.after_commit(
+                    lambda: called.append(self.commits))
+            self.assertEqual([], called)
+        self.assertEqual([1], called)
+        # Outside of a unit of work it runs right away.
+        self._db_connection.after_commit(lambda: called.append(2))
+        self.assertEqual([1, 2], called)
+
+    def testAfterCommitDroppedOnRollback(self):
+        called = []
+        with self.assertRaises(ValueError):
+            with self._db_connection.unit_of_work():
+                self._db_connection.after_commit(lambda: called.append(1))
+                raise ValueError()
+        self.assertEqual([], called)
+
+    def testRollbackInvalidatesTouchedIdentities(self):
+        User(self._db_connection).set_rut(2, self.rut1)
+        User(self._db_connection).get_rut(2)
+        self.assertIsNotNone(self._db_connection.identity_cache.get(2))
+        with self.assertRaises(ValueError):
+            with self._db_connection.unit_of_work():
+                # Creates the user, the row is rolled back.
+                User(self._db_connection).get_id(1)
+                raise ValueError()
+        self.assertIsNone(self._db_connection.identity_cache.get(1))
+        # Not touched by the unit of work.
+        self.assertIsNotNone(self._db_connection.identity_cache.get(2))
+
+
 class TestSubscription(TestCase):
 
     def setUp(self):
@@ -99,6 +296,14 @@ class TestSubscription(TestCase):
                           telegram_id2, chat_id)
         self.assertIsNone(self._user.subscribe(telegram_id2, chat_id2))
 
+    def testUnsubscribeChat(self):
+        self._user.set_rut(34, self.rut1)
+        self._user.subscribe(34, 5657)
+        self.assertFalse(self._user.unsubscribe_chat(5658))
+        self.assertTrue(self._user.unsubscribe_chat(5657))
+        self.assertFalse(self._user.is_subscribed(34, 5657))
+        self.assertFalse(self._user.unsubscribe_chat(5657))
+
     def testGetSubscribersToUpdate(self):
         telegram_id = 23
         telegram_id2 = 24
@@ -123,11 +328,43 @@ class TestSubscription(TestCase):
 
         self.assertTrue(self._user.is_subscribed(telegram_id, chat_id))
         self.assertTrue(self._user.is_subscribed(telegram_id2, chat_id2))
-        self.assertEqual(1, len(self._user.get_subscribers_to_update(2)))
-        self.assertEqual(3, len(self._user.get_subscribers_to_update(0)))
+        self.assertEqual(1, len(self._user.get_subscribers_to_update(
+                2, datetime.datetime.utcnow())))
+        self.assertEqual(3, len(self._user.get_subscribers_to_update(
+                0, datetime.datetime.utcnow())))
         self.assertEqual("%s" % chat_id, self._user.get_chat_id(
                 self._user.get_id(telegram_id)))
 
+    def testGetSubscribersToUpdateOrder(self):
+        ruts = [self.rut1, self.rut2, self.rut3, self.rut4]
+        cache = Cache(self._db_connection)
+        for telegram_id, rut in zip(range(1, 5), ruts):
+            self._user.set_rut(telegram_id, rut)
+            self._user.subscribe(telegram_id, telegram_id + 100)
+        # Telegram id 4 was never retrieved, 2 is the oldest retrieved.
+        now = datetime.datetime.utcnow()
+        session = self._db_connection.get_session()
+        for telegram_id, hours_ago in ((1, 5), (2, 10), (3, 1)):
+            user_id = self._user.get_id(telegram_id)
+            cache.update(user_id, ruts[telegram_id - 1], 'result')
+            session.query(models.CachedResult).filter_by(
+                    user_id=user_id).update(
+                    {'retrieved': now - datetime.timedelta(hours=hours_ago)})
+        session.commit()
+        # A result for other rut doesn't count as retrieved.
+        cache.update(self._user.get_id(4), self.rut1, 'result')
+
+        subscribers = self._user.get_subscribers_to_update(
+                2, datetime.datetime.utcnow())
+        self.assertEqual([4, 2, 1], [s.telegram_id for s in subscribers])
+        self.assertEqual(model_interface.Subscriber(
+                self._user.get_id(4), 4, str(self.rut4.rut_sin_digito),
+                '104'), subscribers[0])
+        self.assertEqual(
+                [4, 2], [s.telegram_id for s in
+                         self._user.get_subscribers_to_update(
+                                 2, datetime.datetime.utcnow(), 2)])
+
     def testGetChatId(self):
         telegram_id = 23
         telegram_id2 = 24
@@ -153,5 +390,222 @@ class TestSubscription(TestCase):
                 self._user.get_id(telegram_id3)))
 
 
+class TestDbConfig(TestCase):
+
+    def testPragmas(self):
+        pragmas = model_interface.DbConfig(
+                journal_mode='wal', synchronous='full', mmap_size=0,
+                cache_size=-100, busy_timeout=10).pragmas()
+        self.assertIn('PRAGMA journal_mode = WAL', pragmas)
+        self.assertIn('PRAGMA synchronous = FULL', pragmas)
+        self.assertIn('PRAGMA mmap_size = 0', pragmas)
+        self.assertIn('PRAGMA cache_size = -100', pragmas)
+        self.assertIn('PRAGMA busy_timeout = 10', pragmas)
+
+    def testInvalidPragmas(self):
+        self.assertRaises(ValueError, model_interface.DbConfig(
+                journal_mode='WAL; DROP TABLE users').pragmas)
+        self.assertRaises(ValueError, model_interface.DbConfig(
+                synchronous='SOMETIMES').pragmas)
+
+    def testFromEnv(self):
+        with unittest.mock.patch.dict(os.environ, {
+                'DB_URL': 'sqlite:///other.sqlite',
+                'DB_SYNCHRONOUS': 'FULL', 'DB_BUSY_TIMEOUT_MS': '100'}):
+            config = model_interface.DbConfig.from_env()
+        self.assertEqual('sqlite:///other.sqlite', config.url)
+        self.assertEqual('FULL', config.synchronous)
+        self.assertEqual(100, config.busy_timeout)
+        self.assertEqual(model_interface.DbConfig().journal_mode,
+                         config.journal_mode)
+
+    def testAppliedOnConnect(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_connection = DbConnection(config=model_interface.DbConfig(
+                    url='sqlite:///%s' % os.path.join(tmp_dir, 'db.sqlite'),
+                    busy_timeout=1234))
+            self.assertEqual('wal', db_connection.pragma('journal_mode'))
+            self.assertEqual(1234, db_connection.pragma('busy_timeout'))
+            self.assertEqual(2, db_connection.pragma('auto_vacuum'))
+            db_connection.get_session().close()
+            db_connection.close()
+
+
+class TestResultHistory(TestCase):
+
+    _VIGENTE = 'Fecha de Pago: 01/02/2019\nEstado: Vigente Rendido'
+    _PAGADO = 'Fecha de Pago: 01/01/2019\nEstado: Pagado Rendido'
+
+    def setUp(self):
+        self._db_connection = DbConnection(in_memory=True)
+        self._history = model_interface.ResultHistory(self._db_connection)
+        self._cache = Cache(self._db_connection, history=self._history)
+        self._user = User(self._db_connection)
+        self.rut = Rut.build_rut('2.343.234-k')
+
+    def historyRows(self):
+        return self._db_connection.get_session().query(
+                models.ResultHistory).count()
+
+    def testClock(self):
+        observed_at = datetime.datetime(2018, 10, 1, 15)
+        history = model_interface.ResultHistory(self._db_connection,
+                                                lambda: observed_at)
+        history.record(self.rut, self._PAGADO)
+        self.assertEqual([observed_at], [
+                change.observed_at for change in history.changes(self.rut)])
+
+    def testRecordsOnlyChanges(self):
+        user_id = self._user.get_id(1)
+        self._cache.update(user_id, self.rut, self._PAGADO)
+        self._cache.update(user_id, self.rut, self._PAGADO)
+        self.assertEqual(1, self.historyRows())
+        # Another user with the same rut doesn't duplicate the change.
+        self._cache.update(self._user.get_id(2), self.rut, self._PAGADO)
+        self.assertEqual(1, self.historyRows())
+        # Errors are not changes of the events.
+        self._cache.update(user_id, self.rut,
+                           Messages.INTENTE_NUEVAMENTE_ERROR)
+        self._cache.update(user_id, self.rut, self._PAGADO)
+        self.assertEqual(1, self.historyRows())
+
+        self._cache.update(user_id, self.rut,
+                           self._VIGENTE + '\n\n' + self._PAGADO)
+        self._cache.update(user_id, self.rut, Messages.NO_PAGOS)
+        changes = self._history.changes(self.rut)
+        self.assertEqual(3, len(changes))
+        self.assertEqual(([self._PAGADO], []),
+                         (changes[0].added, changes[0].removed))
+        self.assertEqual(([self._VIGENTE], []),
+                         (changes[1].added, changes[1].removed))
+        self.assertEqual(([], sorted([self._VIGENTE, self._PAGADO])),
+                         (changes[2].added, changes[2].removed))
+
+        self.assertEqual(changes[1].observed_at,
+                         self._history.first_seen(self.rut, 'vigente'))
+        self.assertIsNone(self._history.first_seen(self.rut, 'rendicion'))
+        self.assertEqual([], self._history.events_at(self.rut))
+        self.assertEqual(sorted([self._VIGENTE, self._PAGADO]),
+                         self._history.events_at(self.rut,
+                                                 changes[1].observed_at))
+
+    def testCompact(self):
+        user_id = self._user.get_id(1)
+        self._cache.update(user_id, self.rut, self._PAGADO)
+        self._cache.update(user_id, self.rut,
+                           self._VIGENTE + '\n\n' + self._PAGADO)
+        self._cache.update(user_id, self.rut, self._VIGENTE)
+        self.assertEqual(2, self._db_connection.write(
+                lambda session: self._history.compact(
+                        session, str(self.rut.rut_sin_digito),
+                        datetime.datetime.utcnow())))
+        self.assertEqual(1, self.historyRows())
+        self.assertEqual([self._VIGENTE], self._history.events_at(self.rut))
+        # Still deduplicated against the compacted state.
+        self._cache.update(self._user.get_id(2), self.rut, self._VIGENTE)
+        self.assertEqual(1, self.historyRows())
+
+
+class TestDbMaintenance(TestCase):
+
+    def setUp(self):
+        self._db_connection = DbConnection(in_memory=True)
+        self._user = User(self._db_connection)
+        self._cache = Cache(self._db_connection)
+        self._maintenance = model_interface.DbMaintenance(
+                self._db_connection, datetime.timedelta(0), batch_size=2,
+                pause=0)
+        self.rut1 = Rut.build_rut('2.343.234-k')
+        self.rut2 = Rut.build_rut('12.444.333-4')
+
+    def cachedRows(self):
+        return self._db_connection.get_session().query(
+                models.CachedResult).count()
+
+    def testPruneCache(self):
+        subscribed_id = self._user.get_id(1)
+        self._user.set_rut(1, self.rut1)
+        self._user.subscribe(1, 11)
+        # Tied to the subscription.
+        self._cache.update(subscribed_id, self.rut1, 'result')
+        # One-off query from a subscribed user.
+        self._cache.update(subscribed_id, self.rut2, 'result')
+        # Non subscribed users.
+        for telegram_id in range(2, 6):
+            self._cache.update(self._user.get_id(telegram_id), self.rut1,
+                               'result')
+        self.assertEqual(6, self.cachedRows())
+
+        self.assertEqual(5, self._maintenance.prune_cache())
+        self.assertEqual(1, self.cachedRows())
+        self.assertEqual('result', self._cache.get(subscribed_id, self.rut1))
+        self.assertEqual(0, self._maintenance.prune_cache())
+
+    def testPruneCacheRetention(self):
+        maintenance = model_interface.DbMaintenance(
+                self._db_connection, datetime.timedelta(days=1), pause=0)
+        self._cache.update(self._user.get_id(1), self.rut1, 'result')
+        self.assertEqual(0, maintenance.prune_cache())
+        self.assertEqual(1, self.cachedRows())
+
+    def testPruneCacheClock(self):
+        self._cache.update(self._user.get_id(1), self.rut1, 'result')
+        maintenance = model_interface.DbMaintenance(
+                self._db_connection, datetime.timedelta(days=1), pause=0,
+                clock=lambda: (datetime.datetime.utcnow() +
+                               datetime.timedelta(days=2)))
+        self.assertEqual(1, maintenance.prune_cache())
+
+    def testPruneHistory(self):
+        history = model_interface.ResultHistory(self._db_connection)
+        cache = Cache(self._db_connection, history=history)
+        user_id = self._user.get_id(1)
+        for rut in (self.rut1, self.rut2):
+            for result in ('a', 'a\n\nb', 'b', 'c'):
+                cache.update(user_id, rut, result)
+        maintenance = model_interface.DbMaintenance(
+                self._db_connection, batch_size=1, pause=0,
+                history_retention=datetime.timedelta(0))
+        self.assertEqual(6, maintenance.prune_history())
+        self.assertEqual(['c'], history.events_at(self.rut1))
+        self.assertEqual(['c'], history.events_at(self.rut2))
+        self.assertEqual(0, maintenance.prune_history())
+        # Within the retention, nothing is folded.
+        cache.update(user_id, self.rut1, 'd')
+        self.assertEqual(0, self._maintenance.prune_history())
+
+    def testIncrementalVacuumBatches(self):
+        maintenance = model_interface.DbMaintenance(
+                self._db_connection, datetime.timedelta(0), batch_size=10,
+                pause=0)
+        for telegram_id in range(1, 300):
+            self._cache.update(self._user.get_id(telegram_id), self.rut1,
+                               'result' * 50)
+        maintenance.prune_cache()
+        free_pages = self._db_connection.pragma('freelist_count')
+        self.assertGreater(free_pages, 10)
+        writes = []
+        write = self._db_connection.write
+
+        def counted_write(job):
+            writes.append(job)
+            return write(job)
+        self._db_connection.write = counted_write
+        self.assertGreater(maintenance.incremental_vacuum(), 0)
+        self.assertEqual(0, self._db_connection.pragma('freelist_count'))
+        # Up to batch_size pages freed per write.
+        self.assertEqual(-(-free_pages // 10), len(writes))
+
+    def testRun(self):
+        for telegram_id in range(1, 300):
+            self._cache.update(self._user.get_id(telegram_id), self.rut1,
+                               'result' * 50)
+        report = self._maintenance.run()
+        self.assertEqual(299, report['rows'])
+        self.assertEqual(0, report['history_rows'])
+        self.assertGreater(report['bytes'], 0)
+        self.assertEqual(0, self.cachedRows())
+
+
 if __name__ == '__main__':
     unittest.main()
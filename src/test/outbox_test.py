@@ -0,0 +1,120 @@
+import threading
+import unittest
+from unittest import TestCase
+
+import telegram
+
+from src import outbox
+from src.outbox import Outbox, TokenBucket
+from src.retry import RetryPolicy
+
+
+class TestTokenBucket(TestCase):
+
+    def testBucket(self):
+        bucket = TokenBucket(2, 2, 0)
+        for _ in range(2):
+            self.assertEqual(0, bucket.wait(0))
+            bucket.take(0)
+        self.assertEqual(0.5, bucket.wait(0))
+        self.assertEqual(0, bucket.wait(0.5))
+        self.assertFalse(bucket.full(0.5))
+        self.assertTrue(bucket.full(10))
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.unauthorized = []
+        self.outbox = Outbox(
+                global_rate=1000, chat_rate=20,
+                on_unauthorized=self.unauthorized.append,
+                retry_policy=RetryPolicy((telegram.error.NetworkError,),
+                                         base_delay=0.01, max_delay=0.01,
+                                         max_elapsed=0.1))
+
+    def tearDown(self):
+        self.outbox.stop(5)
+
+    def message(self, chat_id, text):
+        return lambda: self.sent.append((chat_id, text))
+
+    def blockOutbox(self):
+        """Blocks the outbox until the returned event is set."""
+        release = threading.Event()
+        self.outbox.send(0, lambda: release.wait(5))
+        return release
+
+    def testPriority(self):
+        release = self.blockOutbox()
+        self.outbox.send(1, self.message(1, 'background'))
+        self.outbox.send(2, self.message(2, 'reply'), outbox.INTERACTIVE)
+        release.set()
+        self.assertTrue(self.outbox.join(5))
+        self.assertEqual([(2, 'reply'), (1, 'background')], self.sent)
+
+    def testChatRate(self):
+        release = self.blockOutbox()
+        for text in ('a', 'b'):
+            self.outbox.send(1, self.message(1, text))
+        self.outbox.send(2, self.message(2, 'c'))
+        release.set()
+        self.assertTrue(self.outbox.join(5))
+        # The second message to 1 waits for its chat's bucket.
+        self.assertEqual([(1, 'a'), (2, 'c'), (1, 'b')], self.sent)
+
+    def testRetryAfter(self):
+        attempts = []
+
+        def flooded():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise telegram.error.RetryAfter(0.1)
+            return 'sent'
+        self.assertEqual('sent', self.outbox.send(1, flooded).result(5))
+        self.assertEqual(2, len(attempts))
+
+    def testNetworkError(self):
+        attempts = []
+
+        def fail():
+            attempts.append(1)
+            raise telegram.error.NetworkError('down')
+        future = self.outbox.send(1, fail)
+        with self.assertRaises(telegram.error.NetworkError):
+            future.result(5)
+        self.assertGreater(len(attempts), 1)
+
+    def testBadRequestNotRetried(self):
+        attempts = []
+
+        def fail():
+            attempts.append(1)
+            raise telegram.error.BadRequest('too long')
+        future = self.outbox.send(1, fail)
+        with self.assertRaises(telegram.error.BadRequest):
+            future.result(5)
+        self.assertEqual(1, len(attempts))
+
+    def testUnauthorized(self):
+        def blocked():
+            raise telegram.error.Unauthorized('blocked')
+        future = self.outbox.send(1, blocked)
+        with self.assertRaises(telegram.error.Unauthorized):
+            future.result(5)
+        self.assertTrue(self.outbox.join(5))
+        self.assertEqual(['1'], self.unauthorized)
+
+    def testStop(self):
+        release = self.blockOutbox()
+        future = self.outbox.send(1, self.message(1, 'a'))
+        release.set()
+        self.outbox.stop(5)
+        self.assertTrue(future.done())
+        with self.assertRaises(RuntimeError):
+            self.outbox.send(1, self.message(1, 'b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import datetime
+import unittest
+from unittest import TestCase
+
+from src.model_interface import DbConnection, User
+from src.pacing import RefreshPacer
+from src.scheduler import RefreshScheduler
+from src.utils import Rut
+
+
+class TestRefreshPacer(TestCase):
+
+    def setUp(self):
+        self.db_connection = DbConnection(in_memory=True)
+        # Friday 12:00 in Santiago, the window closes in 12 hours.
+        self.now = datetime.datetime(2016, 12, 2, 15)
+        for telegram_id in range(1, 25):
+            self.subscribe(telegram_id)
+        self.scheduler = RefreshScheduler(self.db_connection, 33, rate=60)
+        self.pacer = RefreshPacer(self.scheduler, 1, 10)
+
+    def subscribe(self, telegram_id):
+        user = User(self.db_connection)
+        user.set_rut(telegram_id, Rut.build_rut_sin_digito(
+                str(10000000 + telegram_id)))
+        user.subscribe(telegram_id, 100 + telegram_id)
+
+    def testRate(self):
+        self.scheduler.reload(self.now)
+        self.assertEqual(2, self.pacer.required_rate(self.now))
+        self.assertEqual(2, self.pacer.update(self.now))
+        self.assertEqual(2, self.scheduler.rate)
+        # New subscribers raise the rate, up to the max.
+        for telegram_id in range(25, 121):
+            self.subscribe(telegram_id)
+        self.scheduler.reload(self.now)
+        self.assertEqual(10, self.pacer.update(self.now))
+
+    def testDeadline(self):
+        self.scheduler.reload(self.now)
+        # The 24 due by an earlier deadline, eg the opening on warmups.
+        deadline = self.now + datetime.timedelta(hours=4)
+        self.assertEqual(6, self.pacer.required_rate(self.now, deadline))
+        self.assertEqual(6, self.pacer.update(self.now, deadline))
+        self.assertEqual(6, self.scheduler.rate)
+
+    def testMinRate(self):
+        self.scheduler.set_rate(3600)
+        now = self.now
+        for _ in range(24):
+            now += datetime.timedelta(seconds=1)
+            self.scheduler.done(self.scheduler.next_due(now), now)
+        # Refreshed, not due again until after the window closes.
+        self.assertEqual(0, self.pacer.required_rate(now))
+        self.assertEqual(1, self.pacer.update(now))
+
+    def testReport(self):
+        self.scheduler.reload(self.now)
+        self.pacer.update(self.now)
+        report = self.pacer.report(self.now)
+        self.assertEqual(24, report['due'])
+        self.assertEqual(datetime.datetime(2016, 12, 3, 3), report['closing'])
+        self.assertEqual(report['closing'], report['completion'])
+        self.assertTrue(report['on_time'])
+        self.scheduler.set_rate(1)
+        report = self.pacer.report(self.now)
+        self.assertFalse(report['on_time'])
+        self.assertIn('behind the SLA', RefreshPacer.format(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
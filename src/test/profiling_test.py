@@ -0,0 +1,74 @@
+import unittest
+from unittest import TestCase
+
+from src import profiling
+from src.model_interface import DbConfig, DbConnection, User
+from src.profiling import QueryProfiler
+
+
+class TestQueryProfiler(TestCase):
+
+    def setUp(self):
+        self.db_connection = DbConnection(in_memory=True)
+        self.profiler = QueryProfiler(repeated_query_threshold=3)
+        self.profiler.attach(self.db_connection.engine)
+
+    def testStatementTemplate(self):
+        self.assertEqual(
+                'SELECT a FROM t WHERE id IN (?, ...) AND b = ?',
+                profiling.statement_template(
+                        'SELECT a\n  FROM t WHERE id IN (?, ?,?) AND b = ?'))
+
+    def testScopes(self):
+        with self.profiler.scope('update:get'):
+            User(self.db_connection).get_id(1)
+            # Nested scopes are part of the outermost one.
+            with self.profiler.scope('inner'):
+                User(self.db_connection).get_id(1)
+        with self.profiler.scope('update:get'):
+            pass
+        scopes = self.profiler.snapshot()['scopes']
+        self.assertEqual(['update:get'], list(scopes))
+        self.assertEqual(2, scopes['update:get']['count'])
+        # Lookup and insert of the new user, then the identity cache.
+        self.assertEqual(2, scopes['update:get']['max_queries'])
+        self.assertEqual(1, scopes['update:get']['avg_queries'])
+
+    def testTemplates(self):
+        User(self.db_connection).get_id(1)
+        User(self.db_connection).get_id(2)
+        templates = self.profiler.snapshot()['templates']
+        self.assertEqual(2, len(templates))
+        for template in templates:
+            self.assertEqual(2, template['count'])
+        self.assertIn('?', self.profiler.format(self.profiler.snapshot()))
+
+    def testRepeatedQueryLogged(self):
+        with self.assertLogs('bot_main_logger', 'WARNING') as logs:
+            with self.profiler.scope('step'):
+                for telegram_id in range(4):
+                    User(self.db_connection).get_id(telegram_id)
+        self.assertEqual(2, len(logs.output))
+        self.assertIn('Query run 4 times in step', logs.output[0])
+
+    def testSlowQueryLogged(self):
+        profiler = QueryProfiler(slow_query_threshold=0)
+        profiler.attach(self.db_connection.engine)
+        with self.assertLogs('bot_main_logger', 'WARNING') as logs:
+            User(self.db_connection).get_id(1)
+        self.assertIn('Slow query', logs.output[0])
+
+    def testUnitOfWorkScope(self):
+        db_connection = DbConnection(in_memory=True, config=DbConfig())
+        with db_connection.unit_of_work('update:set'):
+            User(db_connection).get_id(1)
+        with db_connection.unit_of_work():
+            User(db_connection).get_id(1)
+        scopes = db_connection.profiler.snapshot()['scopes']
+        # Lookup, insert and commit.
+        self.assertEqual(2, scopes['update:set']['queries'])
+        self.assertEqual(0, scopes['update']['queries'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from unittest import TestCase
+
+from src.retry import RetryBudget, RetryPolicy
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Flaky():
+    """Fails 'failures' times, then returns 'ok'."""
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError('down')
+        return 'ok'
+
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def policy(self, **kwargs):
+        policy = RetryPolicy((ConnectionError,), **kwargs)
+        policy.sleep = self.clock.sleep
+        policy.clock = self.clock
+        return policy
+
+    def testRetries(self):
+        flaky = Flaky(3)
+        self.assertEqual('ok', self.policy().call(flaky))
+        self.assertEqual(4, flaky.calls)
+        # Jittered delays of at most 0.5, 1 and 2 seconds.
+        self.assertLessEqual(self.clock.now, 3.5)
+
+    def testMaxElapsed(self):
+        flaky = Flaky(100)
+        with self.assertRaises(ConnectionError):
+            self.policy(base_delay=1, max_delay=1, max_elapsed=10).call(
+                    flaky)
+        self.assertLessEqual(self.clock.now, 10)
+        self.assertGreater(flaky.calls, 2)
+
+    def testOtherErrorsNotRetried(self):
+        def fail():
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            self.policy().call(fail)
+
+    def testBudget(self):
+        budget = RetryBudget(ratio=0.5, minimum=0, window=60,
+                             clock=self.clock)
+        policy = self.policy(budget=budget)
+        # A retry every 2 calls.
+        self.assertEqual('ok', policy.call(Flaky(1)))
+        flaky = Flaky(1)
+        with self.assertRaises(ConnectionError):
+            policy.call(flaky)
+        self.assertEqual(1, flaky.calls)
+        self.assertEqual('ok', policy.call(Flaky(1)))
+        with self.assertRaises(ConnectionError):
+            policy.call(Flaky(1))
+        # The retries in the window passed don't count.
+        self.clock.now += 60
+        self.assertEqual('ok', policy.call(Flaky(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
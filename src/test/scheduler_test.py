@@ -0,0 +1,131 @@
+import datetime
+import unittest
+from unittest import TestCase
+
+from src import models
+from src.cache_backends import MemoryCache
+from src.model_interface import Cache, DbConnection, User
+from src.scheduler import RefreshScheduler
+from src.utils import Rut
+
+
+class TestRefreshScheduler(TestCase):
+
+    def setUp(self):
+        self.db_connection = DbConnection(in_memory=True)
+        self.now = datetime.datetime(2018, 10, 1, 15)
+        user = User(self.db_connection)
+        cache = Cache(self.db_connection)
+        session = self.db_connection.get_session()
+        # Telegram id 1 was never retrieved, 2 and 3 are due 1 and 2 hours
+        # ago and 4 is due in an hour.
+        for telegram_id, hours_ago in ((1, None), (2, 34), (3, 35), (4, 32)):
+            rut = Rut.build_rut_sin_digito(str(10000000 + telegram_id))
+            user.set_rut(telegram_id, rut)
+            user.subscribe(telegram_id, 100 + telegram_id)
+            if hours_ago is None:
+                continue
+            cache.update(user.get_id(telegram_id), rut, 'result')
+            session.query(models.CachedResult).filter_by(
+                    user_id=user.get_id(telegram_id)).update(
+                    {'retrieved': self.now - datetime.timedelta(
+                            hours=hours_ago)})
+        session.commit()
+        # Refreshes don't update the db here, reloading would undo them.
+        self.scheduler = RefreshScheduler(
+                self.db_connection, 33, rate=60,
+                reload_period=datetime.timedelta(days=10))
+
+    def drain(self, now, due_by=None):
+        subscribers = []
+        subscriber = self.scheduler.next_due(now, due_by)
+        while subscriber is not None:
+            subscribers.append(subscriber)
+            self.scheduler.done(subscriber, now)
+            now += datetime.timedelta(minutes=1)
+            subscriber = self.scheduler.next_due(now, due_by)
+        return [subscriber.telegram_id for subscriber in subscribers]
+
+    def testOrder(self):
+        self.assertEqual([1, 3, 2], self.drain(self.now))
+        # Refreshed ones are due again in 33 hours.
+        self.assertEqual(
+                [4], self.drain(self.now + datetime.timedelta(hours=1)))
+        self.assertEqual([], self.drain(self.now + datetime.timedelta(
+                hours=2)))
+        self.assertEqual([1, 3, 2, 4], self.drain(
+                self.now + datetime.timedelta(hours=34)))
+
+    def testCacheBackend(self):
+        # Scheduled by the results in the cache in use, not in the db.
+        cache = MemoryCache(clock=lambda: self.now)
+        user = User(self.db_connection)
+        for telegram_id in (1, 2, 3):
+            cache.update(user.get_id(telegram_id), Rut.build_rut_sin_digito(
+                    str(10000000 + telegram_id)), 'result')
+        self.scheduler = RefreshScheduler(
+                self.db_connection, 33, rate=60,
+                reload_period=datetime.timedelta(days=10), cache=cache)
+        self.assertEqual([4], self.drain(self.now))
+
+    def testRate(self):
+        self.assertEqual(1, self.scheduler.next_due(self.now).telegram_id)
+        # One per minute at 60 per hour.
+        self.assertIsNone(self.scheduler.next_due(self.now))
+        self.assertEqual(60, self.scheduler.seconds_until_next(self.now))
+        later = self.now + datetime.timedelta(minutes=1)
+        self.assertEqual(3, self.scheduler.next_due(later).telegram_id)
+        self.scheduler.set_rate(3600)
+        later += datetime.timedelta(minutes=1)
+        self.assertEqual(2, self.scheduler.next_due(later).telegram_id)
+        self.assertIsNone(self.scheduler.next_due(later))
+        with self.assertRaises(ValueError):
+            self.scheduler.set_rate(0)
+
+    def testDueBy(self):
+        due_by = self.now + datetime.timedelta(hours=1)
+        # 4 is handed out ahead of time.
+        self.assertEqual([1, 3, 2, 4], self.drain(self.now, due_by))
+        # Refreshed at 'now', due again 32 hours after 'due_by'.
+        self.assertEqual(32 * 3600, self.scheduler.seconds_until_next(
+                self.now + datetime.timedelta(minutes=4), due_by))
+
+    def testReloadKeepsInFlight(self):
+        subscriber = self.scheduler.next_due(self.now)
+        User(self.db_connection).unsubscribe(3, 103)
+        self.scheduler.reload(self.now)
+        # 1 is being refreshed and 3 left.
+        self.assertEqual(
+                [2], self.drain(self.now + datetime.timedelta(minutes=1)))
+        self.scheduler.done(subscriber, self.now)
+        self.assertEqual(3, self.scheduler.report(self.now)['subscribers'])
+
+    def testGroup(self):
+        # 5 shares the rut of 4, which isn't due yet.
+        user = User(self.db_connection)
+        user.set_rut(5, Rut.build_rut_sin_digito('10000004'))
+        user.subscribe(5, 105)
+        self.scheduler.set_rate(3600)
+        now = self.now + datetime.timedelta(hours=1)
+        # Never retrieved, 5 goes first, along with 4.
+        for expected in ([1], [5, 4], [3], [2]):
+            group = self.scheduler.next_due_group(now)
+            self.assertEqual(expected, [subscriber.telegram_id
+                                        for subscriber in group])
+            for subscriber in group:
+                self.scheduler.done(subscriber, now)
+            now += datetime.timedelta(seconds=1)
+        self.assertEqual([], self.scheduler.next_due_group(now))
+
+    def testReport(self):
+        self.scheduler.reload(self.now)
+        report = self.scheduler.report(self.now)
+        self.assertEqual(4, report['subscribers'])
+        self.assertEqual(3, report['backlog'])
+        self.assertEqual(2 * 3600, report['max_lag'])
+        self.assertAlmostEqual(3 / 60, report['backlog_hours'])
+        self.assertIn('backlog 3', RefreshScheduler.format(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import threading
+import unittest
+from unittest import TestCase
+
+from src.shutdown import ShutdownCoordinator
+
+
+class TestShutdownCoordinator(TestCase):
+
+    def setUp(self):
+        self.ran = []
+
+    def step(self, name):
+        return lambda: self.ran.append(name)
+
+    def testOrder(self):
+        coordinator = ShutdownCoordinator(5)
+        for name in ('updates', 'refreshes', 'db'):
+            coordinator.add(name, self.step(name))
+        self.assertEqual([], coordinator.run())
+        self.assertEqual(['updates', 'refreshes', 'db'], self.ran)
+
+    def testFailingStep(self):
+        def fail():
+            raise ValueError('failed')
+        coordinator = ShutdownCoordinator(5)
+        coordinator.add('first', fail)
+        coordinator.add('second', self.step('second'))
+        self.assertEqual(['first'], coordinator.run())
+        self.assertEqual(['second'], self.ran)
+
+    def testDeadline(self):
+        release = threading.Event()
+        coordinator = ShutdownCoordinator(0.2)
+        coordinator.add('stuck', release.wait)
+        coordinator.add('after', self.step('after'))
+        try:
+            unfinished = coordinator.run()
+        finally:
+            release.set()
+        # The next steps are still started, but not waited for.
+        self.assertEqual('stuck', unfinished[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
+import datetime
 import unittest
 from unittest import TestCase
 
+from src import utils
 from src.utils import Rut
 
 
@@ -81,5 +83,51 @@ class TestRutObject(TestCase):
         self.assertEqual('k', rut.digito_verificador)
 
 
+class TestWindow(TestCase):
+    def test_window_opening(self):
+        # Santiago is UTC-3 in december and UTC-4 in june.
+        self.assertEqual(
+                datetime.datetime(2016, 12, 2, 13, 00),
+                utils.window_opening(datetime.datetime(2016, 12, 2, 11, 00)))
+        self.assertEqual(
+                datetime.datetime(2016, 6, 3, 14, 00),
+                utils.window_opening(datetime.datetime(2016, 6, 3, 11, 00)))
+
+    def test_window_closing(self):
+        self.assertEqual(
+                datetime.datetime(2016, 12, 3, 3, 00),
+                utils.window_closing(datetime.datetime(2016, 12, 2, 15, 00)))
+        # Still friday in Santiago.
+        self.assertEqual(
+                datetime.datetime(2016, 6, 4, 4, 00),
+                utils.window_closing(datetime.datetime(2016, 6, 4, 2, 00)))
+
+    def test_next_window(self):
+        friday = (datetime.datetime(2016, 12, 2, 13),
+                  datetime.datetime(2016, 12, 3, 3))
+        # Before it opens, while open and until midnight in Santiago.
+        for now in (datetime.datetime(2016, 12, 2, 4),
+                    datetime.datetime(2016, 12, 2, 13),
+                    datetime.datetime(2016, 12, 3, 2, 59)):
+            self.assertEqual(friday, utils.next_window(now))
+        self.assertEqual(
+                (datetime.datetime(2016, 12, 5, 13),
+                 datetime.datetime(2016, 12, 6, 3)),
+                utils.next_window(datetime.datetime(2016, 12, 3, 3)))
+        # The clocks moved forward on sunday, 2016-08-14.
+        self.assertEqual(
+                (datetime.datetime(2016, 8, 15, 13),
+                 datetime.datetime(2016, 8, 16, 3)),
+                utils.next_window(datetime.datetime(2016, 8, 13, 12)))
+
+    def test_notification_window(self):
+        window = utils.NotificationWindow()
+        now = datetime.datetime(2016, 12, 2, 11)
+        while now < datetime.datetime(2016, 12, 10):
+            self.assertEqual(utils.is_a_proper_time(now),
+                             window.is_open(now))
+            now += datetime.timedelta(minutes=30)
+
+
 if __name__ == '__main__':
     unittest.main()
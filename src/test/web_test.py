@@ -3,11 +3,14 @@ import pathlib
 import os
 import unittest
 from unittest import TestCase
+from unittest.mock import patch
 import inspect
+import urllib.error
 
 from src.utils import Rut
 from src.messages import Messages
 from src import web
+from src.test.retry_test import FakeClock
 
 
 class WebPageFromFileRetriever(web.WebRetriever):
@@ -29,6 +32,64 @@ def TestFilesBasePath() -> pathlib.Path:
     return web_path.joinpath('test/test_pages')
 
 
+class TestSharedRetriever(TestCase):
+    def setUp(self):
+        self.retriever = WebPageFromFileRetriever(
+                TestFilesBasePath().joinpath('no_pagos.html'))
+        self.shared = web.SharedRetriever(self.retriever)
+        self.rut = Rut.build_rut('12444333-4')
+
+    def testOncePerRut(self):
+        first = self.shared.retrieve_result(self.rut)
+        self.assertIs(first, self.shared.retrieve_result(self.rut))
+        self.shared.retrieve_result(Rut.build_rut('2343234-k'))
+        self.assertEqual(2, self.shared.retrievals)
+
+    def testErrorKept(self):
+        self.retriever.setPath(TestFilesBasePath().joinpath('missing.html'))
+        for _ in range(2):
+            with self.assertRaises(FileNotFoundError):
+                self.shared.retrieve_result(self.rut)
+        self.assertEqual(1, self.shared.retrievals)
+
+
+class TestWebPageDownloader(TestCase):
+    def setUp(self):
+        clock = FakeClock()
+        self.policy = web.RetryPolicy((OSError,), base_delay=1,
+                                      max_delay=1, max_elapsed=5)
+        self.policy.sleep = clock.sleep
+        self.policy.clock = clock
+        self.downloader = web.WebPageDownloader(self.policy)
+        self.rut = Rut.build_rut('12444333-4')
+
+    @staticmethod
+    def httpError(code):
+        return urllib.error.HTTPError(web.WebPageDownloader.URL, code,
+                                      'error', {}, None)
+
+    def testTimeout(self):
+        with patch('urllib.request.urlopen',
+                   side_effect=OSError('timed out')) as urlopen:
+            with self.assertRaises(web.ParsingException):
+                self.downloader.retrieve(self.rut)
+        self.assertEqual(web.FETCH_TIMEOUT, urlopen.call_args[1]['timeout'])
+
+    def testClientErrorNotRetried(self):
+        with patch('urllib.request.urlopen',
+                   side_effect=self.httpError(404)) as urlopen:
+            with self.assertRaises(web.ParsingException):
+                self.downloader.retrieve(self.rut)
+        self.assertEqual(1, urlopen.call_count)
+
+    def testServerErrorRetried(self):
+        with patch('urllib.request.urlopen',
+                   side_effect=self.httpError(503)) as urlopen:
+            with self.assertRaises(web.ParsingException):
+                self.downloader.retrieve(self.rut)
+        self.assertGreater(urlopen.call_count, 1)
+
+
 class TestPublicParser(TestCase):
     def setUp(self):
         self.retriever = WebPageFromFileRetriever()
@@ -0,0 +1,78 @@
+import threading
+import unittest
+from unittest import TestCase
+
+from src.workers import WorkerPool
+
+
+class TestWorkerPool(TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(4, 6, {'fetch': 2})
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def fetch(self, release):
+        with self.pool.stage('fetch'):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            release.wait(5)
+            with self.lock:
+                self.running -= 1
+
+    def testStageLimit(self):
+        release = threading.Event()
+        for _ in range(4):
+            self.pool.submit(self.fetch, release)
+        self.assertFalse(self.pool.join(0.1))
+        self.assertEqual(4, self.pool.stats()['pending'])
+        release.set()
+        self.assertTrue(self.pool.join(5))
+        # 4 workers, but only 2 fetching at once.
+        self.assertEqual(2, self.max_running)
+        self.assertEqual({'pending': 0, 'completed': 4}, self.pool.stats())
+
+    def testBackpressure(self):
+        release = threading.Event()
+        for _ in range(6):
+            self.pool.submit(release.wait, 5)
+        submitted = threading.Event()
+
+        def submit():
+            self.pool.submit(release.wait, 5)
+            submitted.set()
+        threading.Thread(target=submit).start()
+        # The pool is full until a task finishes.
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        self.assertTrue(self.pool.join(5))
+
+    def testFailingTask(self):
+        def fail():
+            raise ValueError('failed')
+        future = self.pool.submit(fail)
+        with self.assertRaises(ValueError):
+            future.result(5)
+        self.assertTrue(self.pool.join(5))
+        self.assertEqual(0, self.pool.stats()['pending'])
+
+    def testCancelPending(self):
+        release = threading.Event()
+        running = [self.pool.submit(release.wait, 5) for _ in range(4)]
+        queued = [self.pool.submit(release.wait, 5) for _ in range(2)]
+        self.assertEqual(2, self.pool.cancel_pending())
+        self.assertTrue(all(future.cancelled() for future in queued))
+        self.assertEqual(4, self.pool.stats()['pending'])
+        release.set()
+        self.assertTrue(self.pool.join(5))
+        self.assertTrue(all(future.result() for future in running))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 """Some utility classes and methods."""
 import datetime
 import itertools
-from typing import Optional
+from typing import Optional, Tuple
 import re
 import pytz
 
@@ -91,6 +91,27 @@ class Rut():
         return False
 
 
+# Hour (America/Santiago) at which automated messages start to be sent.
+WINDOW_OPENING_HOUR = 10
+
+_SANTIAGO_TZ = pytz.timezone('America/Santiago')
+
+
+def _to_santiago(now: datetime.datetime) -> datetime.datetime:
+    """Converts 'now' (utc if naive) to America/Santiago local time."""
+    if now.tzinfo is None or now.tzinfo.utcoffset(now) is None:
+        now = now.replace(tzinfo=pytz.utc)
+
+    return now.astimezone(_SANTIAGO_TZ)
+
+
+def _santiago_to_utc(day: datetime.date, hour: int) -> datetime.datetime:
+    """Naive utc time of 'hour' o'clock of 'day' in America/Santiago."""
+    local = _SANTIAGO_TZ.localize(
+            datetime.datetime(day.year, day.month, day.day, hour))
+    return local.astimezone(pytz.utc).replace(tzinfo=None)
+
+
 # Check whether is a proper time to send an automated message to an user.
 def is_a_proper_time(now: datetime.datetime) -> bool:
     """
@@ -98,18 +119,73 @@ def is_a_proper_time(now: datetime.datetime) -> bool:
     :param now: utc time to check if is proper
     :return:
     """
-    if now.tzinfo is None or now.tzinfo.utcoffset(now) is None:
-        now = now.replace(tzinfo=pytz.utc)
-
-    cl_tz = pytz.timezone('America/Santiago')
-    normalized_now = now.astimezone(cl_tz)
+    normalized_now = _to_santiago(now)
 
     # If saturday or sunday
     if normalized_now.weekday() > 4:
         return bool(False)  # To make pytype happy.
 
     # If between 00:00 and 9:59.
-    if normalized_now.hour < 10:
+    if normalized_now.hour < WINDOW_OPENING_HOUR:
         return bool(False)
 
     return bool(True)
+
+
+def window_opening(now: datetime.datetime) -> datetime.datetime:
+    """Naive utc time at which the window of the day of 'now' opens.
+
+    :param now: utc time, the day is taken in America/Santiago time.
+    """
+    return _santiago_to_utc(_to_santiago(now).date(), WINDOW_OPENING_HOUR)
+
+
+def window_closing(now: datetime.datetime) -> datetime.datetime:
+    """Naive utc time at which the window of the day of 'now' closes, ie
+    midnight in America/Santiago.
+
+    :param now: utc time, the day is taken in America/Santiago time.
+    """
+    return _santiago_to_utc(
+            _to_santiago(now).date() + datetime.timedelta(days=1), 0)
+
+
+def next_window(now: datetime.datetime) -> Tuple[datetime.datetime,
+                                                 datetime.datetime]:
+    """The window open at 'now', or else the next one to open.
+
+    :param now: utc time.
+    :return: naive utc (opening, closing) times of the window.
+    """
+    # On weekdays the window of the day is open or yet to open, it closes
+    # at midnight.
+    day = _to_santiago(now).date()
+    while day.weekday() > 4:
+        day += datetime.timedelta(days=1)
+    return (_santiago_to_utc(day, WINDOW_OPENING_HOUR),
+            _santiago_to_utc(day + datetime.timedelta(days=1), 0))
+
+
+class NotificationWindow():
+    """Keeps the current or next window, see next_window.
+
+    It is only calculated again once the window closes.
+    """
+    def __init__(self) -> None:
+        self._calculated_at: Optional[datetime.datetime] = None
+        self._window: Tuple[datetime.datetime, datetime.datetime] = (
+                datetime.datetime.min, datetime.datetime.min)
+
+    def next_window(self, now: datetime.datetime) -> Tuple[
+            datetime.datetime, datetime.datetime]:
+        """Naive utc (opening, closing) of the window open at 'now', or
+        else the next one."""
+        if (self._calculated_at is None or now < self._calculated_at or
+                now >= self._window[1]):
+            self._window = next_window(now)
+            self._calculated_at = now
+        return self._window
+
+    def is_open(self, now: datetime.datetime) -> bool:
+        """Same as is_a_proper_time(now)."""
+        return self.next_window(now)[0] <= now
@@ -4,19 +4,35 @@ from collections import OrderedDict
 import datetime
 from enum import Enum
 import logging
-from typing import Dict, List
+import threading
+from typing import Dict, List, Union
 import urllib.error
 import urllib.request as pyrequest
 
 import bs4
 
 from src.messages import Messages
-from src.model_interface import Cache, DbConnection, User
+from src.model_interface import CacheBackend, DbConnection, User
+from src.retry import RetryBudget, RetryPolicy
 from src.utils import Rut
 
 
 logger = logging.getLogger('bot_main_logger')  # pylint: disable=invalid-name
 
+# Seconds a download from the bank may block, connecting or reading.
+FETCH_TIMEOUT = 10
+
+# Retries of the downloads from the bank, on connection errors, timeouts and
+# server errors (urllib's URLError and socket.timeout are OSError, 4xx
+# responses are raised as BankClientError instead). The budget is shared by
+# every download.
+FETCH_RETRY_POLICY = RetryPolicy((OSError,), base_delay=1, max_delay=8,
+                                 max_elapsed=20, budget=RetryBudget())
+
+
+class BankClientError(Exception):
+    """The bank rejected the request (HTTP 4xx), not worth retrying."""
+
 
 class ParsingException(Exception):
     """Error when trying to parse results."""
@@ -155,11 +171,60 @@ class WebRetriever():  # pylint: disable=too-few-public-methods
         """
         raise NotImplementedError()
 
+    def retrieve_result(self, rut: Rut) -> 'WebResult':
+        """Retrieves and parses the web page corresponding to 'rut'."""
+        return Parser.parse(self.retrieve(rut))
+
+
+# pylint: disable=too-few-public-methods
+class LimitedRetriever(WebRetriever):
+    """Runs at most as many retrieves at once as 'slots' allows."""
+    def __init__(self, retriever: WebRetriever,
+                 slots: threading.Semaphore) -> None:
+        self._retriever = retriever
+        self._slots = slots
+
+    def retrieve(self, rut: Rut):
+        with self._slots:
+            return self._retriever.retrieve(rut)
+
+
+class SharedRetriever(WebRetriever):
+    """Retrieves and parses each rut once, for all its subscribers.
+
+    Errors are kept as well, so they are not retried for each subscriber.
+    Not thread safe, meant to be used for a single group of refreshes.
+    """
+    def __init__(self, retriever: WebRetriever) -> None:
+        self._retriever = retriever
+        self._results: Dict[int, Union['WebResult', Exception]] = {}
+        self.retrievals = 0
+
+    def retrieve(self, rut: Rut):
+        return self._retriever.retrieve(rut)
+
+    def retrieve_result(self, rut: Rut) -> 'WebResult':
+        if rut.rut_sin_digito not in self._results:
+            self.retrievals += 1
+            try:
+                self._results[rut.rut_sin_digito] = (
+                        self._retriever.retrieve_result(rut))
+            except Exception as exception:  # pylint: disable=broad-except
+                self._results[rut.rut_sin_digito] = exception
+        result = self._results[rut.rut_sin_digito]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
 
 # pylint: disable=too-few-public-methods
 class WebPageDownloader(WebRetriever):
     """Class to download a webpage."""
 
+    def __init__(self,
+                 retry_policy: RetryPolicy = FETCH_RETRY_POLICY) -> None:
+        self._retry_policy = retry_policy
+
     HEADERS = {
             'Connection': 'keep-alive',
             'Pragma': 'no-cache',
@@ -197,8 +262,7 @@ class WebPageDownloader(WebRetriever):
         parameters = ["%s=%s" % (t[0], t[1]) for t in params]
         url = self.URL + "?" + "&".join(parameters)
         try:
-            req = pyrequest.urlopen(pyrequest.Request(url,
-                                                      headers=self.HEADERS))
+            return self._retry_policy.call(self._download, url)
         except urllib.error.URLError:
             logger.exception("Connection error")
             raise ParsingException(("Error de conexion, (probablemente) "
@@ -208,6 +272,15 @@ class WebPageDownloader(WebRetriever):
             raise ParsingException(("Error de conexion, (probablemente) "
                                     "estamos trabajando para solucionarlo."))
 
+    def _download(self, url: str) -> str:
+        try:
+            req = pyrequest.urlopen(
+                    pyrequest.Request(url, headers=self.HEADERS),
+                    timeout=FETCH_TIMEOUT)
+        except urllib.error.HTTPError as http_error:
+            if 400 <= http_error.code < 500:
+                raise BankClientError('HTTP %d' % http_error.code)
+            raise
         response_bytes = req.read()
         charset = (req.headers.get_content_charset()  # type: ignore
                    or req.info().get_content_charset()  # type: ignore
@@ -303,14 +376,14 @@ class Parser():
 class Web():
     """Class that queries and represents a web response from the bank."""
     def __init__(self, db_connection: DbConnection, rut: Rut,
-                 telegram_user_id: int, cache: Cache,
+                 telegram_user_id: int, cache: CacheBackend,
                  web_retriever: WebRetriever = WebPageDownloader()) -> None:
         self.rut = rut
         self._db_connection = db_connection
         self._retrieve(telegram_user_id, web_retriever, cache)
 
     def _retrieve(self, telegram_user_id: int, web_retriever: WebRetriever,
-                  cache: Cache):
+                  cache: CacheBackend):
         user_id = User(self._db_connection).get_id(telegram_user_id)
         cached_results = cache.get(user_id, self.rut)
         self._retrieved_from_cache = cached_results is not None
@@ -321,8 +394,7 @@ class Web():
                     cached_results)
             return
 
-        raw_page = web_retriever.retrieve(self.rut)
-        web_result = Parser.parse(raw_page)
+        web_result = web_retriever.retrieve_result(self.rut)
 
         # Cache even error results to prevent users to trigger
         # too many requests to the bank.
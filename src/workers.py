@@ -0,0 +1,89 @@
+"""Bounded pool of worker threads for the background refreshes.
+
+A refresh goes through stages using different resources, querying the bank
+and sending Telegram messages. Besides the number of workers, the pool
+limits how many tasks are in each stage at once (eg the bank queries, see
+web.LimitedRetriever; the messages are paced by the outbox), and submit
+blocks while too many tasks are pending so the producer can't run ahead of
+the workers.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from typing import Dict, Set
+
+
+class WorkerPool():
+    """Runs tasks in 'workers' threads, with per stage concurrency limits."""
+
+    def __init__(self, workers: int, max_pending: int,
+                 stage_limits: Dict[str, int]) -> None:
+        """
+        :param workers: number of threads.
+        :param max_pending: submit blocks while this many tasks are queued or
+                            running.
+        :param stage_limits: max tasks at once in each stage, by name.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._stages = {name: threading.BoundedSemaphore(limit)
+                        for name, limit in stage_limits.items()}
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._futures: Set[Future] = set()
+        self._completed = 0
+
+    def stage(self, name: str) -> threading.BoundedSemaphore:
+        """Context manager holding a slot of stage 'name'."""
+        return self._stages[name]
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        """Queues function(*args, **kwargs), blocking while the pool is full.
+        """
+        self._slots.acquire()
+        with self._idle:
+            self._pending += 1
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._task_done(None)
+            raise
+        with self._idle:
+            self._futures.add(future)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future) -> None:
+        self._slots.release()
+        with self._idle:
+            self._futures.discard(future)
+            self._pending -= 1
+            self._completed += 1
+            self._idle.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """Waits until there are no pending tasks.
+
+        Returns:
+            bool: False if it timed out.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """Number of 'pending' and 'completed' tasks."""
+        with self._idle:
+            return {'pending': self._pending, 'completed': self._completed}
+
+    def cancel_pending(self) -> int:
+        """Cancels the tasks queued but not started yet.
+
+        Returns:
+            int: Number of cancelled tasks.
+        """
+        with self._idle:
+            futures = list(self._futures)
+        return sum(1 for future in futures if future.cancel())
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops accepting tasks, waits for the pending ones if 'wait'."""
+        self._executor.shutdown(wait=wait)